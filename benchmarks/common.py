@@ -0,0 +1,97 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# market and portfolio set-up shared by the benchmark scripts, following the notebooks
+
+import argparse
+import numpy as np
+
+
+def add_common_arguments(parser):
+    parser.add_argument('--backend', default='cuda', choices=('cuda', 'cpu'))
+    parser.add_argument('--num-paths', type=int, default=2**14)
+    parser.add_argument('--horizon', type=float, default=10.)
+    parser.add_argument('--num-rates', type=int, default=10)
+    parser.add_argument('--num-spreads', type=int, default=9)
+    parser.add_argument('--num-irs', type=int, default=500)
+    parser.add_argument('--cDtoH-freq', type=int, default=64)
+    parser.add_argument('--num-defs-per-path', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def make_parser(description):
+    return add_common_arguments(argparse.ArgumentParser(description=description))
+
+
+def make_engine_args(num_paths=2**14, horizon=10., num_rates=10, num_spreads=9, num_irs=500, cDtoH_freq=64,
+                     num_fine_per_coarse=25, num_inner_paths=1, num_defs_per_path=1, seed=0):
+    # returns the positional arguments of DiffusionEngine, in order
+    rng = np.random.RandomState(seed)
+    num_fine_steps = int(round(horizon*250))
+    dt = horizon/num_fine_steps
+    dT = num_fine_per_coarse*dt
+    num_coarse_steps = num_fine_steps//num_fine_per_coarse
+
+    R = np.eye(2*num_rates-1+num_spreads, dtype=np.float32)
+    initial_values = np.empty(2*num_rates-1+num_spreads, dtype=np.float32)
+    initial_defaults = np.zeros((num_spreads-1+7)//8, dtype=np.int8)
+
+    rates_params = np.empty(num_rates, dtype=[('a', '<f4'), ('b', '<f4'), ('sigma', '<f4')])
+    rates_params['a'] = rng.normal(0.5, 0.05, num_rates).round(4)
+    rates_params['b'] = rng.normal(0.03, 0.003, num_rates).round(4)
+    rates_params['sigma'] = np.abs(rng.normal(0.01, 0.001, num_rates)).round(4)
+    initial_values[:num_rates] = 0.01
+
+    fx_params = np.empty(num_rates-1, dtype=[('vol', '<f4')])
+    fx_params['vol'] = np.abs(rng.normal(0.5, 0.05, num_rates-1)).round(4)
+    initial_values[num_rates:2*num_rates-1] = 1
+
+    spreads_params = np.empty(num_spreads, dtype=[('a', '<f4'), ('b', '<f4'), ('vvol', '<f4')])
+    spreads_params['a'] = rng.normal(0.7, 0.07, num_spreads)
+    spreads_params['b'] = rng.normal(0.04, 0.004, num_spreads)
+    spreads_params['vvol'] = np.abs(rng.normal(0.1, 0.01, num_spreads))
+    initial_values[2*num_rates-1:] = 0.015
+
+    vanilla_specs = np.empty(0, dtype=[('maturity', '<f4'), ('notional', '<f4'),
+                                       ('strike', '<f4'), ('cpty', '<i4'),
+                                       ('undl', '<i4'), ('call_put', '<b1')])
+
+    irs_specs = np.empty(num_irs, dtype=[('first_reset', '<f4'), ('reset_freq', '<f4'),
+                                         ('notional', '<f4'), ('swap_rate', '<f4'),
+                                         ('num_resets', '<i4'), ('cpty', '<i4'),
+                                         ('undl', '<i4')])
+    irs_specs['first_reset'] = 0.
+    irs_specs['reset_freq'] = 75*dt
+    irs_specs['notional'] = 10000. * ((rng.choice((-1, 1), num_irs, p=(0.5, 0.5))) * rng.choice(range(1, 11), num_irs)).round(4)
+    irs_specs['swap_rate'] = np.abs(rng.normal(0.03, 0.001, num_irs)).round(4)
+    irs_specs['num_resets'] = rng.randint(int((1+dt)/(75*dt)), num_fine_steps//75+1, num_irs).astype(np.int32)
+    irs_specs['cpty'] = rng.randint(0, num_spreads-1, num_irs).astype(np.int32)
+    irs_specs['undl'] = rng.randint(0, num_rates, num_irs).astype(np.int32)
+
+    zcs_specs = np.empty(0, dtype=[('maturity', '<f4'), ('notional', '<f4'),
+                                   ('cpty', '<i4'), ('undl', '<i4')])
+
+    return (50, 50, num_coarse_steps, dT, num_fine_per_coarse, dt, num_paths, num_inner_paths, num_defs_per_path,
+            num_rates, num_spreads, R, rates_params, fx_params, spreads_params, vanilla_specs, irs_specs, zcs_specs,
+            initial_values, initial_defaults, cDtoH_freq)
+
+
+def make_engine_args_from(args, **kwargs):
+    return make_engine_args(num_paths=args.num_paths, horizon=args.horizon, num_rates=args.num_rates,
+                            num_spreads=args.num_spreads, num_irs=args.num_irs, cDtoH_freq=args.cDtoH_freq,
+                            num_defs_per_path=args.num_defs_per_path, seed=args.seed, **kwargs)
@@ -0,0 +1,68 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Standard error of a CVA estimate vs. number of paths, pseudo-random (Philox) vs. scrambled Sobol.
+
+The estimator is the CVA with the default probabilities given by the spread integrals
+(sum over the coarse dates and the counterparties of the discounted positive exposure times the
+default probability over the coarse step), which is a smooth functional of the paths. Each batch
+is an independent replication (a new key for Philox, a new scrambling for Sobol), and the standard
+error for n paths is the standard deviation across batches of the estimate on the first n paths.
+Usage (from the repository root): python -m benchmarks.convergence --backend cpu --num-paths 4096
+"""
+
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+
+def _cva_by_path_prefix(engine, prefixes):
+    discount = np.exp(-engine.dom_rate_integral[1:, None, :])
+    survival = np.exp(-engine.spread_integrals[:, 1:, :])
+    exposure = np.maximum(engine.mtm_by_cpty[1:], 0)
+    cva_by_path = (discount * exposure * (survival[:-1] - survival[1:])).sum(axis=(0, 1))
+    return np.array([cva_by_path[:n].mean() for n in prefixes])
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--num-batches', type=int, default=16, help='number of independent replications')
+    parser.add_argument('--min-paths', type=int, default=64)
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    prefixes = [n for n in 2**np.arange(int(np.log2(args.min_paths)), int(np.log2(args.num_paths))+1)]
+    std_errs = {}
+    for rng in ('philox', 'sobol'):
+        engine = DiffusionEngine(*make_engine_args_from(args), backend=args.backend, rng=rng,
+                                 no_nested_cva=True, no_nested_im=True)
+        estimates = []
+        for _ in range(args.num_batches):
+            engine.generate_batch(fused=True)
+            estimates.append(_cva_by_path_prefix(engine, prefixes))
+        estimates = np.array(estimates)
+        std_errs[rng] = estimates.std(axis=0, ddof=1)
+        print('{}: CVA = {:.4f}'.format(rng, estimates[:, -1].mean()))
+
+    print('{:>8} {:>12} {:>12} {:>8}'.format('paths', 'philox', 'sobol', 'ratio'))
+    for i, n in enumerate(prefixes):
+        print('{:>8} {:>12.4g} {:>12.4g} {:>8.1f}'.format(n, std_errs['philox'][i], std_errs['sobol'][i],
+                                                         std_errs['philox'][i]/std_errs['sobol'][i]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Time per fine step of DiffusionEngine by structure of the correlation matrix of the Brownian motions.
+
+Three correlation matrices of the same size are simulated:
+  - a block-diagonal one, each rate being correlated with its FX rate and the credit names being
+    independent, with correlation='full' (the dense Cholesky factor, zeros included) and 'block';
+  - the identity, with correlation='full' and 'identity';
+  - a k-factor model (--num-factors, random loadings), with correlation='full' (its dense
+    Cholesky factor) and the loadings.
+The report gives the multiply-adds of the correlation per path and fine step and the time per
+fine step of a batch; 'block' and 'identity' are checked to give the same MtMs as 'full'.
+Usage (from the repository root): python -m benchmarks.correlation --backend cpu --num-paths 4096 --horizon 2 --num-rates 20 --num-spreads 51
+"""
+
+import time
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--num-factors', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    from simulation.correlation_pl import factor_correlation
+    engine_args = list(make_engine_args_from(args))
+    num_rates = args.num_rates
+    num_diffusions = 2*num_rates + args.num_spreads - 1
+    rng = np.random.RandomState(args.seed)
+
+    block_R = np.eye(num_diffusions, dtype=np.float32)
+    for i in range(1, num_rates):
+        block_R[i, num_rates+i-1] = block_R[num_rates+i-1, i] = 0.3
+    loadings = rng.uniform(-0.5, 0.5, (num_diffusions, args.num_factors)).astype(np.float32)
+    dense_ops = num_diffusions * (num_diffusions+1) // 2
+    cases = [('block', block_R, 'block', num_diffusions + num_rates - 1),
+             ('identity', np.eye(num_diffusions, dtype=np.float32), 'identity', num_diffusions),
+             ('{}-factor'.format(args.num_factors), factor_correlation(loadings), loadings, num_diffusions * (args.num_factors+1))]
+
+    print('{:>10} {:>12} {:>16} {:>12} {:>16} {:>9} {:>10}'.format('R', 'full ops', 'full (ms/step)', 'ops', 'structured', 'speed-up', 'max diff'))
+    for name, R, correlation, ops in cases:
+        engine_args[11] = R
+        timings = {}
+        mtm = {}
+        for structured in (False, True):
+            engine = DiffusionEngine(*engine_args, backend=args.backend, rng='philox', outputs=('mtm_by_cpty',),
+                                     correlation=correlation if structured else 'full')
+            # the first batch includes the lazy initializations
+            engine.generate_batch(fused=True)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                engine.reset_rng_states(engine.seed)
+                engine.generate_batch(fused=True)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            timings[structured] = elapsed / (engine.num_coarse_steps * engine.num_fine_per_coarse)
+            mtm[structured] = engine.mtm_by_cpty.copy()
+        # the factor model draws other normals than the dense factor, its MtMs only agree in distribution
+        diff = '-' if isinstance(correlation, np.ndarray) else '{:.1e}'.format(np.abs(mtm[True] - mtm[False]).max())
+        print('{:>10} {:>12} {:>16.4f} {:>12} {:>16.4f} {:>9.2f} {:>10}'.format(name, dense_ops, 1e3 * timings[False], ops, 1e3 * timings[True],
+                                                                             timings[False] / timings[True], diff))
+
+
+if __name__ == '__main__':
+    main()
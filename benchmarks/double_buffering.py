@@ -0,0 +1,61 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Batch time of DiffusionEngine.generate_batch with and without double_buffering.
+
+The copy time is that of the slices of a batch alone (see benchmarks/outputs.py); the share of
+it hidden by double buffering is the time saved per batch divided by the copy time. The paths
+of both modes are checked to be identical. Only the CUDA backend has a separate copy stream,
+with the CPU backend the copies stay synchronous and nothing is hidden.
+Usage (from the repository root): python -m benchmarks.double_buffering --num-paths 65536
+"""
+
+import time
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+from benchmarks.outputs import CVA_OUTPUTS, measure
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    copy_time = measure(args, CVA_OUTPUTS)[2]
+    batch_time = {}
+    paths = {}
+    for double_buffering in (False, True):
+        engine = DiffusionEngine(*make_engine_args_from(args), backend=args.backend, rng='philox', outputs=CVA_OUTPUTS,
+                                 double_buffering=double_buffering)
+        # the first batch includes the lazy initializations
+        engine.generate_batch(fused=True)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            engine.reset_rng_states(engine.seed)
+            engine.generate_batch(fused=True)
+        batch_time[double_buffering] = (time.perf_counter() - start) / args.repeat
+        paths[double_buffering] = [getattr(engine, name).copy() for name in engine.outputs]
+        print('double_buffering={}: {:.2f} ms per batch'.format(double_buffering, 1e3*batch_time[double_buffering]))
+    saved = batch_time[False] - batch_time[True]
+    print('copies alone: {:.2f} ms per batch, {:.0%} of them hidden'.format(1e3*copy_time, saved / copy_time))
+    print('identical paths: {}'.format(all(np.array_equal(a, b) for a, b in zip(paths[False], paths[True]))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Pricing throughput of DiffusionEngine with and without large_portfolio, by trade and counterparty count.
+
+For each number of swaps (--trade-counts) and of counterparties (--cpty-counts), a batch is
+generated with the default pricing loops and with large_portfolio=True (swaps grouped by
+counterparty, direct accumulation, cooperative loads on the GPU, cache blocking on the CPU),
+with active_trades=True in both cases so that only the book layout differs. The throughput is
+in swap prices (swaps x paths x coarse steps) per second, the diffusion included, and the MtMs
+of both modes are checked to agree up to float32 rounding.
+Usage (from the repository root): python -m benchmarks.large_portfolio --backend cpu --num-paths 4096 --horizon 2
+"""
+
+import time
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--trade-counts', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--cpty-counts', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    print('{:>8} {:>6} {:>14} {:>14} {:>9} {:>10}'.format('swaps', 'cptys', 'default (/s)', 'large (/s)', 'speed-up', 'max diff'))
+    for num_cpty in args.cpty_counts:
+        for num_irs in args.trade_counts:
+            args.num_spreads = num_cpty + 1
+            args.num_irs = num_irs
+            engine_args = make_engine_args_from(args)
+            throughput = {}
+            mtm = {}
+            for large_portfolio in (False, True):
+                engine = DiffusionEngine(*engine_args, backend=args.backend, rng='philox', outputs=('mtm_by_cpty',),
+                                         active_trades=True, large_portfolio=large_portfolio)
+                # the first batch includes the lazy initializations
+                engine.generate_batch(fused=True)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    engine.reset_rng_states(engine.seed)
+                    engine.generate_batch(fused=True)
+                elapsed = (time.perf_counter() - start) / args.repeat
+                throughput[large_portfolio] = num_irs * engine.num_paths * engine.num_coarse_steps / elapsed
+                mtm[large_portfolio] = engine.mtm_by_cpty.copy()
+            diff = np.abs(mtm[True] - mtm[False]).max() / max(np.abs(mtm[False]).max(), 1e-30)
+            print('{:>8} {:>6} {:>14.3e} {:>14.3e} {:>9.2f} {:>10.1e}'.format(num_irs, num_cpty, throughput[False], throughput[True],
+                                                                          throughput[True] / throughput[False], diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Memory plan of a DiffusionEngine and of its CVA estimator (simulation/memory_plan_pl.py).
+
+The host and device memory of the engine of the benchmark set-up and of a time step of the
+estimator are printed array by array, without allocating anything. With --device-budget and/or
+--host-budget (in MB), the largest cDtoH_freq and estimator batch size (at most --batch-size)
+fitting in them are planned. With --check, the engine is then built and the planned host and
+device memory is compared to that of its arrays.
+Usage (from the repository root): python -m benchmarks.memory_plan --num-paths 1048576 --device-budget 8192
+"""
+
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+from simulation.memory_plan_pl import OPTIONAL_FEATURES, plan_memory
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--batch-size', type=int, default=2**14)
+    parser.add_argument('--num-hidden-layers', type=int, default=2)
+    parser.add_argument('--num-hidden-units', type=int, default=32)
+    parser.add_argument('--device-budget', type=float, default=None)
+    parser.add_argument('--host-budget', type=float, default=None)
+    parser.add_argument('--features', nargs='*', default=[], choices=OPTIONAL_FEATURES)
+    parser.add_argument('--min-mb', type=float, default=1.)
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    engine_kwargs = dict(backend=args.backend, rng='philox')
+    estimator_kwargs = dict(batch_size=args.batch_size, num_hidden_layers=args.num_hidden_layers, num_hidden_units=args.num_hidden_units)
+    budgets = {name: None if value is None else value*2**20 for name, value in (('device_budget', args.device_budget), ('host_budget', args.host_budget))}
+    plan = plan_memory(make_engine_args_from(args), engine_kwargs, estimator_kwargs, args.features, **budgets)
+    print(plan.summary(min_bytes=args.min_mb*2**20))
+    if args.check:
+        from simulation.diffusion_engine_pl import DiffusionEngine
+        engine = DiffusionEngine(*plan.engine_args, **plan.engine_kwargs)
+        arrays = [value for value in vars(engine).values() if isinstance(value, np.ndarray) or hasattr(value, 'gpu_data')]
+        engine_plan = plan_memory(plan.engine_args, plan.engine_kwargs)
+        for memory in ('host', 'device'):
+            # the user's arrays (specs, initial values) kept by the engine are not part of the plan
+            actual = sum(value.nbytes for value in arrays if (memory == 'device') == hasattr(value, 'gpu_data'))
+            print('{}: planned {:.1f} MB for the engine, allocated {:.1f} MB'.format(memory, engine_plan.bytes(memory)/2**20, actual/2**20))
+
+
+if __name__ == '__main__':
+    main()
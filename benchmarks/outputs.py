@@ -0,0 +1,73 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Host memory and device-to-host copy time of DiffusionEngine, all outputs vs. those of CVA learning.
+
+The CVA learning configuration retains the arrays read by learning/cva_estimator_portfolio_int_pl.py,
+i.e. all but cash_flows_by_cpty and cash_pos_by_cpty, and is also measured with default_times=True,
+the default indicators by coarse step being then replaced by the default step of each counterparty.
+The copy time is that of the slices of a batch, each copy being synchronized, so that it excludes
+the simulation.
+Usage (from the repository root): python -m benchmarks.outputs --backend cpu
+"""
+
+import time
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+CVA_OUTPUTS = ('X', 'spread_integrals', 'dom_rate_integral', 'def_indicators', 'mtm_by_cpty')
+
+
+def measure(args, outputs=None, storage_dtype='float32', default_times=False):
+    # returns the engine after one batch, the size of its host path arrays and the copy time per batch
+    from simulation.diffusion_engine_pl import DiffusionEngine, STREAMED_ARRAYS
+    engine = DiffusionEngine(*make_engine_args_from(args), backend=args.backend, rng='philox', outputs=outputs, storage_dtype=storage_dtype,
+                             default_times=default_times)
+    engine.generate_batch(fused=True)
+    keys = set(STREAMED_ARRAYS) | set(engine._output_keys(engine.outputs))
+    nbytes = sum(getattr(engine, key).nbytes for key in keys) + (engine.default_steps.nbytes if default_times else 0)
+    end = engine.num_coarse_steps + engine.num_early_pricing
+    # the copies go to the buffers of generate_batch_stream, so that the arrays of the batch are kept
+    buffers = engine._stream_buffers(1)[0]
+    elapsed = 0.
+    for _ in range(args.repeat):
+        for start_idx in range(1, end+1, engine.cDtoH_freq):
+            length = min(engine.cDtoH_freq, end+1-start_idx)
+            start = time.perf_counter()
+            engine._slice_to_host(length, {key: ary[:length] for key, ary in buffers.items()})
+            engine._synchronize()
+            elapsed += time.perf_counter() - start
+    return engine, nbytes, elapsed / args.repeat
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    results = {}
+    for label, outputs, default_times in (('all outputs', None, False), ('CVA learning', CVA_OUTPUTS, False),
+                                          ('CVA learning, default times', CVA_OUTPUTS, True)):
+        results[label] = measure(args, outputs, default_times=default_times)[1:]
+        print('{}: host arrays {:.1f} MB, copies {:.2f} ms per batch'.format(label, results[label][0]/2**20, 1e3*results[label][1]))
+    (all_bytes, all_time), (cva_bytes, cva_time), (dt_bytes, dt_time) = results.values()
+    print('savings: {:.0%} of the host memory, {:.0%} of the copy time'.format(1-cva_bytes/all_bytes, 1-cva_time/all_time))
+    print('savings with default times: {:.0%} of the host memory, {:.0%} of the copy time'.format(1-dt_bytes/all_bytes, 1-dt_time/all_time))
+
+
+if __name__ == '__main__':
+    main()
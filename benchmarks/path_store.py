@@ -0,0 +1,90 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Write and read throughput of the on-disk path store (simulation/path_store_pl.py).
+
+--num-batches batches of --num-paths paths are simulated and written to the store, one path
+block per batch, the simulation time being excluded. The store is then reopened read-only and
+read back date chunk by date chunk over all the paths (as a learning stage going backward in
+time would), then path block by path block over all the dates. The page cache is not dropped,
+use a store larger than the memory (or --directory on the target disk) for cold reads.
+Usage (from the repository root): python -m benchmarks.path_store --backend cpu --num-batches 4
+"""
+
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+from simulation.path_store_pl import PathStore
+
+
+def _throughput(nbytes, elapsed):
+    return '{:.1f} MB in {:.2f} s, {:.0f} MB/s'.format(nbytes/2**20, elapsed, nbytes/2**20/elapsed)
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--num-batches', type=int, default=4)
+    parser.add_argument('--dates-per-chunk', type=int, default=None, help='defaults to --cDtoH-freq')
+    parser.add_argument('--directory', default=None, help='defaults to a fresh temporary directory')
+    parser.add_argument('--stream', action='store_true', help='write the slices of generate_batch_stream instead of the full host arrays')
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    engine = DiffusionEngine(*make_engine_args_from(args), backend=args.backend, rng='philox', full_host_arrays=not args.stream)
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        store = PathStore.create(directory, engine, args.num_batches*args.num_paths, dates_per_chunk=args.dates_per_chunk)
+        write_time = 0.
+        for batch_idx in range(args.num_batches):
+            path_start = batch_idx*args.num_paths
+            if args.stream:
+                # the writes are interleaved with the simulation, whose time is excluded
+                for start_idx, slices in engine.generate_batch_stream(fused=True):
+                    start = time.perf_counter()
+                    store.write_stream([(start_idx, slices)], path_start)
+                    write_time += time.perf_counter() - start
+            else:
+                engine.generate_batch(fused=True)
+                start = time.perf_counter()
+                store.write_batch(engine, path_start)
+                write_time += time.perf_counter() - start
+        start = time.perf_counter()
+        store.close()
+        write_time += time.perf_counter() - start
+        nbytes = sum(store.dtypes[name].itemsize * store.num_dates * store.num_paths *
+                     int(np.prod(store.shapes[name])) for name in store.shapes)
+        print('write: ' + _throughput(nbytes, write_time))
+
+        store = PathStore(directory)
+        start = time.perf_counter()
+        for date_chunk in reversed(range(store.num_date_chunks)):
+            for name in store.shapes:
+                store.read(name, dates=slice(date_chunk*store.dates_per_chunk, (date_chunk+1)*store.dates_per_chunk))
+        print('read by date chunk: ' + _throughput(nbytes, time.perf_counter() - start))
+
+        store = PathStore(directory)
+        start = time.perf_counter()
+        for path_block in range(store.num_path_blocks):
+            for name in store.shapes:
+                store.read(name, paths=slice(path_block*store.paths_per_block, (path_block+1)*store.paths_per_block))
+        print('read by path block: ' + _throughput(nbytes, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Global-memory traffic and time per step of DiffusionEngine with and without per-path diffusion parameters.
+
+Without pathwise_diff_para (or with shocks of the initial values only), diffuse_and_price and
+compute_mtm read the diffusion parameters from constant memory (params_in_const=True) or from
+one array shared by all the paths, and the (num_params, num_paths) array of per-path
+parameters is neither allocated on the device nor copied there. The per-path variant is forced
+on the same parameters with relative shocks of 1e-30, which round to the base parameters in
+float32, so that both variants simulate the same paths. The report gives the bytes of the
+per-path array (the allocation and the host-to-device copy removed), the per-path parameter
+loads removed per fine step (each Euler step reads all the diffusion parameters of its path),
+and the time per fine step of a batch of both variants.
+Usage (from the repository root): python -m benchmarks.pathwise_params --backend cpu --num-paths 4096 --horizon 2
+"""
+
+import time
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--params-in-const', type=int, choices=(0, 1), default=1)
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    engine_args = make_engine_args_from(args)
+    timings = {}
+    mtm = {}
+    for pathwise_params in (True, False):
+        engine = DiffusionEngine(*engine_args, backend=args.backend, rng='philox', outputs=('mtm_by_cpty',),
+                                 params_in_const=bool(args.params_in_const))
+        if pathwise_params:
+            shocks = np.zeros((engine.num_params, engine.num_paths), np.float32)
+            shocks[engine.num_diffusions:] = 1e-30
+            engine._reinitialize(engine.X[0, :, 0].copy(), shocks)
+        assert engine.pathwise_params == pathwise_params
+        # the first batch includes the lazy initializations
+        engine.generate_batch(fused=True)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            engine.reset_rng_states(engine.seed)
+            engine.generate_batch(fused=True)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        num_fine_steps = engine.num_coarse_steps * engine.num_fine_per_coarse
+        timings[pathwise_params] = elapsed / num_fine_steps
+        mtm[pathwise_params] = engine.mtm_by_cpty.copy()
+
+    num_diff_params = engine.num_params - engine.num_diffusions
+    array_bytes = engine.num_params * engine.num_paths * 4
+    step_bytes = num_diff_params * engine.num_paths * 4
+    diff = np.abs(mtm[True] - mtm[False]).max()
+    print('per-path parameter array (allocation and H2D copy removed): {:.2f} MB'.format(array_bytes / 2**20))
+    print('per-path parameter loads removed per fine step: {} x {} paths x 4 B = {:.2f} MB'.format(num_diff_params, engine.num_paths, step_bytes / 2**20))
+    print('{:>12} {:>16} {:>14}'.format('variant', 'per step (ms)', 'loads (GB/s)'))
+    print('{:>12} {:>16.4f} {:>14.2f}'.format('pathwise', 1e3 * timings[True], step_bytes / timings[True] / 1e9))
+    print('{:>12} {:>16.4f} {:>14}'.format('base', 1e3 * timings[False], '-'))
+    print('speed-up: {:.2f}, max MtM difference: {:.1e}'.format(timings[True] / timings[False], diff))
+
+
+if __name__ == '__main__':
+    main()
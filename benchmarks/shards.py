@@ -0,0 +1,84 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Scaling of the multi-process path sharding (simulation/shards_pl.py) with the number of workers.
+
+A run of --num-paths paths is split into --num-shards shards, which are simulated by 1, 2, 4
+and 8 worker processes (--workers) and written to a PathStore. The run time excludes the
+start-up of the workers (process spawn and kernel compilation, reported separately, use
+--cache-dir to reload the compiled kernels). With the CPU backend the cores are split evenly
+between the workers. The stores of all the worker counts are checked to be identical. Finally,
+a run whose initial values are shocked on each path (relative shocks of standard deviation
+--shock, drawn from a ShockSpec, two groups of initial values in a Latin hypercube) is simulated
+in --num-shards shards by a single worker and checked to be identical to the same run in a
+single shard.
+Usage (from the repository root): python -m benchmarks.shards --backend cpu --num-paths 65536
+"""
+
+import tempfile
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+from simulation.shards_pl import ShardedRun
+from simulation.shocks_pl import ShockSpec
+
+
+def sharded_paths(engine_args, paths_per_shard, num_workers, engine_kwargs, **run_kwargs):
+    # the ShardedRun and X and the MtMs of its first and last paths, which are enough to tell the runs apart
+    with tempfile.TemporaryDirectory() as directory:
+        run = ShardedRun(engine_args, paths_per_shard, num_workers, engine_kwargs)
+        store = run.run(directory, **run_kwargs)
+        check = {name: np.concatenate([store.read(name, paths=slice(0, 64)), store.read(name, paths=slice(-64, None))], axis=-1)
+                 for name in ('X', 'mtm_by_cpty')}
+    return run, check
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--num-shards', type=int, default=8)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--shock', type=float, default=0.1)
+    args = parser.parse_args()
+
+    engine_args = make_engine_args_from(args)
+    engine_kwargs = dict(backend=args.backend, rng='philox', seed=args.seed, cache_dir=args.cache_dir)
+    reference = None
+    base_time = None
+    for num_workers in args.workers:
+        run, check = sharded_paths(engine_args, args.num_paths // args.num_shards, num_workers, engine_kwargs)
+        if reference is None:
+            reference = check
+            base_time = run.run_time
+        identical = all(np.array_equal(check[name], reference[name]) for name in check)
+        print('{} workers: start-up {:.1f} s, run {:.2f} s, {:.0f} paths/s, speed-up {:.2f}, identical to {} worker(s): {}'.format(
+            num_workers, run.startup_time, run.run_time, args.num_paths / run.run_time, base_time / run.run_time,
+            args.workers[0], identical))
+
+    # the shocks of each shard must be relative to the initial values of the run, not to those of the previous shard,
+    # and the batches and strata of the groups those of the run, not of the shard
+    num_diffusions = 2*args.num_rates + args.num_spreads - 1
+    groups = [list(range(num_diffusions // 2)), list(range(num_diffusions // 2, num_diffusions))]
+    spec = ShockSpec(groups, args.shock, 'lhs', seed=args.seed)
+    checks = [sharded_paths(engine_args, paths_per_shard, 1, engine_kwargs, pathwise_diff_para=spec, set_irs_at_par=False)[1]
+              for paths_per_shard in (args.num_paths, args.num_paths // args.num_shards)]
+    identical = all(np.array_equal(checks[0][name], checks[1][name]) for name in checks[0])
+    print('shocked initial values, {} shards on 1 worker identical to 1 shard: {}'.format(args.num_shards, identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Pathwise parameter shocks built on the host versus drawn by DiffusionEngine from a ShockSpec.
+
+The diffusion parameters are split into --num-groups groups, one batch of paths per group as in
+the bump notebooks, with relative shocks of standard deviation --scale. The host variant builds
+the (num_params, num_paths) array of shocks in numpy and passes it to _reinitialize, which copies
+it to the device; the in-engine variant passes a ShockSpec, the shocks being drawn in
+d_pathwise_diff_para. The report gives the time to set the shocks (after a first call including
+the compilation) and, for each sampling, the root mean square error over --repeat seeds of the
+mean and of the standard deviation of the normalized shocks of each parameter, which drive the
+error of the linear-bump regressions.
+Usage (from the repository root): python -m benchmarks.shock_generation --backend cpu --num-paths 16384 --horizon 2
+"""
+
+import time
+import numpy as np
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--num-groups', type=int, default=8)
+    parser.add_argument('--scale', type=float, default=0.02)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    from simulation.shocks_pl import ShockSpec
+    engine = DiffusionEngine(*make_engine_args_from(args), backend=args.backend, rng='philox', outputs=('mtm_by_cpty',))
+    num_diffusions, num_params, num_paths = engine.num_diffusions, engine.num_params, engine.num_paths
+    initial_values = engine.X[0, :, 0].copy()
+    # the diffusion parameters, but the drift adjustments (zero for a flat market)
+    rows = [row for row in range(num_diffusions, num_params) if engine.g_diff_params[row-num_diffusions] != 0]
+    groups = [list(group) for group in np.array_split(rows, args.num_groups)]
+    batch_size = num_paths // len(groups)
+
+    def host_shocks(seed):
+        rng = np.random.RandomState(seed)
+        shocks = np.zeros((num_params, num_paths), np.float32)
+        for i, group in enumerate(groups):
+            end = (i+1)*batch_size if i < len(groups) - 1 else num_paths
+            shocks[group, i*batch_size:end] = args.scale * rng.standard_normal((len(group), end - i*batch_size))
+        return shocks
+
+    def normalized_shocks(params):
+        base = np.concatenate((initial_values, engine.g_diff_params))
+        z = []
+        for i, group in enumerate(groups):
+            end = (i+1)*batch_size if i < len(groups) - 1 else num_paths
+            z.append((params[group, i*batch_size:end] / base[group, np.newaxis] - 1) / args.scale)
+        return z
+
+    def set_shocks(variant, seed):
+        shocks = host_shocks(seed) if variant == 'host' else ShockSpec(groups, args.scale, 'normal', seed=seed)
+        engine._reinitialize(initial_values, shocks)
+
+    timings = {}
+    for variant in ('host', 'spec'):
+        # the first call includes the compilation
+        set_shocks(variant, 0)
+        start = time.perf_counter()
+        for k in range(1, args.repeat+1):
+            set_shocks(variant, k)
+        timings[variant] = (time.perf_counter() - start) / args.repeat
+    print('shock array: {:.2f} MB, groups: {}, paths per group: {}'.format(num_params * num_paths * 4 / 2**20, len(groups), batch_size))
+    print('{:>10} {:>16}'.format('variant', 'set shocks (ms)'))
+    for variant in ('host', 'spec'):
+        print('{:>10} {:>16.2f}'.format(variant, 1e3 * timings[variant]))
+
+    print('{:>12} {:>16} {:>16}'.format('sampling', 'rmse mean', 'rmse std'))
+    for sampling in ('normal', 'stratified', 'lhs'):
+        mean_err, std_err = [], []
+        for k in range(args.repeat):
+            engine._reinitialize(initial_values, ShockSpec(groups, args.scale, sampling, seed=k))
+            for z in normalized_shocks(engine.pathwise_diff_para):
+                mean_err.append(z.mean(axis=1))
+                std_err.append(z.std(axis=1) - 1)
+        print('{:>12} {:>16.2e} {:>16.2e}'.format(sampling, np.sqrt(np.mean(np.concatenate(mean_err)**2)),
+                                                  np.sqrt(np.mean(np.concatenate(std_err)**2))))
+
+
+if __name__ == '__main__':
+    main()
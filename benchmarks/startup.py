@@ -0,0 +1,79 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Cold vs. warm DiffusionEngine construction time with the on-disk kernel cache.
+
+Each construction runs in a fresh process, so that only the on-disk cache can be reused.
+With --nested, the nested CVA and IM kernels and workspaces (otherwise prepared lazily by
+generate_batch) are also built, and the memory they take is reported.
+Usage (from the repository root): python -m benchmarks.startup --backend cpu [--nested]
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import make_parser, make_engine_args_from
+
+
+_NESTED_ARRAYS = ('nested_cva', 'nested_cva_sq', 'nested_im_by_cpty', 'nested_im_err_by_cpty',
+                  'd_nested_cva', 'd_nested_cva_sq', 'd_nested_im_by_cpty', 'd_nested_im_err_by_cpty',
+                  'd_nested_im_std_by_cpty', 'd_nested_im_m', 'd_nested_im_v')
+
+
+def _construct(args):
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    start = time.perf_counter()
+    engine = DiffusionEngine(*make_engine_args_from(args, num_inner_paths=args.num_inner_paths),
+                             backend=args.backend, cache_dir=args.cache_dir)
+    if args.nested:
+        engine._require_nested_cva()
+        engine._require_nested_im()
+    elapsed = time.perf_counter() - start
+    nbytes = sum(getattr(engine, name).nbytes for name in _NESTED_ARRAYS if hasattr(engine, name))
+    print(elapsed, nbytes)
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--cache-dir', default=None, help='defaults to a fresh temporary directory (an existing cache makes the first run warm too)')
+    parser.add_argument('--num-inner-paths', type=int, default=1024)
+    parser.add_argument('--nested', action='store_true', help='also build the nested CVA and IM kernels and workspaces')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _construct(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = args.cache_dir if args.cache_dir is not None else tmp_dir
+        cmd = [sys.executable, '-m', 'benchmarks.startup', '--child', '--cache-dir', cache_dir] + sys.argv[1:]
+        timings = []
+        for label in ('cold', 'warm'):
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            elapsed, nbytes = out.strip().splitlines()[-1].split()
+            timings.append(float(elapsed))
+            print('{} construction: {:.2f} s'.format(label, timings[-1]))
+        print('speed-up: {:.1f}x'.format(timings[0]/timings[1]))
+        print('nested CVA/IM workspaces: {:.1f} MB'.format(int(nbytes)/2**20))
+
+
+if __name__ == '__main__':
+    main()
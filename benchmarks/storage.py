@@ -0,0 +1,78 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Host memory, copy time and accuracy of the CVA labels with the reduced-precision storage of the paths.
+
+The same paths (rng='philox') are simulated with each storage_dtype, in the CVA learning configuration
+of benchmarks/outputs.py. The labels of the backward CVA learning (as built by
+CVAEstimatorPortfolioInt, computed here in double precision from the decoded arrays) are compared
+with those from the float32 arrays: the errors are relative to the root mean square of the float32
+labels, and that of the CVA is the relative error of the mean label at time 0.
+Usage (from the repository root): python -m benchmarks.storage --backend cpu
+"""
+
+import numpy as np
+
+from benchmarks.common import make_parser
+from benchmarks.outputs import measure, CVA_OUTPUTS
+from simulation.compact_pl import decode
+
+
+def _path_array(engine, name):
+    if name not in engine.compact_outputs:
+        return getattr(engine, name).astype(np.float64)
+    return decode(getattr(engine, name+'_codes'), engine.storage_dtype,
+                  getattr(engine, name+'_scale', None), getattr(engine, name+'_offset', None)).astype(np.float64)
+
+
+def cva_labels(engine):
+    # labels by date, default simulation and path, following the backward recursion of _build_labels_backward
+    end = engine.num_coarse_steps + engine.num_early_pricing
+    rate_integral = _path_array(engine, 'dom_rate_integral')
+    spread_integrals = _path_array(engine, 'spread_integrals')[:, 1:]
+    mtm = _path_array(engine, 'mtm_by_cpty')
+    cpty = np.arange(engine.num_spreads-1)
+    labels = np.empty((end, engine.num_defs_per_path, engine.num_paths))
+    labels_by_cpty = 0.
+    for t in range(end-1, -1, -1):
+        dr = rate_integral[t] - rate_integral[t+1]
+        df_r_d = np.exp(dr + spread_integrals[t] - spread_integrals[t+1])
+        labels_by_cpty = labels_by_cpty*df_r_d + np.maximum(mtm[t+1], 0)*(np.exp(dr) - df_r_d)
+        alive = ((engine.def_indicators_at(t)[cpty//8] >> (cpty % 8)[:, None, None]) & 1) == 0
+        labels[t] = (alive * labels_by_cpty[:, None, :]).sum(0)
+    return labels
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    engine, ref_bytes, ref_time = measure(args, CVA_OUTPUTS)
+    ref = cva_labels(engine)
+    ref_rms = np.sqrt(np.mean(ref**2))
+    print('float32: host arrays {:.1f} MB, copies {:.2f} ms per batch, CVA {:.4g}'.format(ref_bytes/2**20, 1e3*ref_time, ref[0].mean()))
+    for storage_dtype in ('float16', 'bfloat16', 'int16'):
+        engine, nbytes, elapsed = measure(args, CVA_OUTPUTS, storage_dtype)
+        err = cva_labels(engine) - ref
+        print('{}: host arrays {:.1f} MB ({:.0%}), copies {:.2f} ms per batch ({:.0%}), label error rms {:.2e} max {:.2e}, CVA error {:.2e}'.format(
+            storage_dtype, nbytes/2**20, nbytes/ref_bytes, 1e3*elapsed, elapsed/ref_time,
+            np.sqrt(np.mean(err**2))/ref_rms, np.abs(err).max()/ref_rms, abs(err[0].mean())/abs(ref[0].mean())))
+
+
+if __name__ == '__main__':
+    main()
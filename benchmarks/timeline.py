@@ -0,0 +1,58 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Timeline of the kernels and copies of DiffusionEngine.generate_batch (simulation/timeline_pl.py).
+
+A batch is simulated with a Timeline, whose summary by kernel and copy is printed and which is
+saved to --trace in the Chrome trace format (open it in chrome://tracing or ui.perfetto.dev).
+The batch time with and without the timeline gives the overhead of the instrumentation.
+Usage (from the repository root): python -m benchmarks.timeline --num-paths 65536 --trace trace.json
+"""
+
+import time
+
+from benchmarks.common import make_parser, make_engine_args_from
+from simulation.timeline_pl import Timeline
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--trace', default='trace.json')
+    args = parser.parse_args()
+
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    engine = DiffusionEngine(*make_engine_args_from(args), backend=args.backend, rng='philox')
+    # the first batch includes the lazy initializations
+    engine.generate_batch(fused=True)
+    batch_time = {}
+    for timeline in (None, Timeline()):
+        engine.timeline = timeline
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            engine.reset_rng_states(engine.seed)
+            engine.generate_batch(fused=True)
+        batch_time[timeline is not None] = (time.perf_counter() - start) / args.repeat
+    print(timeline.summary())
+    timeline.save_chrome_trace(args.trace)
+    print('{} spans saved to {}'.format(len(timeline.spans), args.trace))
+    print('without timeline: {:.2f} ms per batch, with timeline: {:.2f} ms per batch'.format(
+        1e3*batch_time[False], 1e3*batch_time[True]))
+
+
+if __name__ == '__main__':
+    main()
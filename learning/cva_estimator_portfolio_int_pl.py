@@ -17,6 +17,7 @@
 # along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
 
 from learning.generic_estimator import GenericEstimator
+from learning.misc import learning_span, synchronize
 from learning.xva_estimator import XVAEstimatorPortfolio
 import math
 import numba as nb
@@ -57,7 +58,30 @@ def compile_cuda_build_labels_backward(num_spreads, num_paths, ntpb, stream):
     
     return build_labels_backward
 
-def compile_cuda_aggregate_survival(num_spreads, num_defs_per_path, num_paths, ntpb, stream):
+def compile_cuda_aggregate_survival(num_spreads, num_defs_per_path, num_paths, ntpb, stream, default_times=False):
+    if default_times:
+        # def_arr holds the default steps of the counterparties (see DiffusionEngine.default_steps), the default
+        # indicators at the coarse step t being derived from them on the fly
+        sig = (nb.float32[:, :], nb.int16[:, :, :], nb.int32, nb.float32[:, :])
+
+        @cuda.jit(func_or_sig=sig, max_registers=32)
+        def _aggregate_survival_default_steps(labels, def_arr, t, out):
+            block = cuda.blockIdx.x
+            block_size = cuda.blockDim.x
+            tidx = cuda.threadIdx.x
+            pos = tidx + block * block_size
+
+            if pos < num_paths:
+                for i in range(num_defs_per_path):
+                    out[i, pos] = 0
+                for cpty in range(num_spreads-1):
+                    for i in range(num_defs_per_path):
+                        di = def_arr[cpty, i, pos]
+                        if di > t:
+                            out[i, pos] += labels[cpty, pos]
+
+        return _aggregate_survival_default_steps[(num_paths+ntpb-1)//ntpb, ntpb, stream]
+
     sig = (nb.float32[:, :], nb.int8[:, :, :], nb.float32[:, :])
 
     @cuda.jit(func_or_sig=sig, max_registers=32)
@@ -84,7 +108,30 @@ def compile_cuda_aggregate_survival(num_spreads, num_defs_per_path, num_paths, n
     return aggregate_survival
 
 
-def compile_cuda_aggregate_default(num_spreads, num_defs_per_path, num_paths, ntpb, stream):
+def compile_cuda_aggregate_default(num_spreads, num_defs_per_path, num_paths, ntpb, stream, default_times=False):
+    if default_times:
+        # def_arr holds the default steps of the counterparties (see DiffusionEngine.default_steps), the default
+        # indicators at the coarse step t being derived from them on the fly
+        sig = (nb.float32[:, :], nb.int16[:, :, :], nb.int32, nb.float32[:, :])
+
+        @cuda.jit(func_or_sig=sig, max_registers=32)
+        def _aggregate_default_default_steps(labels, def_arr, t, out):
+            block = cuda.blockIdx.x
+            block_size = cuda.blockDim.x
+            tidx = cuda.threadIdx.x
+            pos = tidx + block * block_size
+
+            if pos < num_paths:
+                for i in range(num_defs_per_path):
+                    out[i, pos] = 0
+                for cpty in range(num_spreads-1):
+                    for i in range(num_defs_per_path):
+                        di = def_arr[cpty, i, pos]
+                        if di <= t:
+                            out[i, pos] += labels[cpty, pos]
+
+        return _aggregate_default_default_steps[(num_paths+ntpb-1)//ntpb, ntpb, stream]
+
     sig = (nb.float32[:, :], nb.int8[:, :, :], nb.float32[:, :])
 
     @cuda.jit(func_or_sig=sig, max_registers=32)
@@ -145,8 +192,8 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
     def _compile_kernels(self):
         # NOTE: not caring about async kernel launches for now
         self.__cuda_build_labels_backward = _cuda_build_labels_backward_cache.get((self.diffusion_engine.num_paths, 512, 0))
-        self.__cuda_aggregate_survival = _cuda_aggregate_survival_cache.get((self.diffusion_engine.num_paths, 512, 0))
-        self.__cuda_aggregate_default = _cuda_aggregate_default_cache.get((self.diffusion_engine.num_paths, 512, 0))
+        self.__cuda_aggregate_survival = _cuda_aggregate_survival_cache.get((self.diffusion_engine.num_paths, 512, 0, self.diffusion_engine.default_times))
+        self.__cuda_aggregate_default = _cuda_aggregate_default_cache.get((self.diffusion_engine.num_paths, 512, 0, self.diffusion_engine.default_times))
         if self.backward:
             if self.__cuda_build_labels_backward is None:
                 self.__cuda_build_labels_backward = compile_cuda_build_labels_backward(self.diffusion_engine.num_spreads, self.diffusion_engine.num_paths, 512, 0)
@@ -154,10 +201,10 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
         else:
             raise NotImplementedError
         if self.__cuda_aggregate_survival is None:
-            self.__cuda_aggregate_survival = compile_cuda_aggregate_survival(self.diffusion_engine.num_spreads, self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0)
-            self.__cuda_aggregate_default = compile_cuda_aggregate_default(self.diffusion_engine.num_spreads, self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0)
-            _cuda_aggregate_default_cache[(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0)] = self.__cuda_aggregate_default
-            _cuda_aggregate_survival_cache[(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0)] = self.__cuda_aggregate_survival
+            self.__cuda_aggregate_survival = compile_cuda_aggregate_survival(self.diffusion_engine.num_spreads, self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0, default_times=self.diffusion_engine.default_times)
+            self.__cuda_aggregate_default = compile_cuda_aggregate_default(self.diffusion_engine.num_spreads, self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0, default_times=self.diffusion_engine.default_times)
+            _cuda_aggregate_default_cache[(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0, self.diffusion_engine.default_times)] = self.__cuda_aggregate_default
+            _cuda_aggregate_survival_cache[(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths, 512, 0, self.diffusion_engine.default_times)] = self.__cuda_aggregate_survival
         self.__unpack = _unpack_cache.get(self.diffusion_engine.num_spreads)
         if self.__unpack is None:
             self.__unpack = compile_unpack(self.diffusion_engine.num_spreads)
@@ -170,6 +217,10 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
         labels_gen = self._build_labels(labels_as_cuda_tensors)
         num_defs_per_batch = (self.batch_size+self.diffusion_engine.num_paths-1)//self.diffusion_engine.num_paths
         batch_size = min(self.batch_size, self.diffusion_engine.num_paths)
+        if self.diffusion_engine.antithetic:
+            # the paths of an antithetic pair are adjacent in the engine arrays, the (views on the) slices below
+            # keep both of them in the same mini-batch as long as it has an even size
+            assert batch_size % 2 == 0, 'the batch size must be even with antithetic paths'
         if self.backward:
             timesteps = range(self.diffusion_engine.num_coarse_steps+ self.diffusion_engine.num_early_pricing, -1, -1)
         else:
@@ -194,6 +245,7 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
         num_cpty = self.diffusion_engine.num_spreads-1
         features_gpu = torch.empty(self.batch_size, self.num_features + self.num_params * self.include_para_as_fea, dtype=torch.float32, device=self.device)
         def_indicators_gpu = torch.empty(self.batch_size, (num_cpty+7)//8, dtype=torch.uint8, device=self.device)
+        default_steps_gpu = torch.empty(self.batch_size, num_cpty, dtype=torch.int16, device=self.device)
         _cpty_idx = np.arange(num_cpty, dtype=np.int32)
         _cpty_mask = torch.tensor(1 << (_cpty_idx[None, :] % 8), device=self.device)
         num_defs_per_batch = (self.batch_size+self.diffusion_engine.num_paths-1)//self.diffusion_engine.num_paths
@@ -209,13 +261,25 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
                 # TODO: clean this up
                 shift = (t-1) % self.diffusion_engine.max_coarse_per_reset + 1
                 X_prev = torch.as_tensor(self.diffusion_engine.d_X[self.diffusion_engine.max_coarse_per_reset-shift], device=self.device)
-                def_indicators = torch.as_tensor(self.diffusion_engine.d_def_indicators[1])
+                if self.diffusion_engine.default_times:
+                    # the default steps recorded so far, those after t not being needed
+                    default_steps = torch.as_tensor(self.diffusion_engine.d_default_steps, device=self.device)
+                else:
+                    def_indicators = torch.as_tensor(self.diffusion_engine.d_def_indicators[1])
             else:
-                X = torch.as_tensor(self.diffusion_engine.X[t])
-                X_prev = torch.as_tensor(self.diffusion_engine.X[t_prev_reset])
-                def_indicators = torch.as_tensor(self.diffusion_engine.def_indicators[t])
+                X = self._path_tensor('X', t)
+                X_prev = self._path_tensor('X', t_prev_reset)
+                if self.diffusion_engine.default_times:
+                    default_steps = torch.as_tensor(self.diffusion_engine.default_steps)
+                else:
+                    def_indicators = torch.as_tensor(self.diffusion_engine.def_indicators[t])
             def __gen_features(mean=None, std=None):
                 nonlocal features_gpu
+                # each mini-batch of features is a span of the timeline, from the resumption of the generator
+                timeline = self.diffusion_engine.timeline
+                if timeline is not None:
+                    synchronize(self.device)
+                    begin = time.perf_counter()
                 for i in range((self.diffusion_engine.num_paths+batch_size-1)//batch_size):
                     #print(X[:2*self.diffusion_engine.num_rates-1, i*batch_size:(i+1)*batch_size].T.shape)
                     #print(features_gpu[:batch_size, :2*self.diffusion_engine.num_rates-1].shape)
@@ -239,15 +303,48 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
                     for j in range(1, num_defs_per_batch):
                         features_gpu[j*batch_size:(j+1)*batch_size].copy_(features_gpu[:batch_size])
                     for j in range((self.diffusion_engine.num_defs_per_path+num_defs_per_batch-1)//num_defs_per_batch):
-                        def_indicators_gpu.copy_(def_indicators[:, j*num_defs_per_batch: (j+1)*num_defs_per_batch, i*batch_size:(i+1)*batch_size].view(def_indicators.shape[0], -1).T)
-                        features_gpu[:, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features].copy_((def_indicators_gpu[:, _cpty_idx//8] & _cpty_mask) != 0)
+                        if self.diffusion_engine.default_times:
+                            # the counterparty is in default at t if it defaulted at or before t
+                            default_steps_gpu.copy_(default_steps[:, j*num_defs_per_batch: (j+1)*num_defs_per_batch, i*batch_size:(i+1)*batch_size].reshape(num_cpty, -1).T)
+                            features_gpu[:, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features].copy_(default_steps_gpu <= t)
+                        else:
+                            def_indicators_gpu.copy_(def_indicators[:, j*num_defs_per_batch: (j+1)*num_defs_per_batch, i*batch_size:(i+1)*batch_size].view(def_indicators.shape[0], -1).T)
+                            features_gpu[:, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features].copy_((def_indicators_gpu[:, _cpty_idx//8] & _cpty_mask) != 0)
                         if mean is not None:
                             features_gpu[:, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features] -= mean[None, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features]
                         if std is not None:
                             features_gpu[:, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features] /= (std[None, 3*self.diffusion_engine.num_rates+self.diffusion_engine.num_spreads-2:self.num_features] + 1e-7)
+                        if timeline is not None:
+                            synchronize(self.device)
+                            timeline.add('features', 'learning', begin, time.perf_counter(), t=t)
                         yield features_gpu
+                        if timeline is not None:
+                            synchronize(self.device)
+                            begin = time.perf_counter()
             yield __gen_features
 
+    def _path_tensor(self, name, t):
+        # date t of a path array of the diffusion engine as a float32 tensor, the arrays stored in reduced precision
+        # (see simulation/compact_pl.py) being loaded as 16-bit codes and decoded on the device
+        engine = self.diffusion_engine
+        if name not in engine.compact_outputs:
+            return torch.as_tensor(getattr(engine, name)[t])
+        codes = torch.as_tensor(getattr(engine, name+'_codes')[t]).to(self.device)
+        if engine.storage_dtype == 'float16':
+            return codes.view(torch.float16).float()
+        if engine.storage_dtype == 'bfloat16':
+            return codes.view(torch.bfloat16).float()
+        scale = torch.as_tensor(getattr(engine, name+'_scale')[t]).to(self.device)
+        offset = torch.as_tensor(getattr(engine, name+'_offset')[t]).to(self.device)
+        return torch.addcmul(offset[..., None], codes.float(), scale[..., None])
+
+    def _load_path_array(self, t_out, d_out, name, t, first_row=0):
+        # loads date t of a path array, from the row first_row, into the tensor t_out viewed by the device array d_out
+        if name in self.diffusion_engine.compact_outputs:
+            t_out.copy_(self._path_tensor(name, t)[first_row:])
+        else:
+            d_out.copy_to_device(getattr(self.diffusion_engine, name)[t][first_row:])
+
     def _build_labels(self, as_cuda_tensor=False, print_LGD = False):
         if self.backward:
             return self._build_labels_backward(as_cuda_tensor, print_LGD)
@@ -261,7 +358,11 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
         t_rate_integral_now = torch.empty(self.diffusion_engine.d_dom_rate_integral.shape[1:], dtype=torch.float32, device=self.device)
         t_rate_integral_next = torch.empty(self.diffusion_engine.d_dom_rate_integral.shape[1:], dtype=torch.float32, device=self.device)
 
-        t_def = torch.empty(self.diffusion_engine.d_def_indicators.shape[1:], dtype=torch.int8, device=self.device)
+        if self.diffusion_engine.default_times:
+            # the default steps are loaded once, the indicators of each date being derived from them by the aggregation
+            t_def = torch.as_tensor(self.diffusion_engine.default_steps).to(self.device)
+        else:
+            t_def = torch.empty(self.diffusion_engine.d_def_indicators.shape[1:], dtype=torch.int8, device=self.device)
         t_labels_by_cpty = torch.empty(self.diffusion_engine.d_mtm_by_cpty.shape[1:], dtype=torch.float32, device=self.device)
         
         t_out = torch.empty((self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths), dtype=torch.float32, device=self.device)
@@ -284,23 +385,29 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
             yield out.view(-1, 1)
         else:
             yield out.reshape(-1, 1)
-        d_spread_integral_next.copy_to_device(self.diffusion_engine.spread_integrals[self.diffusion_engine.num_coarse_steps+self.diffusion_engine.num_early_pricing, 1:])
-        d_rate_integral_next.copy_to_device(self.diffusion_engine.dom_rate_integral[self.diffusion_engine.num_coarse_steps+self.diffusion_engine.num_early_pricing])
+        self._load_path_array(t_spread_integral_next, d_spread_integral_next, 'spread_integrals', self.diffusion_engine.num_coarse_steps+self.diffusion_engine.num_early_pricing, 1)
+        self._load_path_array(t_rate_integral_next, d_rate_integral_next, 'dom_rate_integral', self.diffusion_engine.num_coarse_steps+self.diffusion_engine.num_early_pricing)
         accumulate = False
         for t in range(self.diffusion_engine.num_coarse_steps-1+self.diffusion_engine.num_early_pricing, -1, -1):
-            d_spread_integral_now.copy_to_device(self.diffusion_engine.spread_integrals[t, 1:])
-            d_rate_integral_now.copy_to_device(self.diffusion_engine.dom_rate_integral[t])
-            d_mtm_next.copy_to_device(self.diffusion_engine.mtm_by_cpty[t+1])
-            d_def.copy_to_device(self.diffusion_engine.def_indicators[t])
-            self.__cuda_build_labels_backward(d_spread_integral_now, d_spread_integral_next, d_rate_integral_now, d_rate_integral_next, d_mtm_next, d_labels_by_cpty, t > 0, accumulate)
-            if not print_LGD:
-                self.__cuda_aggregate_survival(d_labels_by_cpty, d_def, d_out)
-            else:
-                self.__cuda_aggregate_default(d_labels_by_cpty, d_def, d_out)
+            with learning_span(self.diffusion_engine.timeline, self.device, 'labels', t=t):
+                self._load_path_array(t_spread_integral_now, d_spread_integral_now, 'spread_integrals', t, 1)
+                self._load_path_array(t_rate_integral_now, d_rate_integral_now, 'dom_rate_integral', t)
+                self._load_path_array(t_mtm_next, d_mtm_next, 'mtm_by_cpty', t+1)
+                if self.diffusion_engine.default_times:
+                    def_args = (d_def, t)
+                else:
+                    d_def.copy_to_device(self.diffusion_engine.def_indicators[t])
+                    def_args = (d_def,)
+                self.__cuda_build_labels_backward(d_spread_integral_now, d_spread_integral_next, d_rate_integral_now, d_rate_integral_next, d_mtm_next, d_labels_by_cpty, t > 0, accumulate)
+                if not print_LGD:
+                    self.__cuda_aggregate_survival(d_labels_by_cpty, *def_args, d_out)
+                else:
+                    self.__cuda_aggregate_default(d_labels_by_cpty, *def_args, d_out)
+                if not as_cuda_tensor:
+                    d_out.copy_to_host(out)
             if as_cuda_tensor:
                 yield out.view(-1, 1)
             else:
-                d_out.copy_to_host(out)
                 yield out.reshape(-1, 1)
             if not accumulate:
                 accumulate = True
@@ -312,5 +419,5 @@ class CVAEstimatorPortfolioInt(XVAEstimatorPortfolio):
             if t > self.diffusion_engine.num_coarse_steps+ self.diffusion_engine.num_early_pricing-window:
                 yield next(labels_gen_start).view(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths)
             else:
-                df = (torch.as_tensor(self.diffusion_engine.dom_rate_integral[t], dtype=torch.float32, device=self.device)-torch.as_tensor(self.diffusion_engine.dom_rate_integral[t+window], dtype=torch.float32, device=self.device)).exp_()
+                df = (self._path_tensor('dom_rate_integral', t).to(self.device)-self._path_tensor('dom_rate_integral', t+window).to(self.device)).exp_()
                 yield next(labels_gen_start).view(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths)-next(labels_gen_end).view(self.diffusion_engine.num_defs_per_path, self.diffusion_engine.num_paths)*df[None, :]
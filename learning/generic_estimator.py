@@ -20,7 +20,7 @@ from copy import deepcopy
 import cupy as cp
 from functools import partial
 from itertools import chain
-from learning.misc import batch_mean, batch_std
+from learning.misc import batch_mean, batch_std, learning_span
 import math
 import numpy as np
 import torch
@@ -343,6 +343,7 @@ class GenericEstimator:
         self.multiple_var = multiple_var
         self.piecewise_affine_var = interpolation_nodes is not None
         self.monotonicity_penalty = monotonicity_penalty
+        self.timeline = None    # None, or a Timeline (see simulation/timeline_pl.py) recording the refinement of the last layer
         # TODO: move the following line to self.train and add a flag to specify whether we want that or not
         self.loss_hist = np.empty(num_epochs, dtype=np.float32)
         # INFO: no need to have num_samples and holdout_size in constructor
@@ -430,20 +431,21 @@ class GenericEstimator:
                             j = 0
                             self.model.o.W.zero_()
                             self.model.o.b.zero_()
-                            for features_batch, labels_batch in zip(features_gen(self.t_features_mean, self.t_features_std), labels_gen(None, self.t_labels_std)):
-                                # features_batch -= self.t_features_mean[None]
-                                # features_batch /= (self.t_features_std[None] + 1e-16)
-                                # labels_batch /= (self.t_labels_std[None] + 1e-16)
-                                h = features_batch
-                                for l in self.model.h:
-                                    h = l(h)
-                                h_aug[:, 1:] = h
-                                with cp.cuda.Device(self.device.index):
-                                    sol, _, _, _ = cp.linalg.lstsq(cp.asarray(h_aug), cp.asarray(labels_batch), rcond=None)
-                                    sol = torch.as_tensor(sol, device=self.device)
-                                self.model.o.W.add_(sol[1:h_aug.shape[1]])
-                                self.model.o.b.add_(sol[:1])
-                                j += 1
+                            with learning_span(self.timeline, self.device, 'lstsq_refine'):
+                                for features_batch, labels_batch in zip(features_gen(self.t_features_mean, self.t_features_std), labels_gen(None, self.t_labels_std)):
+                                    # features_batch -= self.t_features_mean[None]
+                                    # features_batch /= (self.t_features_std[None] + 1e-16)
+                                    # labels_batch /= (self.t_labels_std[None] + 1e-16)
+                                    h = features_batch
+                                    for l in self.model.h:
+                                        h = l(h)
+                                    h_aug[:, 1:] = h
+                                    with cp.cuda.Device(self.device.index):
+                                        sol, _, _, _ = cp.linalg.lstsq(cp.asarray(h_aug), cp.asarray(labels_batch), rcond=None)
+                                        sol = torch.as_tensor(sol, device=self.device)
+                                    self.model.o.W.add_(sol[1:h_aug.shape[1]])
+                                    self.model.o.b.add_(sol[:1])
+                                    j += 1
                             self.model.o.W /= j
                             self.model.o.b /= j
                         if self.regr_type == 'positive_mean':
@@ -1,4 +1,6 @@
+from functools import partial
 import numpy as np
+from simulation.timeline_pl import span
 import torch
 
 
@@ -19,6 +21,16 @@ def batch_std(batch_gen):
     std.sqrt_()
     return std
 
+def synchronize(device):
+    # waits for the work queued by PyTorch on device
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def learning_span(timeline, device, name, **args):
+    # span of timeline (see simulation/timeline_pl.py) around the learning work of the body of a with statement on
+    # device, a no-op without timeline
+    return span(timeline, name, 'learning', sync=partial(synchronize, device), **args)
+
 def predict(estimator, num_coarse_steps, num_defs_per_path, num_paths, stop_at=0):
     features_gen = estimator._features_generator()
     predictor = estimator.predict(features_gen=features_gen, as_cuda_array=True, flatten=False)
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
 
-from learning.misc import batch_mean, batch_std
+from learning.misc import batch_mean, batch_std, learning_span
 from numba import cuda
 import numpy as np
 from simulation.diffusion_engine_pl import DiffusionEngine
@@ -54,6 +54,7 @@ class XVAEstimatorPortfolio(XVAEstimator):
             ignore = tuple()
         if reset_estimator:
             self._estimator.reset()
+        self._estimator.timeline = self.diffusion_engine.timeline
         for t, features_gen, labels_gen in batch_gen:
             if t in ignore:
                 continue
@@ -71,12 +72,14 @@ class XVAEstimatorPortfolio(XVAEstimator):
                     if exec_times is not None:
                         exec_times['num_trainings'] += 1
                         exec_times['train'] -= time.time()
-                    self._estimator.train(features_gen, labels_gen)
+                    with learning_span(self.diffusion_engine.timeline, self.device, 'train', t=t):
+                        self._estimator.train(features_gen, labels_gen)
                     if exec_times is not None:
                         exec_times['train'] += time.time()
                     if exec_times is not None:
                         exec_times['save_state'] -= time.time()
-                    self.saved_states[t] = (True, self._estimator.get_state())
+                    with learning_span(self.diffusion_engine.timeline, self.device, 'save_state', t=t):
+                        self.saved_states[t] = (True, self._estimator.get_state())
                     if exec_times is not None:
                         exec_times['save_state'] += time.time()
                     if self.reset_weights:
@@ -0,0 +1,108 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Reduced-precision host storage of the path arrays, used with storage_dtype != 'float32'.
+#
+# The arrays of COMPACT_ARRAYS are encoded on the device, slice by slice, into 16-bit codes which are then
+# copied to the host instead of the float32 values, halving the device-to-host traffic and the host memory:
+#     'float16': IEEE half precision (11 significant bits, largest finite value 65504, above which values
+#                saturate to infinity),
+#     'bfloat16': upper half of the float32 (8 significant bits, same range as float32),
+#     'int16': affine quantisation per date and factor, value = code*scale + offset, the scale and offset
+#              mapping the range of the factor over the paths of the batch onto [-32767, 32767].
+# The codes are always stored as int16 (the bit patterns of the half floats for 'float16' and 'bfloat16'), so
+# that they can be reinterpreted with a view by numpy (see decode below) and torch alike.
+# The half floats are encoded from the bit patterns of the float32 values, rounding to nearest, ties to even.
+
+import math
+import numpy as np
+from numba import jit
+
+STORAGE_DTYPES = ('float32', 'float16', 'bfloat16', 'int16')
+COMPACT_ARRAYS = ('X', 'mtm_by_cpty', 'spread_integrals', 'dom_rate_integral')
+
+INT16_MAX_CODE = 32767
+
+
+@jit(forceinline=True)
+def _signed16(bits):
+    if bits >= 32768:
+        return bits - 65536
+    return bits
+
+
+@jit(forceinline=True)
+def _shift_right_even(m, shift):
+    # m / 2^shift rounded to nearest, ties to even
+    h = m >> shift
+    rem = m & ((1 << shift) - 1)
+    half = 1 << (shift - 1)
+    if rem > half or (rem == half and h & 1):
+        h += 1
+    return h
+
+
+@jit(forceinline=True)
+def encode_float16(bits):
+    # bits: bit pattern of the float32 value, as an integer
+    bits = int(bits) & 0xffffffff
+    sign = (bits >> 16) & 0x8000
+    a = bits & 0x7fffffff
+    if a > 0x7f800000:
+        return _signed16(sign | 0x7e00)
+    if a >= 0x477ff000:
+        # 65520 and above round to infinity
+        return _signed16(sign | 0x7c00)
+    if a < 0x38800000:
+        # below 2^-14: subnormal half, in units of 2^-24
+        if a < 0x33000000:
+            return _signed16(sign)
+        return _signed16(sign | _shift_right_even((a & 0x7fffff) | 0x800000, 126 - (a >> 23)))
+    # the carry of the rounding goes into the exponent
+    return _signed16(sign | _shift_right_even(a - 0x38000000, 13))
+
+
+@jit(forceinline=True)
+def encode_bfloat16(bits):
+    # bits: bit pattern of the float32 value, as an integer
+    bits = int(bits) & 0xffffffff
+    if bits & 0x7fffffff > 0x7f800000:
+        return _signed16((bits >> 16) | 0x40)
+    return _signed16(_shift_right_even(bits, 16))
+
+
+@jit(forceinline=True)
+def encode_int16(v, inv_scale, offset):
+    # inv_scale: inverse of the scale (0 for a constant factor)
+    c = math.floor((v - offset)*inv_scale + 0.5)
+    return int(min(max(c, -INT16_MAX_CODE), INT16_MAX_CODE))
+
+
+@jit(forceinline=True)
+def int16_scale_offset(lo, hi):
+    # scale and offset mapping [lo, hi] onto [-INT16_MAX_CODE, INT16_MAX_CODE]
+    return (hi - lo) / (2*INT16_MAX_CODE), (hi + lo) / 2
+
+
+def decode(codes, storage_dtype, scale=None, offset=None):
+    # float32 values of codes, of shape (..., num_paths), scale and offset being those of its dates and factors
+    # (shape codes.shape[:-1]) for 'int16'
+    if storage_dtype == 'float16':
+        return codes.view(np.float16).astype(np.float32)
+    if storage_dtype == 'bfloat16':
+        return (codes.view(np.uint16).astype(np.uint32) << np.uint32(16)).view(np.float32)
+    return codes.astype(np.float32) * scale[..., np.newaxis] + offset[..., np.newaxis]
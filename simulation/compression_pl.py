@@ -0,0 +1,86 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Portfolio compression, used with compress_portfolio=True: the products whose prices only differ by linear
+# coefficients are netted into equivalent trades before being copied to the device, so that the kernels price
+# fewer products.
+#
+# The price of a swap is floating_leg - swap_rate*fixed_annuity, for a unit notional, where both legs only depend
+# on the currency and the schedule (first_reset, reset_freq, num_resets). The swaps sharing the counterparty, the
+# currency and the schedule thus add up to one swap of notional N = sum(notional) and swap rate
+# K = sum(notional*swap_rate)/N, for the MtMs and the cash flows alike. If the notionals cancel out (N = 0) but not
+# the fixed legs, the group is replaced by a pair of swaps (notional S, swap rate 1) and (notional -S, swap rate 0),
+# S = sum(notional*swap_rate), whose floating legs cancel out; if both cancel out, the group is dropped. Swaps set
+# at par (set_irs_at_par) share the par rate of their schedule, so that the compressed book is at par too.
+# The vanilla options sharing the counterparty, the currency, the maturity, the strike and the type add up to one
+# option with the sum of their notionals, and are dropped if it is 0.
+# The sums are taken in float64, so that the compressed book only differs from the original one by the float32
+# rounding of the netted notionals and swap rates.
+
+import numpy as np
+
+IRS_KEY = ('cpty', 'undl', 'first_reset', 'reset_freq', 'num_resets')
+VANILLA_KEY = ('cpty', 'undl', 'maturity', 'strike', 'call_put')
+
+
+def _group(specs, key):
+    # index of the group of each row (in order of first appearance) and number of groups
+    if specs.size == 0:
+        return np.empty(0, np.int64), 0
+    _, first, inverse = np.unique(specs[list(key)], return_index=True, return_inverse=True)
+    # np.unique sorts the groups, they are renumbered by first appearance
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+    return rank[inverse.reshape(-1)], order.size
+
+
+def compress_irs(irs_specs):
+    # returns the compressed swaps, and the row of the compressed swaps netting each original swap (two rows
+    # groups[i] and groups[i]+1 for the groups replaced by a pair of swaps, -1 for the dropped groups)
+    groups, num_groups = _group(irs_specs, IRS_KEY)
+    notional = np.bincount(groups, irs_specs['notional'].astype(np.float64), num_groups)
+    fixed = np.bincount(groups, irs_specs['notional'].astype(np.float64) * irs_specs['swap_rate'].astype(np.float64), num_groups)
+    first = np.unique(groups, return_index=True)[1]
+    rows = []
+    row_of_group = np.full(num_groups, -1, np.int64)
+    for g in range(num_groups):
+        if notional[g] != 0:
+            row_of_group[g] = len(rows)
+            rows.append((first[g], notional[g], fixed[g] / notional[g]))
+        elif fixed[g] != 0:
+            row_of_group[g] = len(rows)
+            rows.append((first[g], fixed[g], 1.))
+            rows.append((first[g], -fixed[g], 0.))
+    compressed = irs_specs[[row[0] for row in rows]].copy()
+    compressed['notional'] = [row[1] for row in rows]
+    compressed['swap_rate'] = [row[2] for row in rows]
+    return compressed, row_of_group[groups]
+
+
+def compress_vanillas(vanilla_specs):
+    # returns the compressed vanilla options, and the row of the compressed option netting each original one (-1
+    # for the dropped groups)
+    groups, num_groups = _group(vanilla_specs, VANILLA_KEY)
+    notional = np.bincount(groups, vanilla_specs['notional'].astype(np.float64), num_groups)
+    first = np.unique(groups, return_index=True)[1]
+    kept = np.flatnonzero(notional != 0)
+    compressed = vanilla_specs[first[kept]].copy()
+    compressed['notional'] = notional[kept]
+    row_of_group = np.full(num_groups, -1, np.int64)
+    row_of_group[kept] = np.arange(kept.size)
+    return compressed, row_of_group[groups]
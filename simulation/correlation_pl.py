@@ -0,0 +1,132 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Structure of the correlation matrix R of the Brownian motions, used with DiffusionEngine(correlation=...) to
+# correlate the independent normals of each step in less than the d(d+1)/2 multiply-adds of the dense Cholesky
+# factor (d = num_diffusions):
+#  - 'full': R = L L^T with L lower-triangular, g_L_T holding the upper-triangular entries of L^T by rows;
+#  - 'identity': R = I, each normal drives its own factor;
+#  - 'block': R is block-diagonal up to a permutation of the factors (e.g. one block per economy, a rate with its
+#    FX rate, and independent credit names). The Cholesky factor has no fill-in between the blocks, so that only
+#    the entries of L^T within the blocks are applied, in sum(b(b+1)/2) multiply-adds for blocks of size b;
+#  - a (d, k) array of loadings B: k-factor model R = B B^T + diag(1 - |B_i|^2), the k common normals and the d
+#    idiosyncratic ones being combined in d(k+1) multiply-adds, with k more normals per step. g_L_T then holds the
+#    idiosyncratic volatilities sqrt(1 - |B_i|^2), followed by the loadings by rows.
+# 'identity' and 'block' keep the layout of g_L_T and only skip its zeros, so that the paths are exactly those of
+# 'full'; a factor model draws its common normals after the idiosyncratic ones, and is not supported with
+# rng='sobol' (whose Brownian bridge has one dimension per factor).
+
+import numpy as np
+from numba import jit
+
+CORRELATIONS = ('full', 'identity', 'block')
+
+
+def num_common_factors(correlation):
+    # number k of common normals per step (0 unless correlation is an array of loadings)
+    return 0 if isinstance(correlation, str) else np.shape(correlation)[1]
+
+
+def factor_size(correlation, num_diffusions):
+    # size of g_L_T
+    k = num_common_factors(correlation)
+    return num_diffusions * (num_diffusions+1) // 2 if k == 0 else num_diffusions * (k+1)
+
+
+def factor_correlation(loadings):
+    # correlation matrix of the k-factor model of the given (d, k) loadings
+    loadings = np.asarray(loadings, np.float64)
+    assert (np.sum(loadings**2, axis=1) <= 1).all(), 'the rows of the loadings must have a norm of at most 1'
+    R = loadings @ loadings.T
+    np.fill_diagonal(R, 1.)
+    return R.astype(np.float32)
+
+
+def correlation_pattern(correlation, R):
+    # for 'identity' and 'block', the columns j >= i of the nonzero entries of each row i of L^T, as the offsets
+    # (num_diffusions+1,) of the rows in the columns; None for 'full' and the factor models
+    if not isinstance(correlation, str) or correlation == 'full':
+        return None
+    num_diffusions = R.shape[0]
+    if correlation == 'identity':
+        block = np.arange(num_diffusions)
+    else:
+        # connected components of the graph of the nonzero correlations
+        block = np.arange(num_diffusions)
+        for i, j in zip(*np.nonzero(R)):
+            bi, bj = block[i], block[j]
+            if bi != bj:
+                block[block == max(bi, bj)] = min(bi, bj)
+    cols = [[j for j in range(i, num_diffusions) if block[j] == block[i]] for i in range(num_diffusions)]
+    starts = np.cumsum([0] + [len(c) for c in cols]).astype(np.int32)
+    return starts, np.array(sum(cols, []), np.int32)
+
+
+def check_correlation(correlation, R, pattern):
+    # R must have the structure declared at the construction of the engine
+    if isinstance(correlation, str):
+        assert correlation in CORRELATIONS, 'correlation must be one of {} or an array of loadings'.format(CORRELATIONS)
+        if pattern is not None:
+            inside = np.zeros(R.shape, bool)
+            for i in range(R.shape[0]):
+                inside[i, pattern[1][pattern[0][i]:pattern[0][i+1]]] = True
+            inside |= inside.T
+            assert (R[~inside] == 0).all(), 'the correlation matrix does not have the {} structure of the engine'.format(correlation)
+    else:
+        assert np.allclose(R, factor_correlation(correlation), atol=1e-5), \
+            'the correlation matrix is not the one of the factor model of the loadings'
+
+
+def set_correlation_factor(correlation, R, out):
+    # fills g_L_T, see above
+    num_diffusions = R.shape[0]
+    if isinstance(correlation, str):
+        out[:] = np.linalg.cholesky(R).T[np.triu_indices(num_diffusions)]
+    else:
+        loadings = np.asarray(correlation, np.float64)
+        out[:num_diffusions] = np.sqrt(np.maximum(1 - np.sum(loadings**2, axis=1), 0.))
+        out[num_diffusions:] = loadings.ravel()
+    return out
+
+
+def compile_correlate(num_diffusions, num_correlated, pattern=None, num_factors=0):
+    # function adding the contribution of the i-th independent normal v of a step to the correlated increments
+    # dW_corr of the first num_correlated factors (the rates and FX rates only in the nested IM), for
+    # i < num_correlated + num_factors; callable from the CUDA kernels and their CPU ports alike
+    sparse = pattern is not None
+    starts, cols = pattern if sparse else (np.zeros(1, np.int32), np.zeros(1, np.int32))
+
+    @jit(forceinline=True)
+    def correlate(dW_corr, L_T, i, v):
+        if num_factors > 0:
+            if i < num_correlated:
+                dW_corr[i] += L_T[i] * v
+            else:
+                f = i - num_correlated
+                for j in range(num_correlated):
+                    dW_corr[j] += L_T[num_diffusions+j*num_factors+f] * v
+        elif sparse:
+            for k in range(starts[i], starts[i+1]):
+                j = cols[k]
+                if j < num_correlated:
+                    dW_corr[j] += L_T[i*num_diffusions-i*(i+1)//2+j] * v
+        else:
+            for j in range(i, num_correlated):
+                # L_T is the transpose of the lower-triangular L such that Corr=L*L_T
+                dW_corr[j] += L_T[i*num_diffusions-i*(i+1)//2+j] * v
+
+    return correlate
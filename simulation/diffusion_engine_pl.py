@@ -17,17 +17,57 @@
 # along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
+import time
+import numba
 from numba import cuda
-from numba.cuda.random import create_xoroshiro128p_states
-from simulation.kernels_pl import compile_cuda_compute_mtm, compile_cuda_diffuse_and_price, compile_cuda_oversimulate_defs, compile_cuda_generate_exp1, compile_cuda_nested_cva, compile_cuda_nested_im, compile_cuda_nested_im_err#, compile_cuda_gen_diff_params
+from numba.cuda.random import init_xoroshiro128p_states_cpu, xoroshiro128p_dtype
+from simulation.kernels_pl import compile_cuda_compute_mtm, compile_cuda_diffuse_and_price, compile_cuda_oversimulate_defs, compile_cuda_generate_exp1, compile_cuda_nested_cva, compile_cuda_nested_im, compile_cuda_nested_im_err, compile_cuda_encode_paths, compile_cuda_gen_diff_params
+from simulation.philox_pl import philox_key
+from simulation.sobol_pl import sobol_states
+from simulation.kernels_cpu_pl import compile_cpu_compute_mtm, compile_cpu_diffuse_and_price, compile_cpu_oversimulate_defs, compile_cpu_generate_exp1, compile_cpu_nested_cva, compile_cpu_nested_im, compile_cpu_nested_im_err, compile_cpu_encode_paths, compile_cpu_gen_diff_params
+from simulation.compact_pl import STORAGE_DTYPES, COMPACT_ARRAYS
+from simulation.timeline_pl import span
+from simulation.compression_pl import compress_irs, compress_vanillas
+from simulation.zc_tables_pl import num_zc_offsets, tabulate_zc_coefficients
+from simulation.correlation_pl import num_common_factors, factor_size, correlation_pattern, check_correlation, set_correlation_factor
+from simulation.shocks_pl import ShockSpec, shock_layout, shocked_rows
+
+# host arrays filled slice by slice along the coarse steps, in the order of the slices yielded by generate_batch_stream
+STREAMED_ARRAYS = ('X', 'spread_integrals', 'dom_rate_integral', 'def_indicators', 'mtm_by_cpty', 'cash_flows_by_cpty', 'cash_pos_by_cpty')
+# default step of the counterparties which do not default within the horizon, with default_times=True
+NO_DEFAULT_STEP = np.iinfo(np.int16).max
+
+class _HostEvent:
+    # stand-in for cuda.event() on the CPU backend, where kernels run synchronously
+    def __init__(self):
+        self.time = None
+
+    def record(self, stream=None):
+        self.time = time.perf_counter()
+
+    def synchronize(self):
+        pass
+
+    def wait(self, stream=None):
+        pass
 
 class DiffusionEngine:
     def __init__(self, irs_batch_size, vanilla_batch_size, num_coarse_steps, dT, num_fine_per_coarse, dt, num_paths, num_inner_paths, 
                  num_defs_per_path, num_rates, num_spreads, R, rates_params, fx_params,
                  spreads_params, vanilla_specs, irs_specs, zcs_specs,
                  initial_values, initial_defaults, cDtoH_freq, device=0, params_in_const=True, no_nested_cva=False, no_nested_im=False, num_adam_iters=100, lam=1, gamma=0.5, adam_b1=0.9, adam_b2=0.999, 
-                 pathwise_diff_para = None, early_pricing_date = None, seed = 1):
-        cuda.select_device(device)
+                 pathwise_diff_para = None, early_pricing_date = None, seed = 1, backend='cuda', cache_dir=None, rng_pool_size=4, rng='xoroshiro128p', path_offset=0, scheme='euler', full_host_arrays=True, outputs=None, storage_dtype='float32', default_times=False, double_buffering=False, timeline=None, compress_portfolio=False, active_trades=False, large_portfolio=False, correlation='full'):
+        assert backend in ('cuda', 'cpu'), 'backend must be either \'cuda\' or \'cpu\''
+        self.backend = backend  # 'cuda': kernels run on the GPU, 'cpu': numba parallel ports of the same kernels run on the host
+        if self.backend == 'cuda':
+            cuda.select_device(device)
+        self.cache_dir = cache_dir  # None: kernels are recompiled at each construction, otherwise: compiled kernels are persisted to (and reloaded from) this directory, keyed by problem sizes and baked-in constants
+        assert rng in ('xoroshiro128p', 'philox', 'sobol'), 'rng must be one of \'xoroshiro128p\', \'philox\' or \'sobol\''
+        self.rng = rng  # 'xoroshiro128p': one stateful stream per thread, 'philox': counter-based generator, the paths then only depend on their global index (see simulation/philox_pl.py), 'sobol': same, with a scrambled Sobol Brownian bridge on the coarse grid (see simulation/sobol_pl.py)
+        self.path_offset = path_offset  # only with rng='philox' or 'sobol': global index of the first path simulated by this engine, so that a larger run can be split into several engines
+        assert scheme in ('euler', 'exact'), 'scheme must be either \'euler\' or \'exact\''
+        self.scheme = scheme  # 'euler': num_fine_per_coarse Euler steps per coarse step, 'exact': one exact transition per coarse step for the rates, their integrals and the FX rates, and a moment-matched one for the intensities (see simulation/exact_pl.py); only used by the outer diffusion
+        self.rng_pool_size = rng_pool_size  # number of initial RNG states (one per seed) kept on the host, so that reseeding with a recently used seed is a plain copy instead of a jump-ahead
         self.params_in_const = params_in_const  # True: model parameters are put in constant memory, false: they are put in global memory instead
         self.irs_batch_size = irs_batch_size    # size of the batch of swaps to be loaded in shared memory (shared memory is used as a buffer for product specs during MtM computations)
         self.vanilla_batch_size = vanilla_batch_size    # # size of the batch of vanill options to be loaded in shared memory (shared memory is used as a buffer for product specs during MtM computations)
@@ -41,10 +81,54 @@ class DiffusionEngine:
         self.vanilla_specs = vanilla_specs.copy()   # named array containing specifications of the vanilla options to be priced, each row corresponds to one vanilla option
         self.irs_specs = irs_specs.copy()   # named array containing specifications of the swaps to be priced, each row corresponds to one swap
         self.zcs_specs = zcs_specs.copy()   # NOT USED (TODO: à nettoyer et à enlever)
+        self.compress_portfolio = compress_portfolio    # True: the swaps and the vanilla options are netted into equivalent trades before pricing (see simulation/compression_pl.py), irs_specs and vanilla_specs then being the compressed books
+        if compress_portfolio:
+            # row of the compressed book netting each original trade
+            self.irs_specs, self.irs_rows = compress_irs(irs_specs)
+            self.vanilla_specs, self.vanilla_rows = compress_vanillas(vanilla_specs)
+            print('Compressed {} swaps into {} and {} vanilla options into {}.'.format(irs_specs.size, self.irs_specs.size,
+                                                                                     vanilla_specs.size, self.vanilla_specs.size))
+        self.active_trades = active_trades  # True: the swaps and the vanilla options are sorted by decreasing final date, so that the kernels only load and price the first ones, still alive at each date (their number is found by a binary search, see _cuda_num_live_irs in simulation/kernels_pl.py)
+        self.large_portfolio = large_portfolio  # True: the swaps and the vanilla options are grouped by counterparty (by decreasing final date within a counterparty), so that diffuse_and_price prices one counterparty after the other, accumulating its MtM directly, with its swaps loaded cooperatively in shared memory on the GPU and priced by blocks of paths on the CPU (for books of 10^4-10^5 trades)
+        if active_trades or large_portfolio:
+            # the final dates are computed from the float32 specs as in the kernels; the sorts are stable, and irs_rows
+            # and vanilla_rows give the row of the sorted book pricing each original trade
+            irs_final = self.irs_specs['first_reset'].astype(np.float32).astype(np.float64) + \
+                (self.irs_specs['num_resets'].astype(np.int64) - 1) * self.irs_specs['reset_freq'].astype(np.float32).astype(np.float64)
+            vanilla_final = self.vanilla_specs['maturity'].astype(np.float32).astype(np.float64)
+            if large_portfolio:
+                irs_order = np.lexsort((-irs_final, self.irs_specs['cpty']))
+                vanilla_order = np.lexsort((-vanilla_final, self.vanilla_specs['cpty']))
+            else:
+                irs_order = np.argsort(-irs_final, kind='stable')
+                vanilla_order = np.argsort(-vanilla_final, kind='stable')
+            irs_rank = np.empty(irs_order.size, np.int64)
+            irs_rank[irs_order] = np.arange(irs_order.size)
+            vanilla_rank = np.empty(vanilla_order.size, np.int64)
+            vanilla_rank[vanilla_order] = np.arange(vanilla_order.size)
+            if compress_portfolio:
+                # the second swap of a pair stays next to the first one
+                self.irs_rows = np.where(self.irs_rows >= 0, irs_rank[np.maximum(self.irs_rows, 0)], -1)
+                self.vanilla_rows = np.where(self.vanilla_rows >= 0, vanilla_rank[np.maximum(self.vanilla_rows, 0)], -1)
+            else:
+                self.irs_rows = irs_rank
+                self.vanilla_rows = vanilla_rank
+            self.irs_specs = self.irs_specs[irs_order]
+            self.vanilla_specs = self.vanilla_specs[vanilla_order]
         self.cDtoH_freq = cDtoH_freq    # size in coarse steps of the path to be simulated on GPU (we simulate the paths by time slices because of memory constraints)
+        self.full_host_arrays = full_host_arrays    # True: the host arrays hold the whole horizon and are filled by generate_batch, False: they only hold the initial date and the paths are only available slice by slice through generate_batch_stream, so that the host memory does not depend on num_coarse_steps
+        assert outputs is None or set(outputs) <= set(STREAMED_ARRAYS), 'outputs must be a subset of {}'.format(STREAMED_ARRAYS)
+        self.outputs = STREAMED_ARRAYS if outputs is None else tuple(name for name in STREAMED_ARRAYS if name in outputs)    # path arrays retained on the host and copied back from the device, the others only hold the initial date
+        self.default_times = default_times  # False: the default indicators are stored by coarse step in def_indicators, True: only the coarse step at which each counterparty defaults is stored, in default_steps (see def_indicators_at), so that the memory for the defaults does not depend on num_coarse_steps
+        if default_times:
+            assert num_coarse_steps + (0 if early_pricing_date is None else len(early_pricing_date)) < NO_DEFAULT_STEP, 'default_times requires less than {} coarse steps'.format(NO_DEFAULT_STEP)
+            self.outputs = tuple(name for name in self.outputs if name != 'def_indicators')
+        assert storage_dtype in STORAGE_DTYPES, 'storage_dtype must be one of {}'.format(STORAGE_DTYPES)
+        self.storage_dtype = storage_dtype  # host storage of the arrays of COMPACT_ARRAYS: 'float32', or 16-bit codes encoded on the device (see simulation/compact_pl.py)
+        self.compact_outputs = tuple(name for name in self.outputs if name in COMPACT_ARRAYS) if storage_dtype != 'float32' else ()    # outputs stored as <name>_codes (and <name>_scale, <name>_offset with 'int16'), the float32 arrays then only holding the initial date
         
-        self.no_nested_cva = no_nested_cva  # True: no kernel compilation & no allocations are to be done for the nested CVA, False: kernel & memory space will be prepared for the nested CVA
-        self.no_nested_im = no_nested_im    # True: no kernel compilation & no allocations are to be done for the nested IM, False: kernel & memory space will be prepared for the nested IM
+        self.no_nested_cva = no_nested_cva  # True: the nested CVA can't be requested, False: kernel & memory space will be prepared for the nested CVA the first time it is requested in generate_batch
+        self.no_nested_im = no_nested_im    # True: the nested IM can't be requested, False: kernel & memory space will be prepared for the nested IM the first time it is requested in generate_batch
         self.num_adam_iters = num_adam_iters    # number of Adam iterations for the nested stochastic approximation of the IM
         self.lam = lam
         self.gamma = gamma  # Adam step size for the nested stochastic approximation of the IM
@@ -58,9 +142,12 @@ class DiffusionEngine:
         else:
             self.early_pricing_date =early_pricing_date
             self.num_early_pricing = 0
+        # the Sobol Brownian bridge is built on the regular coarse grid
+        assert rng != 'sobol' or self.early_pricing_date is None, 'early pricing dates are not supported with rng=\'sobol\''
 
+        # from the original book, the compressed one possibly dropping swaps
         if irs_specs.size > 0:
-            self.max_coarse_per_reset = max(int((self.irs_specs['reset_freq'].max()+dt)/dT), 1)
+            self.max_coarse_per_reset = max(int((irs_specs['reset_freq'].max()+dt)/dT), 1)
         else:
             self.max_coarse_per_reset = 1
         # TODO: add assert statements on the acceptable range for reset_freq
@@ -75,10 +162,27 @@ class DiffusionEngine:
         # total number of parameters (including initials)
         self.num_params = self.num_diffusions + 5*self.num_rates-2+3*self.num_spreads
 
-        self.pathwise_diff_para = pathwise_diff_para
+        self.correlation = correlation  # 'full': the normals of each step are correlated by the dense Cholesky factor of R, 'identity' or 'block': R is the identity or block-diagonal (up to a permutation of the factors, e.g. by economy), and only the entries of the factor within the blocks are applied, '(d, k) array of loadings': R is the correlation of a k-factor model, applied in d(k+1) operations from k common normals (see simulation/correlation_pl.py)
+        self.num_factors = num_common_factors(correlation)
+        assert rng != 'sobol' or self.num_factors == 0, 'factor models of the correlation are not supported with rng=\'sobol\''
+        # nonzero entries of the Cholesky factor of R with 'identity' and 'block', baked in the kernels
+        self.corr_pattern = correlation_pattern(correlation, R)
+
+        # relative pathwise shocks of the initial values and of the diffusion parameters: None, a (num_params, num_paths)
+        # array, or a ShockSpec from which the engine draws them (see simulation/shocks_pl.py); the absolute parameters
+        # of each path are then in pathwise_diff_para, see _gen_diff_params
+        self._pathwise_diff_para = None
+        self._pathwise_diff_para_on_device = False
+        # True: diffuse_and_price and compute_mtm read the parameters of each path from d_pathwise_diff_para, False:
+        # the parameters are shocked on no path, and the kernels read the base ones from constant (or uniform) storage,
+        # see _gen_diff_params
+        self.pathwise_params = self._shocks_params(pathwise_diff_para)
 
         # CUDA stream to have asynchronous kernel launches & copies to hide the latencies associated with those calls
-        self.stream = cuda.stream()
+        self.stream = cuda.stream() if self.backend == 'cuda' else None
+        self.double_buffering = double_buffering    # False: the slices are copied to the host on self.stream, between the kernel launches, True: the device slice arrays are doubled, the kernels filling one set while the other is copied to the host on self.copy_stream, so that the copies overlap the simulation of the next slice (at the cost of twice the device memory for the slices)
+        self.copy_stream = cuda.stream() if self.backend == 'cuda' and double_buffering else self.stream
+        self.timeline = timeline    # None, or a Timeline (see simulation/timeline_pl.py) recording the kernel launches and copies, which can be set at any time
 
         # preparing workspace arrays on the host and the device
         self._allocate_host_arrays()
@@ -88,39 +192,84 @@ class DiffusionEngine:
 
         self._allocate_device_arrays()
         self._copy_product_specs_to_device()
+        self._copy_market_params_to_device()
+
+        # the nested CVA & IM kernels are compiled lazily, see _require_nested_cva and _require_nested_im
+        self.cuda_nested_cva = None
+        self.cuda_gen_diff_params = None   # compiled on the first ShockSpec, for its sampling
+        self.gen_diff_params_sampling = None
+        self.cuda_nested_im = None
+        self.cuda_nested_im_err = None
+        self._compile_kernels()
+        print('Successfully compiled all kernels.')
+        # creating RNG state structures on the GPU
+        self._rng_state_pool = {}
+        self._rng_batch_idx = 0
+        self.d_rng_states = None
+        self.d_rng_states2 = None
+        self.reset_rng_states(seed)
+        self.antithetic = False    # layout of the last batch, see generate_batch
+        self._stream_ring = []    # pinned buffers of generate_batch_stream, allocated on first use
+        
+        if not pathwise_diff_para is None:
+            print('Randomizing diffusion parameters.')
+        self._gen_diff_params(pathwise_diff_para)
+        
 
+    def _compile_kernels(self, base=True, nested_cva=False, nested_im=False):
         # running factories which will generate custom CUDA kernels optimized for our problem size
-        self.cuda_generate_exp1 = compile_cuda_generate_exp1(self.num_spreads,
+        # (on the CPU backend, the compiled functions are stored under the same names and take the same arguments)
+        # with a cache directory, numba only compiles the kernels whose specialisation is not already on disk
+        if self.cache_dir is not None:
+            _prev_cache_dir = numba.config.CACHE_DIR
+            numba.config.CACHE_DIR = self.cache_dir
+        try:
+            if self.backend == 'cuda':
+                self._compile_cuda_kernels(base, nested_cva, nested_im)
+            else:
+                self._compile_cpu_kernels(base, nested_cva, nested_im)
+        finally:
+            if self.cache_dir is not None:
+                numba.config.CACHE_DIR = _prev_cache_dir
+
+    def _compile_cuda_kernels(self, base=True, nested_cva=False, nested_im=False):
+        # grouped by counterparty, the live trades of the book are no longer its first ones, only diffuse_and_price
+        # then skips the expired ones (within each counterparty)
+        live_prefix = self.active_trades and not self.large_portfolio
+        if base:
+            self.cuda_generate_exp1 = compile_cuda_generate_exp1(self.num_spreads,
+                                                                 self.num_defs_per_path,
+                                                                 self.num_paths,
+                                                                 512,
+                                                                 self.stream, rng=self.rng, cache=self.cache_dir is not None)
+            self.cuda_compute_mtm = compile_cuda_compute_mtm(self.irs_batch_size, 
+                                                             self.vanilla_batch_size,
+                                                             self.g_diff_params,
+                                                             self.g_R, 
+                                                             self.num_fine_per_coarse,
+                                                             self.num_rates,
+                                                             self.num_spreads,
+                                                             self.num_paths, 512,
+                                                             self.stream, params_in_const=self.params_in_const, active_trades=live_prefix, pathwise_params=self.pathwise_params, cache=self.cache_dir is not None)
+            self.cuda_diffuse_and_price = compile_cuda_diffuse_and_price(self.irs_batch_size, 
+                                                             self.vanilla_batch_size,
+                                                             self.g_diff_params,
+                                                             self.g_R,
+                                                             self.g_L_T,
+                                                             self.num_fine_per_coarse,
+                                                             self.num_rates,
+                                                             self.num_spreads,
+                                                             self.num_paths, 
+                                                             512,
+                                                             self.stream, params_in_const=self.params_in_const, rng=self.rng, scheme=self.scheme, active_trades=self.active_trades, large_portfolio=self.large_portfolio, pathwise_params=self.pathwise_params, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+            self.cuda_oversimulate_defs = compile_cuda_oversimulate_defs(self.num_spreads,
                                                              self.num_defs_per_path,
-                                                             self.num_paths,
+                                                             self.num_paths, 
                                                              512,
-                                                             self.stream)
-        self.cuda_compute_mtm = compile_cuda_compute_mtm(self.irs_batch_size, 
-                                                         self.vanilla_batch_size,
-                                                         self.g_diff_params,
-                                                         self.g_R, 
-                                                         self.num_fine_per_coarse,
-                                                         self.num_rates,
-                                                         self.num_spreads,
-                                                         self.num_paths, 512,
-                                                         self.stream)
-        self.cuda_diffuse_and_price = compile_cuda_diffuse_and_price(self.irs_batch_size, 
-                                                         self.vanilla_batch_size,
-                                                         self.g_diff_params,
-                                                         self.g_R,
-                                                         self.g_L_T,
-                                                         self.num_fine_per_coarse,
-                                                         self.num_rates,
-                                                         self.num_spreads,
-                                                         self.num_paths, 
-                                                         512,
-                                                         self.stream, params_in_const=params_in_const)
-        self.cuda_oversimulate_defs = compile_cuda_oversimulate_defs(self.num_spreads,
-                                                         self.num_defs_per_path,
-                                                         self.num_paths, 
-                                                         512,
-                                                         self.stream)
-        if not self.no_nested_cva:
+                                                             self.stream, default_times=self.default_times, cache=self.cache_dir is not None)
+            self.cuda_encode_paths = compile_cuda_encode_paths(self.num_paths, self.cDtoH_freq, self.num_diffusions, 256, self.stream,
+                                                               storage_dtype=self.storage_dtype, cache=self.cache_dir is not None) if self.compact_outputs else None
+        if nested_cva:
             self.cuda_nested_cva = compile_cuda_nested_cva(self.irs_batch_size, 
                                                         self.vanilla_batch_size,
                                                         self.g_diff_params, 
@@ -133,8 +282,8 @@ class DiffusionEngine:
                                                         self.num_paths, 
                                                         self.num_inner_paths, 
                                                         self.max_coarse_per_reset,
-                                                        self.stream)
-        if not self.no_nested_im:
+                                                        self.stream, params_in_const=self.params_in_const, rng=self.rng, active_trades=live_prefix, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+        if nested_im:
             self.cuda_nested_im = compile_cuda_nested_im(self.irs_batch_size, 
                                                         self.vanilla_batch_size,
                                                         self.g_diff_params, 
@@ -147,7 +296,7 @@ class DiffusionEngine:
                                                         self.num_paths, 
                                                         self.num_inner_paths, 
                                                         self.max_coarse_per_reset,
-                                                        self.stream)
+                                                        self.stream, params_in_const=self.params_in_const, rng=self.rng, active_trades=live_prefix, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
             self.cuda_nested_im_err = compile_cuda_nested_im_err(self.irs_batch_size, 
                                                        self.vanilla_batch_size,
                                                        self.g_diff_params, 
@@ -160,86 +309,210 @@ class DiffusionEngine:
                                                        self.num_paths, 
                                                        self.num_inner_paths, 
                                                        self.max_coarse_per_reset,
-                                                       self.stream)
-        print('Successfully compiled all kernels.')
-        # creating RNG state structures on the GPU
-        self.d_rng_states = None
-        self.reset_rng_states(seed)
-        
-        if not self.pathwise_diff_para is None:
-            print('Randomizing diffusion parameters.')
-            #self.cuda_gen_diff_params = compile_cuda_gen_diff_params(512, num_paths, self.num_diffusions, self.stream)
-            self._gen_diff_params(pathwise_diff_para.copy())
-        else:
-            self._gen_diff_params(None)
-        
+                                                       self.stream, params_in_const=self.params_in_const, rng=self.rng, active_trades=live_prefix, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+
+    def _compile_cpu_kernels(self, base=True, nested_cva=False, nested_im=False):
+        # grouped by counterparty, the live trades of the book are no longer its first ones, only diffuse_and_price
+        # then skips the expired ones (within each counterparty)
+        live_prefix = self.active_trades and not self.large_portfolio
+        if base:
+            self.cuda_generate_exp1 = compile_cpu_generate_exp1(self.num_spreads,
+                                                                self.num_defs_per_path,
+                                                                self.num_paths, rng=self.rng, cache=self.cache_dir is not None)
+            self.cuda_compute_mtm = compile_cpu_compute_mtm(self.g_diff_params,
+                                                            self.g_R,
+                                                            self.num_fine_per_coarse,
+                                                            self.num_rates,
+                                                            self.num_spreads,
+                                                            self.num_paths, params_in_const=self.params_in_const, active_trades=live_prefix, pathwise_params=self.pathwise_params, cache=self.cache_dir is not None)
+            self.cuda_diffuse_and_price = compile_cpu_diffuse_and_price(self.g_diff_params,
+                                                                        self.g_R,
+                                                                        self.g_L_T,
+                                                                        self.num_fine_per_coarse,
+                                                                        self.num_rates,
+                                                                        self.num_spreads,
+                                                                        self.num_paths,
+                                                                        params_in_const=self.params_in_const, rng=self.rng, scheme=self.scheme, active_trades=self.active_trades, large_portfolio=self.large_portfolio, pathwise_params=self.pathwise_params, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+            self.cuda_oversimulate_defs = compile_cpu_oversimulate_defs(self.num_spreads,
+                                                                        self.num_defs_per_path,
+                                                                        self.num_paths, default_times=self.default_times,
+                                                                        cache=self.cache_dir is not None)
+            self.cuda_encode_paths = compile_cpu_encode_paths(self.num_paths, storage_dtype=self.storage_dtype,
+                                                              cache=self.cache_dir is not None) if self.compact_outputs else None
+        if nested_cva:
+            self.cuda_nested_cva = compile_cpu_nested_cva(self.g_diff_params,
+                                                          self.g_R,
+                                                          self.g_L_T,
+                                                          self.num_fine_per_coarse,
+                                                          self.num_rates,
+                                                          self.num_spreads,
+                                                          self.num_defs_per_path,
+                                                          self.num_paths,
+                                                          self.num_inner_paths,
+                                                          self.max_coarse_per_reset, params_in_const=self.params_in_const, rng=self.rng, active_trades=live_prefix, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+        if nested_im:
+            self.cuda_nested_im = compile_cpu_nested_im(self.g_diff_params,
+                                                        self.g_R,
+                                                        self.g_L_T,
+                                                        self.num_fine_per_coarse,
+                                                        self.num_rates,
+                                                        self.num_spreads,
+                                                        self.num_defs_per_path,
+                                                        self.num_paths,
+                                                        self.num_inner_paths,
+                                                        self.max_coarse_per_reset, params_in_const=self.params_in_const, rng=self.rng, active_trades=live_prefix, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+            self.cuda_nested_im_err = compile_cpu_nested_im_err(self.g_diff_params,
+                                                                self.g_R,
+                                                                self.g_L_T,
+                                                                self.num_fine_per_coarse,
+                                                                self.num_rates,
+                                                                self.num_spreads,
+                                                                self.num_defs_per_path,
+                                                                self.num_paths,
+                                                                self.num_inner_paths,
+                                                                self.max_coarse_per_reset, params_in_const=self.params_in_const, rng=self.rng, active_trades=live_prefix, corr_pattern=self.corr_pattern, num_factors=self.num_factors, cache=self.cache_dir is not None)
+
+    def _pinned_array(self, shape, dtype):
+        if self.backend == 'cuda':
+            return cuda.pinned_array(shape, dtype)
+        return np.empty(shape, dtype)
+
+    def _pinned_array_or_numpy(self, name, shape, dtype):
+        try:
+            return self._pinned_array(shape, dtype)
+        except cuda.cudadrv.driver.CudaAPIError:
+            print('couldn\'t allocate pinned array for {} ({:.1f} MB), using the numpy allocator instead (non-pinned array).'.format(
+                name, np.prod(shape)*np.dtype(dtype).itemsize/2**20))
+            return np.empty(shape, dtype)
+
+    def _device_array(self, shape, dtype):
+        if self.backend == 'cuda':
+            return cuda.device_array(shape, dtype)
+        return np.empty(shape, dtype)
+
+    def _to_host(self, d_ary, ary, stream=None, name='D2H'):
+        with self._span(name, 'copy', ary.nbytes, stream):
+            if self.backend == 'cuda':
+                d_ary.copy_to_host(ary=ary, stream=stream or self.stream)
+            else:
+                ary[...] = d_ary
+
+    def _to_device(self, ary, d_ary, name='H2D'):
+        # also used for device-to-device copies
+        with self._span(name, 'copy', d_ary.nbytes):
+            if self.backend == 'cuda':
+                d_ary.copy_to_device(ary, stream=self.stream)
+            else:
+                d_ary[...] = ary
+
+    def _span(self, name, cat='kernel', nbytes=0, stream=None, **args):
+        # span of the timeline around the work queued on stream (self.stream by default), a no-op without timeline
+        stream = stream or self.stream
+        return span(self.timeline, name, cat, nbytes, engine=self, stream=stream,
+                    track='copy stream' if stream is not self.stream else 'stream', **args)
+
+    def _synchronize(self):
+        if self.backend == 'cuda':
+            self.stream.synchronize()
+            if self.copy_stream is not self.stream:
+                self.copy_stream.synchronize()
+
+    def _event(self):
+        if self.backend == 'cuda':
+            return cuda.event()
+        return _HostEvent()
+
+    def _event_elapsed_time(self, evt_begin, evt_end):
+        # in ms, like cuda.event_elapsed_time
+        if self.backend == 'cuda':
+            return cuda.event_elapsed_time(evt_begin, evt_end)
+        return 1000 * (evt_end.time - evt_begin.time)
+
+    def _rng_states_snapshot(self, seed):
+        if self.rng == 'philox':
+            # nothing is stored per path with the counter-based generator, the batch index is part of the key
+            # so that successive batches are independent, like successive batches of the xoroshiro128p streams
+            return philox_key(seed, self._rng_batch_idx, self.path_offset)
+        if self.rng == 'sobol':
+            # same key, followed by the Brownian bridge order and the direction numbers; the scrambling depends
+            # on the batch index, so that successive batches are independent randomized QMC replications
+            return sobol_states(seed, self._rng_batch_idx, self.path_offset, self.num_coarse_steps, self.num_diffusions)
+        # initial xoroshiro128p states for the given seed, the (sequential) jump-ahead being done on the host
+        # like in create_xoroshiro128p_states; the most recently used seeds are kept in an LRU pool
+        snapshot = self._rng_state_pool.pop(seed, None)
+        if snapshot is None:
+            snapshot = np.empty(self.num_paths*(self.num_defs_per_path+self.num_inner_paths), dtype=xoroshiro128p_dtype)
+            init_xoroshiro128p_states_cpu(snapshot, seed, 0)
+        if self.rng_pool_size > 0:
+            while len(self._rng_state_pool) >= self.rng_pool_size:
+                del self._rng_state_pool[next(iter(self._rng_state_pool))]
+            self._rng_state_pool[seed] = snapshot
+        return snapshot
+
+    def _restore_rng_states(self, d_rng_states, seed):
+        # copies the initial states for the given seed into d_rng_states (allocated if None, reused otherwise)
+        snapshot = self._rng_states_snapshot(seed)
+        if d_rng_states is None:
+            d_rng_states = self._device_array(snapshot.shape, snapshot.dtype)
+        self._to_device(snapshot, d_rng_states)
+        return d_rng_states
+
+    def _set_rng_coarse_offset(self, coarse_offset):
+        # the kernels only see coarse indices local to the device arrays, the counter-based generator
+        # gets the global index of the coarse step preceding them through its key
+        if self.rng in ('philox', 'sobol'):
+            for d_rng_states in (self.d_rng_states, self.d_rng_states2):
+                if d_rng_states is not None:
+                    self._to_device(np.array([coarse_offset], dtype=np.uint32), d_rng_states[3:4])
 
     def _allocate_host_arrays(self):
+        num_dates = {name: self.num_coarse_steps+1 + self.num_early_pricing if self.full_host_arrays and name in self.outputs and name not in self.compact_outputs else 1
+                     for name in STREAMED_ARRAYS}
         # CPU array for the diffusion factors
-        self.X = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_diffusions, self.num_paths), np.float32)
+        self.X = self._pinned_array(
+            (num_dates['X'], self.num_diffusions, self.num_paths), np.float32)
         # CPU array for the MtMs for each counterparty
-        self.mtm_by_cpty = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
+        self.mtm_by_cpty = self._pinned_array(
+            (num_dates['mtm_by_cpty'], self.num_spreads-1, self.num_paths), np.float32)
         # CPU array for the cash flows for each counterparty
-        self.cash_flows_by_cpty = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
+        self.cash_flows_by_cpty = self._pinned_array(
+            (num_dates['cash_flows_by_cpty'], self.num_spreads-1, self.num_paths), np.float32)
         # CPU array for the cash position (ie accumulation of the cash flows) for each counterparty
-        self.cash_pos_by_cpty = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
+        self.cash_pos_by_cpty = self._pinned_array(
+            (num_dates['cash_pos_by_cpty'], self.num_spreads-1, self.num_paths), np.float32)
         # CPU array for the spread integrals
-        self.spread_integrals = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads, self.num_paths), np.float32)
+        self.spread_integrals = self._pinned_array(
+            (num_dates['spread_integrals'], self.num_spreads, self.num_paths), np.float32)
         # CPU array for the domestic short rate integral
-        self.dom_rate_integral = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_paths), np.float32)
+        self.dom_rate_integral = self._pinned_array(
+            (num_dates['dom_rate_integral'], self.num_paths), np.float32)
         # CPU array for the default indicators
-        self.def_indicators = cuda.pinned_array(
-            (self.num_coarse_steps+1 + self.num_early_pricing, (self.num_spreads-1+7)//8, self.num_defs_per_path, self.num_paths), 
+        self.def_indicators = self._pinned_array(
+            (num_dates['def_indicators'], (self.num_spreads-1+7)//8, self.num_defs_per_path, self.num_paths), 
             np.int8)
+        # CPU array for the coarse step at which each counterparty defaults (NO_DEFAULT_STEP if it does not), with default_times
+        self.default_steps = self._pinned_array(
+            (self.num_spreads-1, self.num_defs_per_path, self.num_paths), np.int16) if self.default_times else None
+        # CPU arrays for the reduced-precision codes, and the scales and offsets of the int16 quantisation
+        for name in self.compact_outputs:
+            shape = (self.num_coarse_steps+1 + self.num_early_pricing if self.full_host_arrays else 1,) + getattr(self, name).shape[1:]
+            setattr(self, name+'_codes', self._pinned_array(shape, np.int16))
+            if self.storage_dtype == 'int16':
+                setattr(self, name+'_scale', self._pinned_array(shape[:-1], np.float32))
+                setattr(self, name+'_offset', self._pinned_array(shape[:-1], np.float32))
         # CPU array for the nested CVA
-        if not self.no_nested_cva:
-            # since the CPU array for the nested CVA can be huge (mostly due to the fact what we have an additional dimension related to the default scenario)
-            # we first try to allocate it in pinned memory, and if it fails, we allocate it
-            # using the regular numpy allocator
-            try:
-                self.nested_cva = cuda.pinned_array(
-                    (self.num_coarse_steps+1 + self.num_early_pricing, self.num_defs_per_path, self.num_paths), np.float32)
-            except cuda.cudadrv.driver.CudaAPIError:
-                print('couldn\'t allocate pinned array for nested_cva, using the numpy allocator instead (non-pinned array).')
-                self.nested_cva = np.empty((self.num_coarse_steps+1 + self.num_early_pricing, self.num_defs_per_path, self.num_paths), np.float32)
-            try:
-                self.nested_cva_sq = cuda.pinned_array(
-                    (self.num_coarse_steps+1, self.num_defs_per_path, self.num_paths), np.float32)
-            except cuda.cudadrv.driver.CudaAPIError:
-                print('couldn\'t allocate pinned array for nested_cva_sq, using the numpy allocator instead (non-pinned array).')
-                self.nested_cva_sq = np.empty((self.num_coarse_steps+1 + self.num_early_pricing, self.num_defs_per_path, self.num_paths), np.float32)
-        
-        # CPU array for the nested IM, same remarks as for the CVA
-        if not self.no_nested_im:
-            try:
-                self.nested_im_by_cpty = cuda.pinned_array(
-                    (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
-            except cuda.cudadrv.driver.CudaAPIError:
-                print('couldn\'t allocate pinned array for nested_im_by_cpty, using the numpy allocator instead (non-pinned array).')
-                self.nested_im_by_cpty = np.empty((self.num_coarse_steps+1, self.num_spreads-1, self.num_paths), np.float32)
-            try:
-                self.nested_im_err_by_cpty = cuda.pinned_array(
-                    (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
-            except cuda.cudadrv.driver.CudaAPIError:
-                print('couldn\'t allocate pinned array for nested_im_err_by_cpty, using the numpy allocator instead (non-pinned array).')
-                self.nested_im_err_by_cpty = np.empty((self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
-
-
         # correlation matrix for the Brownian motions
         self.R = np.empty(
             (self.num_diffusions, self.num_diffusions), dtype=np.float32)
-        # then we store only upper-triangular entries of the correlation matrix and its Cholesky decomposition
+        # then we store only upper-triangular entries of the correlation matrix and its Cholesky decomposition (or the
+        # factor model of the correlation, see simulation/correlation_pl.py)
         # the following matrices are flattened
         self.g_R = np.empty(self.num_diffusions * (self.num_diffusions+1)//2, np.float32)
-        self.g_L_T = np.empty(self.num_diffusions * (self.num_diffusions+1)//2, np.float32)
+        self.g_L_T = np.empty(factor_size(self.correlation, self.num_diffusions), np.float32)
 
         self.g_diff_params = np.empty(5*self.num_rates-2+3*self.num_spreads, np.float32)
+        # coefficients A and B of the zero-coupon bonds priced by the swaps, by currency and offset on the fine grid (see simulation/zc_tables_pl.py)
+        self.zc_tables = np.empty((2, self.num_rates, num_zc_offsets(self.irs_specs, self.dt)), np.float32)
 
         # grouping product specs by data type
         self.vanillas_on_fx_f32 = np.empty((self.vanilla_specs.size, 3), np.float32)  # mat, notional, stk
@@ -254,55 +527,103 @@ class DiffusionEngine:
 
     def _allocate_device_arrays(self):
         # same as _allocate_host_arrays but on GPU
-        self.d_exp_1 = cuda.device_array(
+        self.d_exp_1 = self._device_array(
             (self.num_spreads-1, self.num_defs_per_path, self.num_paths), np.float32)
-        self.d_X = cuda.device_array(
+        self.d_X = self._device_array(
             (self.cDtoH_freq+self.max_coarse_per_reset, self.num_diffusions, self.num_paths), np.float32)
-        self.d_spread_integrals = cuda.device_array(
+        self.d_spread_integrals = self._device_array(
             (self.cDtoH_freq+1, self.num_spreads, self.num_paths), np.float32)
-        self.d_dom_rate_integral = cuda.device_array(
+        self.d_dom_rate_integral = self._device_array(
             (self.cDtoH_freq+1, self.num_paths), np.float32)
-        self.d_def_indicators = cuda.device_array(
+        self.d_def_indicators = self._device_array(
             (self.cDtoH_freq+1, (self.num_spreads-1+7)//8, self.num_defs_per_path, self.num_paths), np.int8)
-        if not self.no_nested_cva:
-            self.d_nested_cva = cuda.device_array((self.num_defs_per_path, self.num_paths), np.float32)
-            self.d_nested_cva_sq = cuda.device_array((self.num_defs_per_path, self.num_paths), np.float32)
-        if not self.no_nested_im:
-            self.d_nested_im_by_cpty = cuda.device_array((self.num_spreads-1, self.num_paths), np.float32)
-            self.d_nested_im_err_by_cpty = cuda.device_array((self.num_spreads-1, self.num_paths), np.float32)
-            self.d_nested_im_std_by_cpty = cuda.device_array((self.num_spreads-1, self.num_paths), np.float32)
-            self.d_nested_im_m = cuda.device_array((self.num_spreads-1, self.num_paths), np.float32)
-            self.d_nested_im_v = cuda.device_array((self.num_spreads-1, self.num_paths), np.float32)
-        #if not self.pathwise_diff_para is None:
-        self.d_pathwise_diff_para = cuda.device_array((self.num_params, self.num_paths), np.float32)
-        #else:
-        #    self.d_pathwise_diff_para = None
-        self.d_vanillas_on_fx_f32 = cuda.device_array((self.vanilla_specs.size, 3), np.float32)
-        self.d_vanillas_on_fx_i32 = cuda.device_array((self.vanilla_specs.size, 2), np.int32)
-        self.d_vanillas_on_fx_b8 = cuda.device_array((self.vanilla_specs.size, 1), np.bool8)
-        self.d_irs_f32 = cuda.device_array((self.irs_specs.size, 4), np.float32)
-        self.d_irs_i32 = cuda.device_array((self.irs_specs.size, 3), np.int32)
-        self.d_zcs_f32 = cuda.device_array(
+        self.d_default_steps = self._device_array(self.default_steps.shape, np.int16) if self.default_times else None
+        self.d_diff_params = self._device_array(self.g_diff_params.shape, np.float32)
+        self.d_R = self._device_array(self.g_R.shape, np.float32)
+        self.d_L_T = self._device_array(self.g_L_T.shape, np.float32)
+        self.d_zc_tables = self._device_array(self.zc_tables.shape, np.float32)
+        # empty tables, for the kernels to compute the coefficients on the fly
+        self.d_no_zc_tables = self._device_array((2, self.num_rates, 0), np.float32)
+        # allocated by _gen_diff_params when the parameters are shocked, not read by the kernels otherwise
+        self.d_pathwise_diff_para = self._device_array((self.num_params, 0), np.float32)
+        self.d_vanillas_on_fx_f32 = self._device_array((self.vanilla_specs.size, 3), np.float32)
+        self.d_vanillas_on_fx_i32 = self._device_array((self.vanilla_specs.size, 2), np.int32)
+        self.d_vanillas_on_fx_b8 = self._device_array((self.vanilla_specs.size, 1), np.bool8)
+        self.d_irs_f32 = self._device_array((self.irs_specs.size, 4), np.float32)
+        self.d_irs_i32 = self._device_array((self.irs_specs.size, 3), np.int32)
+        self.d_zcs_f32 = self._device_array(
             (self.zcs_specs.size, 2), np.float32)
-        self.d_zcs_i32 = cuda.device_array(
+        self.d_zcs_i32 = self._device_array(
             (self.zcs_specs.size, 2), np.int32)
-        self.d_mtm_by_cpty = cuda.device_array(
+        self.d_mtm_by_cpty = self._device_array(
             (self.cDtoH_freq+1, self.num_spreads-1, self.num_paths), np.float32)
-        self.d_cash_flows_by_cpty = cuda.device_array(
+        self.d_cash_flows_by_cpty = self._device_array(
             (self.cDtoH_freq+1, self.num_spreads-1, self.num_paths), np.float32)
-        self.d_cash_pos_by_cpty = cuda.device_array(
+        self.d_cash_pos_by_cpty = self._device_array(
             (self.cDtoH_freq+1, self.num_spreads-1, self.num_paths), np.float32)
+        for name in self.compact_outputs:
+            shape = (self.cDtoH_freq,) + getattr(self, name).shape[1:]
+            setattr(self, 'd_'+name+'_codes', self._device_array(shape, np.int16))
+            setattr(self, 'd_'+name+'_scale', self._device_array(shape[:-1], np.float32))
+            setattr(self, 'd_'+name+'_offset', self._device_array(shape[:-1], np.float32))
+        # second set of slice arrays with double_buffering, swapped with the first one after each slice (see
+        # _swap_slice_buffers), and the events ordering the kernels and the copies of the two sets
+        self._d_other_slice = {attr: self._device_array(getattr(self, attr).shape, getattr(self, attr).dtype)
+                               for attr in self._slice_attrs()} if self.double_buffering else None
+        self._slice_buffer = 0
+        self._slice_computed = self._event()
+        self._slice_drained = [self._event(), self._event()]
     
-    def _set_cpu_arrays(self, R, rates_params, fx_params, spreads_params,
-                        initial_values, initial_defaults):
+    def _allocate_nested_cva_arrays(self):
+        # since the CPU array for the nested CVA can be huge (mostly due to the fact what we have an additional dimension related to the default scenario)
+        # we first try to allocate it in pinned memory, and if it fails, we allocate it
+        # using the regular numpy allocator (see simulation/memory_plan_pl.py to plan the memory beforehand)
+        self.nested_cva = self._pinned_array_or_numpy('nested_cva',
+            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_defs_per_path, self.num_paths), np.float32)
+        self.nested_cva_sq = self._pinned_array_or_numpy('nested_cva_sq',
+            (self.num_coarse_steps+1, self.num_defs_per_path, self.num_paths), np.float32)
+        # GPU workspaces
+        self.d_nested_cva = self._device_array((self.num_defs_per_path, self.num_paths), np.float32)
+        self.d_nested_cva_sq = self._device_array((self.num_defs_per_path, self.num_paths), np.float32)
+
+    def _allocate_nested_im_arrays(self):
+        # CPU array for the nested IM, same remarks as for the CVA
+        self.nested_im_by_cpty = self._pinned_array_or_numpy('nested_im_by_cpty',
+            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
+        self.nested_im_err_by_cpty = self._pinned_array_or_numpy('nested_im_err_by_cpty',
+            (self.num_coarse_steps+1 + self.num_early_pricing, self.num_spreads-1, self.num_paths), np.float32)
+        # GPU workspaces
+        self.d_nested_im_by_cpty = self._device_array((self.num_spreads-1, self.num_paths), np.float32)
+        self.d_nested_im_err_by_cpty = self._device_array((self.num_spreads-1, self.num_paths), np.float32)
+        self.d_nested_im_std_by_cpty = self._device_array((self.num_spreads-1, self.num_paths), np.float32)
+        self.d_nested_im_m = self._device_array((self.num_spreads-1, self.num_paths), np.float32)
+        self.d_nested_im_v = self._device_array((self.num_spreads-1, self.num_paths), np.float32)
+
+    def _require_nested_cva(self):
+        # the nested CVA kernel and its workspaces are only prepared the first time they are requested
+        assert not self.no_nested_cva, 'the nested CVA was disabled with no_nested_cva=True'
+        if self.cuda_nested_cva is None:
+            self._allocate_nested_cva_arrays()
+            self._compile_kernels(base=False, nested_cva=True)
+
+    def _require_nested_im(self):
+        # same as _require_nested_cva for the nested IM
+        assert not self.no_nested_im, 'the nested IM was disabled with no_nested_im=True'
+        if self.cuda_nested_im is None:
+            self._allocate_nested_im_arrays()
+            self._compile_kernels(base=False, nested_im=True)
+
+    def _set_market_arrays(self, R, rates_params, fx_params, spreads_params):
         assert R.shape[0] == R.shape[1] == self.num_diffusions, \
             'incorrect shape for correlation matrix'
         assert R.dtype == np.float32, 'use only float32 for floating point numbers'
+        assert self.scheme == 'euler' or (rates_params['a'] > 0).all(), 'the exact scheme requires positive mean reversion speeds for the rates'
+        check_correlation(self.correlation, R, self.corr_pattern)
         # setting the CPU arrays for the correlation matrix, its upper-diagonal entries and those of its Cholesky decomposition
         self.R[:] = R
         triu_indices = np.triu_indices(self.num_diffusions)
         self.g_R[:] = self.R[triu_indices]
-        self.g_L_T[:] = np.linalg.cholesky(self.R).T[triu_indices]
+        set_correlation_factor(self.correlation, self.R, self.g_L_T)
 
         # setting the CPU array for the diffusion parameters with the Vasicek parameters
         self.g_diff_params[:self.num_rates] = rates_params['a']
@@ -326,6 +647,11 @@ class DiffusionEngine:
                            self.num_rates+2*self.num_spreads-2] = spreads_params['b']
         self.g_diff_params[5*self.num_rates+2 *
                            self.num_spreads-2:] = spreads_params['vvol']
+        tabulate_zc_coefficients(self.g_diff_params, self.num_rates, self.dt, self.zc_tables)
+
+    def _set_cpu_arrays(self, R, rates_params, fx_params, spreads_params,
+                        initial_values, initial_defaults):
+        self._set_market_arrays(R, rates_params, fx_params, spreads_params)
 
         # setting the CPU arrays for the vanilla specs
         self.vanillas_on_fx_f32[:, 0] = self.vanilla_specs['maturity']
@@ -367,15 +693,46 @@ class DiffusionEngine:
 
     def _copy_product_specs_to_device(self):
         # copying product specs to GPU
-        cuda.to_device(self.vanillas_on_fx_f32, to=self.d_vanillas_on_fx_f32)
-        cuda.to_device(self.vanillas_on_fx_i32, to=self.d_vanillas_on_fx_i32)
-        cuda.to_device(self.vanillas_on_fx_b8, to=self.d_vanillas_on_fx_b8)
-        cuda.to_device(self.irs_f32, to=self.d_irs_f32)
-        cuda.to_device(self.irs_i32, to=self.d_irs_i32)
-        cuda.to_device(self.zcs_f32, to=self.d_zcs_f32)
-        cuda.to_device(self.zcs_i32, to=self.d_zcs_i32)
+        self._to_device(self.vanillas_on_fx_f32, self.d_vanillas_on_fx_f32)
+        self._to_device(self.vanillas_on_fx_i32, self.d_vanillas_on_fx_i32)
+        self._to_device(self.vanillas_on_fx_b8, self.d_vanillas_on_fx_b8)
+        self._to_device(self.irs_f32, self.d_irs_f32)
+        self._to_device(self.irs_i32, self.d_irs_i32)
+        self._to_device(self.zcs_f32, self.d_zcs_f32)
+        self._to_device(self.zcs_i32, self.d_zcs_i32)
+
+    def _copy_market_params_to_device(self):
+        # copying model parameters and correlation to GPU (read by the kernels when params_in_const is False)
+        self._to_device(self.g_diff_params, self.d_diff_params)
+        self._to_device(self.g_R, self.d_R)
+        self._to_device(self.g_L_T, self.d_L_T)
+        self._to_device(self.zc_tables, self.d_zc_tables)
+
+    @property
+    def pathwise_diff_para(self):
+        # absolute initial values and diffusion parameters of each path, (num_params, num_paths); those drawn from a
+        # ShockSpec are only copied to the host on first access (e.g. as features of the CVA regressions)
+        if self._pathwise_diff_para_on_device:
+            if self._pathwise_diff_para is None:
+                self._pathwise_diff_para = np.empty((self.num_params, self.num_paths), np.float32)
+            self._to_host(self.d_pathwise_diff_para, self._pathwise_diff_para, name='D2H params')
+            self._synchronize()
+            self._pathwise_diff_para_on_device = False
+        return self._pathwise_diff_para
+
+    @pathwise_diff_para.setter
+    def pathwise_diff_para(self, pathwise_diff_para):
+        self._pathwise_diff_para = pathwise_diff_para
+        self._pathwise_diff_para_on_device = False
 
     def _gen_diff_params(self, pathwise_diff_para=None):
+        # kept to rebuild the pathwise parameters around new market parameters, see update_market
+        self.base_initial_values = self.X[0, :, 0].copy()
+        if isinstance(pathwise_diff_para, ShockSpec):
+            self._draw_diff_params(pathwise_diff_para)
+            return
+        self.pathwise_diff_shock = None if pathwise_diff_para is None else pathwise_diff_para.copy()
+
         if pathwise_diff_para is None:
             self.pathwise_diff_para = np.zeros((self.num_params, self.num_paths), dtype=np.float32)
         else:
@@ -384,18 +741,94 @@ class DiffusionEngine:
         self.pathwise_diff_para[:self.num_diffusions, :] += self.X[0, :, 0][:, np.newaxis]
         self.pathwise_diff_para[self.num_diffusions:, :] *= self.g_diff_params[:, np.newaxis]
         self.pathwise_diff_para[self.num_diffusions:, :] += self.g_diff_params[:, np.newaxis]
-        self.d_pathwise_diff_para.copy_to_device(self.pathwise_diff_para, stream=self.stream)
-        self.stream.synchronize()
+        pathwise_params = self._shocks_params(pathwise_diff_para)
+        if pathwise_params:
+            if self.d_pathwise_diff_para.shape[1] != self.num_paths:
+                self.d_pathwise_diff_para = self._device_array((self.num_params, self.num_paths), np.float32)
+            self._to_device(self.pathwise_diff_para, self.d_pathwise_diff_para)
+        if pathwise_params != self.pathwise_params:
+            # e.g. _reinitialize with shocks on an engine built without them, or conversely
+            self.pathwise_params = pathwise_params
+            self._compile_kernels()
+        # the outer swaps are priced with the pathwise rate parameters: the tables only hold for unshocked ones
+        rates_params = self.pathwise_diff_para[self.num_diffusions:self.num_diffusions+3*self.num_rates]
+        shocked = (rates_params != self.g_diff_params[:3*self.num_rates, np.newaxis]).any()
+        self.d_outer_zc_tables = self.d_no_zc_tables if shocked else self.d_zc_tables
+        self._synchronize()
         self.X[0, :self.num_params, :] = self.pathwise_diff_para[:min(self.num_params, self.num_diffusions), :]
 
+    def _draw_diff_params(self, spec):
+        # same as _gen_diff_params, the shocks being drawn by the engine from the ShockSpec spec directly in
+        # d_pathwise_diff_para, on the device (or in parallel on the host with backend='cpu'): the (num_params, num_paths)
+        # relative shocks are neither built nor copied from the host, and only the initial values are copied back (to X)
+        self.pathwise_diff_shock = spec
+        # the groups split the paths of the run of the spec, of which the engine holds those from path_offset on
+        if spec.num_paths is None:
+            first_path, num_run_paths = 0, self.num_paths
+        else:
+            first_path, num_run_paths = self.path_offset, spec.num_paths
+            assert first_path + self.num_paths <= num_run_paths, 'the paths of the engine must be within the num_paths of the spec'
+        rows, row_scales, group_starts, batch_size = shock_layout(spec, self.num_params, num_run_paths)
+        if self.cuda_gen_diff_params is None or spec.sampling != self.gen_diff_params_sampling:
+            if self.backend == 'cuda':
+                self.cuda_gen_diff_params = compile_cuda_gen_diff_params(self.num_params, self.num_paths, 512, self.stream,
+                                                                         sampling=spec.sampling, cache=self.cache_dir is not None)
+            else:
+                self.cuda_gen_diff_params = compile_cpu_gen_diff_params(self.num_params, self.num_paths, sampling=spec.sampling,
+                                                                        cache=self.cache_dir is not None)
+            self.gen_diff_params_sampling = spec.sampling
+        if self.d_pathwise_diff_para.shape[1] != self.num_paths:
+            self.d_pathwise_diff_para = self._device_array((self.num_params, self.num_paths), np.float32)
+        # the small arrays of the spec and the base parameters
+        spec_arrays = [np.concatenate((self.base_initial_values, self.g_diff_params)), philox_key(spec.seed, 0, self.path_offset),
+                       rows, row_scales, group_starts]
+        d_spec_arrays = [self._device_array(ary.shape, ary.dtype) for ary in spec_arrays]
+        for ary, d_ary in zip(spec_arrays, d_spec_arrays):
+            self._to_device(ary, d_ary, 'H2D params')
+        with self._span('gen_diff_params'):
+            self.cuda_gen_diff_params(self.d_pathwise_diff_para, *d_spec_arrays, batch_size, first_path, num_run_paths)
+        self._pathwise_diff_para_on_device = True
+        shocked = shocked_rows(spec)
+        pathwise_params = bool((shocked >= self.num_diffusions).any())
+        if pathwise_params != self.pathwise_params:
+            self.pathwise_params = pathwise_params
+            self._compile_kernels()
+        # see _gen_diff_params
+        shocked_rates = ((shocked >= self.num_diffusions) & (shocked < self.num_diffusions+3*self.num_rates)).any()
+        self.d_outer_zc_tables = self.d_no_zc_tables if shocked_rates else self.d_zc_tables
+        self._to_host(self.d_pathwise_diff_para[:self.num_diffusions], self.X[0], name='D2H params')
+        self._synchronize()
+
+    def _shocks_params(self, pathwise_diff_para):
+        # whether the relative shocks pathwise_diff_para move the diffusion parameters of any path (the shocks of the
+        # initial values only change the first row of X)
+        if isinstance(pathwise_diff_para, ShockSpec):
+            return bool((shocked_rows(pathwise_diff_para) >= self.num_diffusions).any())
+        return pathwise_diff_para is not None and bool(pathwise_diff_para[self.num_diffusions:].any())
+
     def _reset(self):
-        cuda.to_device(self.X[0], to=self.d_X[self.max_coarse_per_reset-1], stream=self.stream)
-        cuda.to_device(
-            self.spread_integrals[0], to=self.d_spread_integrals[0], stream=self.stream)
-        cuda.to_device(
-            self.dom_rate_integral[0], to=self.d_dom_rate_integral[0], stream=self.stream)
+        self._to_device(self.X[0], self.d_X[self.max_coarse_per_reset-1], 'H2D reset')
+        self._to_device(self.spread_integrals[0], self.d_spread_integrals[0], 'H2D reset')
+        self._to_device(self.dom_rate_integral[0], self.d_dom_rate_integral[0], 'H2D reset')
         self.def_indicators[:] = self.def_indicators[0][None]
-        cuda.to_device(self.def_indicators[:self.cDtoH_freq+1], to=self.d_def_indicators, stream=self.stream)
+        if self.def_indicators.shape[0] > self.cDtoH_freq:
+            self._to_device(self.def_indicators[:self.cDtoH_freq+1], self.d_def_indicators, 'H2D reset')
+        else:
+            for i in range(self.cDtoH_freq+1):
+                self._to_device(self.def_indicators[0], self.d_def_indicators[i], 'H2D reset')
+        if self.default_times:
+            # the counterparties in default at the initial date default at step 0
+            cpty = np.arange(self.num_spreads-1)
+            initial = (self.def_indicators[0][cpty // 8] >> (cpty % 8)[:, np.newaxis, np.newaxis]) & 1
+            self.default_steps[:] = np.where(initial != 0, 0, NO_DEFAULT_STEP)
+            self._to_device(self.default_steps, self.d_default_steps, 'H2D reset')
+
+    def def_indicators_at(self, coarse_idx):
+        # default indicators at the given coarse step, packed as def_indicators[coarse_idx] (one bit per
+        # counterparty), derived from default_steps with default_times
+        if not self.default_times:
+            return self.def_indicators[coarse_idx]
+        return np.packbits(self.default_steps <= coarse_idx, axis=0, bitorder='little').view(np.int8)
 
     def _reinitialize(self, initial_values, pathwise_diff_para):
         self.X[0, :self.num_rates] = initial_values[:self.num_rates, np.newaxis]
@@ -405,55 +838,212 @@ class DiffusionEngine:
             2*self.num_rates-1):(2*self.num_rates+self.num_spreads-1), np.newaxis]
         self._gen_diff_params(pathwise_diff_para)
 
+    def update_market(self, rates_params, fx_params, spreads_params, R, loadings=None):
+        # recalibration of the diffusion parameters and of the correlation matrix, the products,
+        # the initial values and the relative pathwise shocks are kept
+        # loadings: with a factor model of the correlation, the new loadings (with the same number of factors) of which
+        # R is the correlation matrix
+        if loadings is not None:
+            assert self.num_factors > 0 and num_common_factors(loadings) == self.num_factors, \
+                'the loadings must have the number of factors of the engine'
+            self.correlation = loadings
+        self._set_market_arrays(R, rates_params, fx_params, spreads_params)
+        self._copy_market_params_to_device()
+        if self.params_in_const:
+            # parameters are baked in the kernels, which thus need to be rebuilt (use params_in_const=False to avoid this)
+            self._compile_kernels(nested_cva=self.cuda_nested_cva is not None, nested_im=self.cuda_nested_im is not None)
+        self.X[0] = self.base_initial_values[:, np.newaxis]
+        self._gen_diff_params(self.pathwise_diff_shock)
+
     def generate_batch(self, end=None, verbose=False, fused=False, nested_cva_at=None, nested_im_at=None, indicator_in_cva=False, alpha=None, im_window=None, set_irs_at_par=True,
-                       time_to_change_seed = np.inf, seed_to_change = 2):
-        self.d_rng_states2 = None
-        self.d_rng_states2 = create_xoroshiro128p_states(self.num_paths*(self.num_defs_per_path+self.num_inner_paths), seed=seed_to_change)
+                       time_to_change_seed = np.inf, seed_to_change = 2, antithetic = False, outputs=None):
+        # outputs: path arrays to be copied back, by default all those retained by the engine
+        assert self.full_host_arrays, 'generate_batch requires full_host_arrays=True, use generate_batch_stream otherwise'
+        keys = self._output_keys(self._select_outputs(outputs))
+        for start_idx, length in self._generate_batch_slices(end, verbose, fused, nested_cva_at, nested_im_at, indicator_in_cva, alpha, im_window, set_irs_at_par,
+                                                             time_to_change_seed, seed_to_change, antithetic):
+            # the initial date is already on the host, except for the arrays stored in reduced precision
+            self._slice_to_host(length, {key: getattr(self, key)[start_idx:start_idx+length] for key in keys
+                                         if start_idx > 0 or key not in STREAMED_ARRAYS}, min(start_idx, 1))
+
+    def generate_batch_stream(self, end=None, verbose=False, fused=False, nested_cva_at=None, nested_im_at=None, indicator_in_cva=False, alpha=None, im_window=None, set_irs_at_par=True,
+                              time_to_change_seed = np.inf, seed_to_change = 2, antithetic = False, num_buffers=2, outputs=None):
+        # same as generate_batch, but yields (start_idx, slices) as soon as the coarse steps start_idx, ..., 
+        # start_idx+length-1 are copied to the host, slices being a dict mapping the names in outputs (or those of
+        # their codes, scales and offsets, for the arrays stored in reduced precision) to arrays of first dimension length: first the initial date (start_idx=0, length=1), then slices of
+        # cDtoH_freq coarse steps (the last one may be shorter)
+        # the slices are views of a ring of num_buffers pinned buffers, they remain valid until the generator is
+        # resumed num_buffers-1 more times, and have to be copied to be kept longer
+        assert num_buffers >= 1, 'num_buffers must be positive'
+        keys = self._output_keys(self._select_outputs(outputs))
+        ring = self._stream_buffers(num_buffers)
+        for k, (start_idx, length) in enumerate(self._generate_batch_slices(end, verbose, fused, nested_cva_at, nested_im_at, indicator_in_cva, alpha, im_window, set_irs_at_par,
+                                                                            time_to_change_seed, seed_to_change, antithetic)):
+            slices = {key: (getattr(self, key) if start_idx == 0 and key in STREAMED_ARRAYS else ring[k % num_buffers][key])[:length]
+                      for key in keys}
+            self._slice_to_host(length, {key: ary for key, ary in slices.items() if start_idx > 0 or key not in STREAMED_ARRAYS},
+                                min(start_idx, 1))
+            self._synchronize()
+            yield start_idx, slices
+
+    def _stream_buffers(self, num_buffers):
+        # ring of pinned buffers of cDtoH_freq coarse steps, kept across batches
+        if len(self._stream_ring) != num_buffers:
+            self._stream_ring = [{name: self._pinned_array((self.cDtoH_freq,)+getattr(self, name).shape[1:], getattr(self, name).dtype)
+                                  for name in self._output_keys(self.outputs)} for _ in range(num_buffers)]
+        return self._stream_ring
+
+    def _select_outputs(self, outputs):
+        if outputs is None:
+            return self.outputs
+        assert set(outputs) <= set(self.outputs), 'outputs must be a subset of the outputs of the engine {}'.format(self.outputs)
+        return tuple(name for name in self.outputs if name in outputs)
+
+    def _output_keys(self, outputs):
+        # names of the host arrays filled from the given outputs
+        keys = []
+        for name in outputs:
+            if name in self.compact_outputs:
+                keys.append(name+'_codes')
+                if self.storage_dtype == 'int16':
+                    keys += [name+'_scale', name+'_offset']
+            else:
+                keys.append(name)
+        return tuple(keys)
+
+    def _device_steps(self, name, first, length):
+        # coarse steps first, ..., first+length-1 of the device slice of a path array, 0 being the step before the slice
+        base = self.max_coarse_per_reset-1 if name == 'X' else 0
+        return getattr(self, 'd_'+name)[base+first:base+first+length]
+
+    def _slice_to_host(self, length, slices, first=1):
+        # copies the coarse steps first, ..., first+length-1 of the device slice into slices, a dict of host arrays
+        # by key (see _output_keys), the arrays stored in reduced precision being encoded on the device beforehand
+        for name in self.compact_outputs:
+            if name+'_codes' in slices:
+                src = self._device_steps(name, first, length)
+                shape = (length, int(np.prod(src.shape[1:-1])))
+                with self._span('encode_paths', array=name):
+                    self.cuda_encode_paths(src.reshape(shape+(self.num_paths,)),
+                                           getattr(self, 'd_'+name+'_codes')[:length].reshape(shape+(self.num_paths,)),
+                                           getattr(self, 'd_'+name+'_scale')[:length].reshape(shape),
+                                           getattr(self, 'd_'+name+'_offset')[:length].reshape(shape))
+        if self.double_buffering:
+            # the copies wait for the kernels which filled the slice, and are waited for before it is refilled
+            self._slice_computed.record(stream=self.stream)
+            self._slice_computed.wait(stream=self.copy_stream)
+        for key, ary in slices.items():
+            if key in STREAMED_ARRAYS:
+                self._to_host(self._device_steps(key, first, length), ary, self.copy_stream, 'D2H '+key)
+            else:
+                self._to_host(getattr(self, 'd_'+key)[:length], ary, self.copy_stream, 'D2H '+key)
+        if self.double_buffering:
+            self._slice_drained[self._slice_buffer].record(stream=self.copy_stream)
+
+    def _slice_attrs(self):
+        # device arrays holding a slice of coarse steps
+        return tuple('d_'+name for name in STREAMED_ARRAYS) + tuple('d_'+key for key in self._output_keys(self.compact_outputs))
+
+    def _swap_slice_buffers(self):
+        # makes the other set of slice arrays the current one, once its previous slice is copied out, and rolls the
+        # last steps of the slice just simulated into its head, as done in place without double_buffering
+        self._slice_buffer = 1 - self._slice_buffer
+        for attr in self._slice_attrs():
+            current = getattr(self, attr)
+            setattr(self, attr, self._d_other_slice[attr])
+            self._d_other_slice[attr] = current
+        self._slice_drained[self._slice_buffer].wait(stream=self.stream)
+        prev = self._d_other_slice
+        self._to_device(prev['d_X'][-self.max_coarse_per_reset:], self.d_X[:self.max_coarse_per_reset], 'D2D roll')
+        self._to_device(prev['d_spread_integrals'][self.cDtoH_freq], self.d_spread_integrals[0], 'D2D roll')
+        self._to_device(prev['d_dom_rate_integral'][self.cDtoH_freq], self.d_dom_rate_integral[0], 'D2D roll')
+        # the oversimulation only sets the bits of the default indicators, which keep those of the previous slice
+        self._to_device(prev['d_def_indicators'], self.d_def_indicators, 'D2D roll')
+        self._to_device(prev['d_def_indicators'][self.cDtoH_freq], self.d_def_indicators[0], 'D2D roll')
+        self._to_device(prev['d_cash_pos_by_cpty'][self.cDtoH_freq], self.d_cash_pos_by_cpty[0], 'D2D roll')
+
+    def _generate_batch_slices(self, end, verbose, fused, nested_cva_at, nested_im_at, indicator_in_cva, alpha, im_window, set_irs_at_par,
+                               time_to_change_seed, seed_to_change, antithetic):
+        # simulates a batch, yielding (start_idx, length) whenever the coarse steps start_idx, ..., start_idx+length-1
+        # are in the device slice (starting with the initial date, which is already on the host) so that the caller
+        # can queue their copy before the slice is overwritten
+        if antithetic:
+            # paths 2k and 2k+1 are an antithetic pair, simulated from the same draws with opposite signs, so the
+            # pairs have to be complete and aligned on the global path index
+            assert self.rng in ('philox', 'sobol'), 'antithetic pairs require a counter-based generator (rng=\'philox\' or \'sobol\')'
+            assert self.num_paths % 2 == 0 and self.path_offset % 2 == 0, 'antithetic pairs require even num_paths and path_offset'
+        self.antithetic = antithetic
+        # the nested CVA reads the default indicators of the device slice, which are not simulated with default_times
+        assert nested_cva_at is None or not self.default_times, 'the nested CVA requires default_times=False'
+        if nested_cva_at is not None:
+            self._require_nested_cva()
+        if nested_im_at is not None:
+            self._require_nested_im()
+
+        if self.rng in ('philox', 'sobol'):
+            # the key of the counter-based generator contains the batch index
+            self.d_rng_states = self._restore_rng_states(self.d_rng_states, self.seed)
+        # the secondary stream is only needed when the seed is actually changed during the simulation,
+        # otherwise the kernels are given the primary one, which they never swap for it
+        if np.isfinite(time_to_change_seed):
+            self.d_rng_states2 = self._restore_rng_states(self.d_rng_states2, seed_to_change)
+            d_rng_states2 = self.d_rng_states2
+        else:
+            d_rng_states2 = self.d_rng_states
+        if self.rng in ('philox', 'sobol'):
+            self._rng_batch_idx += 1
         
         if end is None:
             end = self.num_coarse_steps + self.num_early_pricing
         t = 0.
         self._reset()
-        self.cuda_generate_exp1(self.d_exp_1, self.d_rng_states)
-        self.stream.synchronize()
-        self.cuda_compute_mtm(0, t, self.d_X, self.d_mtm_by_cpty, self.d_cash_flows_by_cpty, 
-                              self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32,
-                              self.d_vanillas_on_fx_b8, self.d_irs_f32,
-                              self.d_irs_i32, self.d_zcs_f32, self.d_zcs_i32,
-                              self.dt, self.max_coarse_per_reset, self.cDtoH_freq, set_irs_at_par, self.d_pathwise_diff_para)
+        with self._span('generate_exp1'):
+            self.cuda_generate_exp1(self.d_exp_1, self.d_rng_states, antithetic)
+        self._synchronize()
+        with self._span('compute_mtm', coarse_idx=0):
+            self.cuda_compute_mtm(0, t, self.d_X, self.d_mtm_by_cpty, self.d_cash_flows_by_cpty, 
+                                  self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32,
+                                  self.d_vanillas_on_fx_b8, self.d_irs_f32,
+                                  self.d_irs_i32, self.d_zcs_f32, self.d_zcs_i32,
+                                  self.dt, self.max_coarse_per_reset, self.cDtoH_freq, set_irs_at_par, self.d_diff_params, self.d_R, self.d_pathwise_diff_para, self.d_outer_zc_tables)
         
         if set_irs_at_par:
-            self.d_irs_f32.copy_to_host(ary=self.irs_f32, stream=self.stream)
+            self._to_host(self.d_irs_f32, self.irs_f32)
             self.irs_specs['first_reset'] = self.irs_f32[:, 0]
             self.irs_specs['reset_freq'] = self.irs_f32[:, 1]
             self.irs_specs['notional'] = self.irs_f32[:, 2]
             self.irs_specs['swap_rate'] = self.irs_f32[:, 3]
 
-        self.stream.synchronize()
-        self.d_mtm_by_cpty[0].copy_to_host(ary=self.mtm_by_cpty[0], stream=self.stream)
-        self.d_cash_flows_by_cpty[0].copy_to_host(ary=self.cash_flows_by_cpty[0], stream=self.stream)
-        self.d_cash_pos_by_cpty[0].copy_to_device(self.d_cash_flows_by_cpty[0], stream=self.stream)
+        self._synchronize()
+        self._to_host(self.d_mtm_by_cpty[0], self.mtm_by_cpty[0])
+        self._to_host(self.d_cash_flows_by_cpty[0], self.cash_flows_by_cpty[0])
+        self._to_device(self.d_cash_flows_by_cpty[0], self.d_cash_pos_by_cpty[0])
         self.cash_pos_by_cpty[0] = self.cash_flows_by_cpty[0]
+        yield 0, 1
         
-        _cuda_bulk_diffuse_event_begin = [cuda.event() for i in range(end)]
-        _cuda_bulk_diffuse_event_end = [cuda.event() for i in range(end)]
+        # the events of compute_mtm and of the nested CVA & IM are only created when those are launched
+        _cuda_bulk_diffuse_event_begin = [self._event() for i in range(end)]
+        _cuda_bulk_diffuse_event_end = [self._event() for i in range(end)]
 
-        _cuda_compute_mtm_event_begin = [cuda.event() for i in range(end)]
-        _cuda_compute_mtm_event_end = [cuda.event() for i in range(end)]
+        if not fused:
+            _cuda_compute_mtm_event_begin = [self._event() for i in range(end)]
+            _cuda_compute_mtm_event_end = [self._event() for i in range(end)]
 
-        _cuda_nested_cva_event_begin = [cuda.event() for i in range(end)]
-        _cuda_nested_cva_event_end = [cuda.event() for i in range(end)]
+        if nested_cva_at is not None:
+            _cuda_nested_cva_event_begin = [self._event() for i in range(end)]
+            _cuda_nested_cva_event_end = [self._event() for i in range(end)]
 
-        _cuda_nested_im_event_begin = [cuda.event() for i in range(end)]
-        _cuda_nested_im_event_end = [cuda.event() for i in range(end)]
+        if nested_im_at is not None:
+            _cuda_nested_im_event_begin = [self._event() for i in range(end)]
+            _cuda_nested_im_event_end = [self._event() for i in range(end)]
 
         for coarse_idx in range(1, end+1):
             if (self.early_pricing_date is not None) and (self.num_early_pricing ==1) :
                 if coarse_idx == 1:
-                    t+= self.early_pricing_date
-                    DT = self.dT-self.early_pricing_date
+                    t+= self.early_pricing_date[0]
+                    DT = self.dT-self.early_pricing_date[0]
                 elif coarse_idx == 2:
-                    t+= self.dT - self.early_pricing_date
+                    t+= self.dT - self.early_pricing_date[0]
                     DT = 0.#self.dt*self.num_fine_per_coarse
                 else:
                     t += self.dT
@@ -484,113 +1074,97 @@ class DiffusionEngine:
             else:
                 _cuda_bulk_diffuse_event_begin[coarse_idx-1].record(stream=self.stream)
                 if idx_in_dev_arr == 1:
-                    self.cuda_diffuse_and_price(1, self.cDtoH_freq, t, self.d_X,
-                                        self.d_dom_rate_integral,
-                                        self.d_spread_integrals, self.d_mtm_by_cpty,
-                                        self.d_cash_flows_by_cpty, 
-                                        self.d_cash_pos_by_cpty, 
-                                        self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32,
-                                        self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, 
-                                        self.d_rng_states, self.dt, self.max_coarse_per_reset, 
-                                        self.g_diff_params, self.g_R, self.g_L_T, self.d_pathwise_diff_para, DT, 
-                                        time_to_change_seed, self.d_rng_states2)
-                    self.cuda_oversimulate_defs(1, self.cDtoH_freq, self.d_def_indicators, 
-                                            self.d_spread_integrals, self.d_exp_1)
+                    self._set_rng_coarse_offset(coarse_idx-1)
+                    with self._span('diffuse_and_price', coarse_idx=coarse_idx):
+                        self.cuda_diffuse_and_price(1, self.cDtoH_freq, t, self.d_X,
+                                            self.d_dom_rate_integral,
+                                            self.d_spread_integrals, self.d_mtm_by_cpty,
+                                            self.d_cash_flows_by_cpty, 
+                                            self.d_cash_pos_by_cpty, 
+                                            self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32,
+                                            self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, 
+                                            self.d_rng_states, self.dt, self.max_coarse_per_reset, 
+                                            self.d_diff_params, self.d_R, self.d_L_T, self.d_pathwise_diff_para, DT, 
+                                            time_to_change_seed, d_rng_states2, antithetic, self.d_outer_zc_tables)
+                    with self._span('oversimulate_defs', coarse_idx=coarse_idx):
+                        if self.default_times:
+                            # the row 1 of the device slice is the coarse step coarse_idx
+                            self.cuda_oversimulate_defs(1, self.cDtoH_freq, coarse_idx-1, self.d_default_steps,
+                                                        self.d_spread_integrals, self.d_exp_1)
+                        else:
+                            self.cuda_oversimulate_defs(1, self.cDtoH_freq, self.d_def_indicators, 
+                                                    self.d_spread_integrals, self.d_exp_1)
                 _cuda_bulk_diffuse_event_end[coarse_idx-1].record(stream=self.stream)
             
             if t > time_to_change_seed:
-                self.cuda_generate_exp1(self.d_exp_1, self.d_rng_states2)
+                with self._span('generate_exp1', coarse_idx=coarse_idx):
+                    self.cuda_generate_exp1(self.d_exp_1, d_rng_states2, antithetic)
 
             if nested_cva_at is not None:
                 _cuda_nested_cva_event_begin[coarse_idx-1].record(stream=self.stream)
                 if coarse_idx in nested_cva_at:
-                    self.cuda_nested_cva(idx_in_dev_arr, self.num_coarse_steps + self.num_early_pricing -coarse_idx, t, self.d_X, self.d_def_indicators, self.d_dom_rate_integral, self.d_spread_integrals, self.d_mtm_by_cpty, self.d_cash_flows_by_cpty, self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, self.d_exp_1, 
-                                         self.d_rng_states if time_to_change_seed> end*self.dT else self.d_rng_states2, self.dt, self.cDtoH_freq, indicator_in_cva, self.d_nested_cva, self.d_nested_cva_sq, DT)
-                    self.d_nested_cva.copy_to_host(ary=self.nested_cva[coarse_idx], stream=self.stream)
-                    self.d_nested_cva_sq.copy_to_host(ary=self.nested_cva_sq[coarse_idx], stream=self.stream)
+                    with self._span('nested_cva', coarse_idx=coarse_idx):
+                        self.cuda_nested_cva(idx_in_dev_arr, self.num_coarse_steps + self.num_early_pricing -coarse_idx, t, self.d_X, self.d_def_indicators, self.d_dom_rate_integral, self.d_spread_integrals, self.d_mtm_by_cpty, self.d_cash_flows_by_cpty, self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, self.d_exp_1, 
+                                             self.d_rng_states if time_to_change_seed> end*self.dT else d_rng_states2, self.dt, self.cDtoH_freq, indicator_in_cva, self.d_nested_cva, self.d_nested_cva_sq, self.d_diff_params, self.d_R, self.d_L_T, DT, self.d_zc_tables)
+                    self._to_host(self.d_nested_cva, self.nested_cva[coarse_idx])
+                    self._to_host(self.d_nested_cva_sq, self.nested_cva_sq[coarse_idx])
                 _cuda_nested_cva_event_end[coarse_idx-1].record(stream=self.stream)
             
             if nested_im_at is not None:
                 _cuda_nested_im_event_begin[coarse_idx-1].record(stream=self.stream)
                 if coarse_idx in nested_im_at:
-                    for adam_iter in range(self.num_adam_iters):
-                        adam_init = adam_iter == 0
-                        step_size = self.lam * (adam_iter + 1)**(-self.gamma)
-                        self.cuda_nested_im(alpha, adam_init, step_size, idx_in_dev_arr, im_window, t, self.d_X, self.d_mtm_by_cpty[idx_in_dev_arr], self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, self.d_rng_states, self.dt, self.d_nested_im_by_cpty, self.d_nested_im_std_by_cpty, self.d_nested_im_m, self.d_nested_im_v, self.adam_b1, self.adam_b2, adam_iter, DT)
-                    self.d_nested_im_by_cpty.copy_to_host(ary=self.nested_im_by_cpty[coarse_idx], stream=self.stream)
-                    self.cuda_nested_im_err(alpha, idx_in_dev_arr, im_window, t, self.d_X, self.d_mtm_by_cpty[idx_in_dev_arr], self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, self.d_rng_states, self.dt, self.d_nested_im_by_cpty, self.d_nested_im_err_by_cpty, DT)
-                    self.d_nested_im_err_by_cpty.copy_to_host(ary=self.nested_im_err_by_cpty[coarse_idx], stream=self.stream)
+                    with self._span('nested_im', coarse_idx=coarse_idx, num_adam_iters=self.num_adam_iters):
+                        for adam_iter in range(self.num_adam_iters):
+                            adam_init = adam_iter == 0
+                            step_size = self.lam * (adam_iter + 1)**(-self.gamma)
+                            self.cuda_nested_im(alpha, adam_init, step_size, idx_in_dev_arr, im_window, t, self.d_X, self.d_mtm_by_cpty[idx_in_dev_arr], self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, self.d_rng_states, self.dt, self.d_nested_im_by_cpty, self.d_nested_im_std_by_cpty, self.d_nested_im_m, self.d_nested_im_v, self.adam_b1, self.adam_b2, adam_iter, self.d_diff_params, self.d_R, self.d_L_T, DT, self.d_zc_tables)
+                    self._to_host(self.d_nested_im_by_cpty, self.nested_im_by_cpty[coarse_idx])
+                    with self._span('nested_im_err', coarse_idx=coarse_idx):
+                        self.cuda_nested_im_err(alpha, idx_in_dev_arr, im_window, t, self.d_X, self.d_mtm_by_cpty[idx_in_dev_arr], self.d_irs_f32, self.d_irs_i32, self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32, self.d_vanillas_on_fx_b8, self.d_rng_states, self.dt, self.d_nested_im_by_cpty, self.d_nested_im_err_by_cpty, self.d_diff_params, self.d_R, self.d_L_T, DT, self.d_zc_tables)
+                    self._to_host(self.d_nested_im_err_by_cpty, self.nested_im_err_by_cpty[coarse_idx])
                 _cuda_nested_im_event_end[coarse_idx-1].record(stream=self.stream)
 
             if coarse_idx % self.cDtoH_freq == 0:
-                self.d_X[self.max_coarse_per_reset:].copy_to_host(
-                    ary=self.X[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                self.d_spread_integrals[1:].copy_to_host(
-                    ary=self.spread_integrals[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                self.d_dom_rate_integral[1:].copy_to_host(
-                    ary=self.dom_rate_integral[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                self.d_def_indicators[1:].copy_to_host(
-                    ary=self.def_indicators[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                self.d_mtm_by_cpty[1:].copy_to_host(
-                    ary=self.mtm_by_cpty[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                self.d_cash_flows_by_cpty[1:].copy_to_host(
-                    ary=self.cash_flows_by_cpty[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                self.d_cash_pos_by_cpty[1:].copy_to_host(
-                    ary=self.cash_pos_by_cpty[coarse_idx-self.cDtoH_freq+1:coarse_idx+1], stream=self.stream)
-                if coarse_idx < end:
-                    self.d_X[:self.max_coarse_per_reset].copy_to_device(
-                        self.d_X[-self.max_coarse_per_reset:], stream=self.stream)
-                    self.d_spread_integrals[0].copy_to_device(
-                        self.d_spread_integrals[self.cDtoH_freq], stream=self.stream)
-                    self.d_dom_rate_integral[0].copy_to_device(
-                        self.d_dom_rate_integral[self.cDtoH_freq], stream=self.stream)
-                    self.d_def_indicators[0].copy_to_device(
-                        self.d_def_indicators[self.cDtoH_freq], stream=self.stream)
-                    self.d_cash_pos_by_cpty[0].copy_to_device(
-                        self.d_cash_pos_by_cpty[self.cDtoH_freq], stream=self.stream)
+                yield coarse_idx-self.cDtoH_freq+1, self.cDtoH_freq
+                if coarse_idx < end and self.double_buffering:
+                    self._swap_slice_buffers()
+                elif coarse_idx < end:
+                    self._to_device(self.d_X[-self.max_coarse_per_reset:], self.d_X[:self.max_coarse_per_reset], 'D2D roll')
+                    self._to_device(self.d_spread_integrals[self.cDtoH_freq], self.d_spread_integrals[0], 'D2D roll')
+                    self._to_device(self.d_dom_rate_integral[self.cDtoH_freq], self.d_dom_rate_integral[0], 'D2D roll')
+                    self._to_device(self.d_def_indicators[self.cDtoH_freq], self.d_def_indicators[0], 'D2D roll')
+                    self._to_device(self.d_cash_pos_by_cpty[self.cDtoH_freq], self.d_cash_pos_by_cpty[0], 'D2D roll')
 
             
 
         if end % self.cDtoH_freq != 0:
             start_idx = (end // self.cDtoH_freq) * self.cDtoH_freq + 1
             length = end % self.cDtoH_freq
-            self.d_X[self.max_coarse_per_reset:self.max_coarse_per_reset+length].copy_to_host(
-                ary=self.X[start_idx:start_idx+length], stream=self.stream)
-            self.d_spread_integrals[1:length+1].copy_to_host(
-                ary=self.spread_integrals[start_idx:start_idx+length], stream=self.stream)
-            self.d_dom_rate_integral[1:length+1].copy_to_host(
-                ary=self.dom_rate_integral[start_idx:start_idx+length], stream=self.stream)
-            self.d_def_indicators[1:length+1].copy_to_host(
-                ary=self.def_indicators[start_idx:start_idx+length], stream=self.stream)
-            self.d_mtm_by_cpty[1:length+1].copy_to_host(
-                ary=self.mtm_by_cpty[start_idx:start_idx+length], stream=self.stream)
-            self.d_cash_flows_by_cpty[1:length+1].copy_to_host(
-                ary=self.cash_flows_by_cpty[start_idx:start_idx+length], stream=self.stream)
-            self.d_cash_pos_by_cpty[1:length+1].copy_to_host(
-                ary=self.cash_pos_by_cpty[start_idx:start_idx+length], stream=self.stream)
+            yield start_idx, length
+
+        if self.default_times:
+            # steps beyond end may be recorded by the last slice, they are reset to NO_DEFAULT_STEP on the host
+            self._to_host(self.d_default_steps, self.default_steps)
 
         if verbose:
             print('Everything was successfully queued!')
         
-        for evt_cuda_bulk_diffuse_event, evt_cuda_compute_mtm_event, evt_cuda_nested_cva_event, evt_cuda_nested_im_event in zip(_cuda_bulk_diffuse_event_end, _cuda_compute_mtm_event_end, _cuda_nested_cva_event_end, _cuda_nested_im_event_end):
-            evt_cuda_bulk_diffuse_event.synchronize()
-            evt_cuda_compute_mtm_event.synchronize()
-            evt_cuda_nested_cva_event.synchronize()
-            evt_cuda_nested_im_event.synchronize()
-        
-        self.stream.synchronize()
+        # all the events are recorded on self.stream
+        self._synchronize()
+        if self.default_times:
+            self.default_steps[self.default_steps > end] = NO_DEFAULT_STEP
         
         if not fused:
-            print('cuda_bulk_diffuse average elapsed time per launch: {0} ms'.format(round(sum(cuda.event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_bulk_diffuse_event_begin, _cuda_bulk_diffuse_event_end))/end, 3)))
-            print('compute_mtm average elapsed time per launch: {0} ms'.format(round(sum(cuda.event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_compute_mtm_event_begin, _cuda_compute_mtm_event_end))/end, 3)))
+            print('cuda_bulk_diffuse average elapsed time per launch: {0} ms'.format(round(sum(self._event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_bulk_diffuse_event_begin, _cuda_bulk_diffuse_event_end))/end, 3)))
+            print('compute_mtm average elapsed time per launch: {0} ms'.format(round(sum(self._event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_compute_mtm_event_begin, _cuda_compute_mtm_event_end))/end, 3)))
         else:
-            print('cuda_diffuse_and_price elapsed time: {0} ms'.format(round(sum(cuda.event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_bulk_diffuse_event_begin, _cuda_bulk_diffuse_event_end)), 3)))
+            print('cuda_diffuse_and_price elapsed time: {0} ms'.format(round(sum(self._event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_bulk_diffuse_event_begin, _cuda_bulk_diffuse_event_end)), 3)))
         
         if nested_cva_at is not None:
-            print('cuda_nested_cva average elapsed time per launch: {0} ms'.format(round(sum(cuda.event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_nested_cva_event_begin, _cuda_nested_cva_event_end))/len(nested_cva_at), 3)))
+            print('cuda_nested_cva average elapsed time per launch: {0} ms'.format(round(sum(self._event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_nested_cva_event_begin, _cuda_nested_cva_event_end))/len(nested_cva_at), 3)))
         
         if nested_im_at is not None:
-            print('cuda_nested_im average elapsed time per launch: {0} ms'.format(round(sum(cuda.event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_nested_im_event_begin, _cuda_nested_im_event_end))/len(nested_im_at), 3)))
+            print('cuda_nested_im average elapsed time per launch: {0} ms'.format(round(sum(self._event_elapsed_time(evt_begin, evt_end) for evt_begin, evt_end in zip(_cuda_nested_im_event_begin, _cuda_nested_im_event_end))/len(nested_im_at), 3)))
     
     def single_step_diffuse_and_price(self, coarse_idx):
         t = (coarse_idx+1)*self.dT
@@ -630,13 +1204,14 @@ class DiffusionEngine:
     
     def reset_rng_states(self, seed):
         self.seed = seed
-        self.d_rng_states = create_xoroshiro128p_states(self.num_paths*(self.num_defs_per_path+self.num_inner_paths), seed=seed)
+        self._rng_batch_idx = 0
+        self.d_rng_states = self._restore_rng_states(self.d_rng_states, seed)
 
     def note_use_generate_early_pricing_date(self, early_pricing_date, verbose=False, fused=False, nested_cva_at=None, nested_im_at=None, indicator_in_cva=False, alpha=None, im_window=None):
         end = 1
         t = 0.
         self._reset()
-        self.cuda_generate_exp1(self.d_exp_1, self.d_rng_states)
+        self.cuda_generate_exp1(self.d_exp_1, self.d_rng_states, False)
         self.stream.synchronize()
         self.cuda_compute_mtm(0, t, self.d_X, self.d_mtm_by_cpty, self.d_cash_flows_by_cpty,
                               self.d_vanillas_on_fx_f32, self.d_vanillas_on_fx_i32,
@@ -0,0 +1,93 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Coarse-step transitions of the outer diffusion, used with scheme='exact'.
+#
+# Over a step of length h, with W the correlated Brownian motions, the Vasicek short rates
+# dr_i = a_i(b_i - r_i)dt + sigma_i(dW_i + adj_i dt) (adj_i being the drift adjustment of the foreign rates)
+# and their integrals are exactly
+#     r_i(h) = r_i e^{-a_i h} + b'_i (1 - e^{-a_i h}) + sigma_i I_i
+#     int_0^h r_i = r_i phi_i + b'_i (h - phi_i) + sigma_i (W_i(h) - I_i) / a_i
+# with b'_i = b_i + sigma_i adj_i / a_i, phi_i = (1 - e^{-a_i h}) / a_i and I_i = int_0^h e^{-a_i(h-s)} dW_i(s).
+# Writing I_i = (phi_i / h) W_i(h) + e_i, the residuals e_i are uncorrelated with all the W_j(h), and
+#     Cov(e_i, e_j) = rho_ij ((1 - e^{-(a_i+a_j) h}) / (a_i+a_j) - phi_i phi_j / h)
+# so that the rates, their integrals and the log FX rates (whose drift only involves the rate integrals) are
+# sampled exactly from the Brownian increments W(h) of all the factors, correlated as in the Euler scheme, and
+# num_rates additional independent normals.
+#
+# The CIR intensities use the quadratic-exponential scheme of Andersen, "Simple and efficient simulation of
+# the Heston stochastic volatility model" (J. Comput. Finance 2008), which matches the first two moments of the
+# exact non-central chi-square transition and stays non-negative, driven by the correlated increment of their
+# Brownian motion; their integrals use the trapezoidal rule over the coarse step.
+
+import math
+from numba import jit
+
+
+@jit(forceinline=True)
+def _phi(a, h):
+    return -math.expm1(-a*h) / a
+
+
+@jit(forceinline=True)
+def vasicek_residual_cholesky(diff_params, R, num_rates, num_diffusions, h, out):
+    # lower-triangular Cholesky factor (packed by rows) of the covariance of the residuals e_i, where R holds the
+    # upper-triangular entries of the correlation matrix; computed in double precision as the covariance is a
+    # small difference of two terms
+    for i in range(num_rates):
+        a_i = float(diff_params[i])
+        for j in range(i+1):
+            a_j = float(diff_params[j])
+            s = R[j*num_diffusions-j*(j+1)//2+i] * (_phi(a_i+a_j, h) - _phi(a_i, h)*_phi(a_j, h)/h)
+            for k in range(j):
+                s -= out[i*(i+1)//2+k] * out[j*(j+1)//2+k]
+            if i == j:
+                out[i*(i+1)//2+j] = math.sqrt(max(s, 0.))
+            elif out[j*(j+1)//2+j] > 0:
+                out[i*(i+1)//2+j] = s / out[j*(j+1)//2+j]
+            else:
+                out[i*(i+1)//2+j] = 0
+
+
+@jit(forceinline=True)
+def vasicek_step(r, a, b, sigma, h, w, e):
+    # short rate at the end of the step and its integral over the step, given the Brownian increment w and
+    # the residual e of the stochastic integral
+    phi = _phi(a, h)
+    I = phi / h * w + e
+    return r*math.exp(-a*h) + b*a*phi + sigma*I, r*phi + b*(h - phi) + sigma*(w - I)/a
+
+
+@jit(forceinline=True)
+def cir_qe_step(v, kappa, theta, eps, h, z):
+    # intensity at the end of the step, z being the standard normal driving the step
+    ekh = math.exp(-kappa*h)
+    m = theta + (v - theta)*ekh
+    if m <= 0:
+        return 0.
+    s2 = v*eps*eps*ekh*(1 - ekh)/kappa + theta*eps*eps*(1 - ekh)*(1 - ekh)/(2*kappa)
+    if s2 <= 0:
+        return m
+    psi = s2 / (m*m)
+    if psi <= 1.5:
+        b2 = 2/psi - 1 + math.sqrt(2/psi)*math.sqrt(2/psi - 1)
+        return m/(1 + b2) * (math.sqrt(b2) + z)**2
+    p = (psi - 1)/(psi + 1)
+    u = 0.5*math.erfc(-z/math.sqrt(2.))
+    if u <= p:
+        return 0.
+    return m*(1 + psi)/2 * math.log((1 - p)/(1 - u))
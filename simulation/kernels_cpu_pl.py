@@ -0,0 +1,1297 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+# Copyright 2021 Bouazza SAADEDDINE
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# CPU ports of the kernels in kernels_pl.py. Each factory returns a function taking exactly the same
+# positional arguments as the corresponding launched CUDA kernel, so that DiffusionEngine can call
+# them interchangeably. One CUDA thread becomes one iteration of a prange loop over the paths; the
+# xoroshiro128p streams are indexed the same way as on the GPU, hence both backends consume the same
+# random numbers (the same holds for the counter-based generator of philox_pl.py, with rng='philox').
+
+import math
+import numba as nb
+import numpy as np
+from numba.cuda.random import xoroshiro128p_uniform_float32, xoroshiro128p_dtype
+from simulation.sobol_pl import sobol_bridge_point
+from simulation.exact_pl import vasicek_residual_cholesky, vasicek_step, cir_qe_step
+from simulation.correlation_pl import compile_correlate
+from simulation.compact_pl import encode_float16, encode_bfloat16, encode_int16, int16_scale_offset
+from simulation.philox_pl import philox4x32_10, philox_uniform_float32_pair, PHILOX_EXP1, PHILOX_OUTER, PHILOX_NESTED_CVA, PHILOX_NESTED_IM, PHILOX_NESTED_IM_ERR, PHILOX_NUM_STREAMS, PHILOX_PARAMS
+from simulation.shocks_pl import permute_stratum, stratified_normal
+
+# cache blocking of the swaps with large_portfolio (see compile_cpu_diffuse_and_price): a tile of 512 swaps (14 KB
+# of specs) stays in the L1/L2 cache while it is priced for a block of 32 paths
+LARGE_PORTFOLIO_TRADE_TILE = 512
+LARGE_PORTFOLIO_PATH_BLOCK = 32
+
+
+def compile_cpu_generate_exp1(num_spreads, num_defs_per_path, num_paths, rng='xoroshiro128p', cache=False):
+
+    num_names = num_spreads - 1
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.float32[:, :, :], rng_type, nb.bool_)
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_generate_exp1(out, rng_states, antithetic):
+        for pos in nb.prange(num_paths):
+            for j in range(num_defs_per_path):
+                for i in range(num_names):
+                    if counter_based:
+                        if antithetic:
+                            # mirrored uniform of the even path of the pair, still in (0, 1]
+                            u, _ = philox_uniform_float32_pair(rng_states, pos - pos % 2, j, i, PHILOX_EXP1)
+                            if pos % 2:
+                                u = nb.float32(1) - u + nb.float32(5.9604644775390625e-08)
+                        else:
+                            u, _ = philox_uniform_float32_pair(rng_states, pos, j, i, PHILOX_EXP1)
+                    else:
+                        u = xoroshiro128p_uniform_float32(rng_states, j*num_paths+pos)
+                    out[i, j, pos] = -math.log(u)
+
+    # returning the compiled kernel
+    return _cpu_generate_exp1
+
+
+def compile_cpu_gen_diff_params(num_params, num_paths, sampling='normal', cache=False):
+    # see compile_cuda_gen_diff_params
+    bump = sampling == 'bump'
+    lhs = sampling == 'lhs'
+    stratified = sampling == 'stratified'
+
+    sig = (nb.float32[:, :], nb.float32[:], nb.uint32[:], nb.int32[:], nb.float32[:], nb.int32[:], nb.int32, nb.int32, nb.int32)
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_gen_diff_params(out, base_params, rng_key, rows, row_scales, group_starts, batch_size, first_path, num_run_paths):
+        num_groups = group_starts.shape[0] - 1
+        # the base parameters by rows, contiguous on the host, then the shocked ones path by path
+        for i in nb.prange(num_params):
+            out[i, :] = base_params[i]
+        for pos in nb.prange(num_paths):
+            g = min((first_path + pos) // batch_size, num_groups - 1)
+            k = first_path + pos - g*batch_size
+            n = batch_size if g < num_groups - 1 else num_run_paths - g*batch_size
+            for j in range(group_starts[g], group_starts[g+1]):
+                if bump:
+                    z = 1.
+                else:
+                    u, v = philox_uniform_float32_pair(rng_key, pos, j, 0, PHILOX_PARAMS)
+                    if lhs or (stratified and j == group_starts[g]):
+                        key, _, _, _ = philox4x32_10(rng_key[0], rng_key[1], 0, j, 1, PHILOX_PARAMS)
+                        z = stratified_normal(permute_stratum(k, n, key), n, u)
+                    else:
+                        z = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v)
+                row = rows[j]
+                out[row, pos] = base_params[row] + nb.float32(row_scales[j] * z) * base_params[row]
+
+    return _cpu_gen_diff_params
+
+
+def compile_cpu_diffuse_and_price(g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_paths, params_in_const=True, rng='xoroshiro128p', scheme='euler', active_trades=False, large_portfolio=False, pathwise_params=True, corr_pattern=None, num_factors=0, cache=False):
+    # compile-time constants
+    num_cpty = num_spreads - 1
+    num_diffusions = 2*num_rates+num_spreads-1
+    fx_start = num_rates
+    fx_params_start = 3*num_rates
+    drift_adj_start = 4*num_rates - 1
+    spread_start = fx_start + num_rates - 1
+    # correlation of the independent normals of a step, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, num_diffusions, corr_pattern, num_factors)
+    num_draws = num_diffusions + num_factors
+    spread_params_start = fx_params_start + 2*num_rates - 2
+
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, see compile_cuda_diffuse_and_price
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    quasi_random = rng == 'sobol'
+    # 'euler': num_fine_per_coarse Euler steps per coarse step, 'exact': one exact (Vasicek, FX) or
+    # moment-matched (CIR) transition per coarse step, see exact_pl.py
+    exact = scheme == 'exact'
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], rng_type, nb.float32, nb.int32, nb.float32[:], nb.float32[:], nb.float32[:], nb.float32[:, :], nb.float32, nb.float32, rng_type, nb.bool_, nb.float32[:, :, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_bulk_diffuse_and_price(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, max_coarse_per_reset, d_diff_params, d_R, d_L_T, d_pathwise_diff_params, DT, time_to_change_seed, rng_states2, antithetic, zc_tables):
+        if params_in_const:
+            R = g_R
+            L_T = g_L_T
+            base_diff_params = g_diff_params
+        else:
+            R = d_R
+            L_T = d_L_T
+            base_diff_params = d_diff_params
+        sqrt_dt = math.sqrt(dt)
+
+        for pos in nb.prange(num_paths):
+            # same as on the GPU, the diffusion parameters are read from the pathwise array with pathwise_params
+            if pathwise_params:
+                diff_params = d_pathwise_diff_params[num_diffusions:, pos]
+            else:
+                diff_params = base_diff_params
+            dW_corr = np.empty(num_diffusions, np.float32)
+            tmp_X = np.empty(num_diffusions, np.float32)
+            tmp_spread_integrals = np.empty(num_spreads, np.float32)
+            tmp_mtm_by_cpty = np.empty(num_cpty, np.float32)
+            tmp_cash_flows_by_cpty = np.empty(num_cpty, np.float32)
+            tmp_cash_pos_by_cpty = np.empty(num_cpty, np.float32)
+            sobol_W = np.empty(num_diffusions, np.float32)
+            bridge_rem = np.empty(num_diffusions, np.float32)
+            res_chol = np.empty(num_rates*(num_rates+1)//2, np.float32)
+            res_z = np.empty(num_rates, np.float32)
+            rate_integrals = np.empty(num_rates, np.float32)
+            t_ = t
+
+            # antithetic pairs, see compile_cuda_diffuse_and_price
+            rng_pos = pos - pos % 2 if antithetic else pos
+            sign = -1 if antithetic and pos % 2 else 1
+
+            for i in range(num_diffusions):
+                tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-2, i, pos]
+
+            for i in range(num_spreads):
+                tmp_spread_integrals[i] = spread_integrals[coarse_start_idx - 1, i, pos]
+
+            for i in range(num_cpty):
+                tmp_cash_pos_by_cpty[i] = cash_pos_by_cpty[coarse_start_idx - 1, i, pos]
+
+            prev_seed_changed = False
+            res_chol_num_fine = -1
+            for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                tmp_dom_rate_integral = 0.
+                for i in range(num_rates-1):
+                    tmp_X[fx_start+i] = math.log(tmp_X[fx_start+i])
+
+                if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                    num_fine = int((t_-0.01*dt)//dt)+1
+                elif (DT != 0.) and (coarse_idx == coarse_start_idx+1):
+                    num_fine = int((DT-0.01*dt)//dt)
+                else:
+                    num_fine = num_fine_per_coarse
+
+                if quasi_random:
+                    # coarse increments of the scrambled Sobol Brownian bridge, see compile_cuda_diffuse_and_price
+                    seed_changed = t_ > time_to_change_seed
+                    sqrt_dT = math.sqrt(num_fine*dt)
+                    for i in range(num_diffusions):
+                        if coarse_idx == coarse_start_idx or seed_changed != prev_seed_changed:
+                            sobol_W[i] = sobol_bridge_point(rng_states if t_ <= time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx-1, i)
+                        w = sobol_bridge_point(rng_states if t_ <= time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx, i)
+                        bridge_rem[i] = (w - sobol_W[i]) * sqrt_dT
+                        sobol_W[i] = w
+                    prev_seed_changed = seed_changed
+
+                if exact:
+                    # exact transition over the coarse step (see exact_pl.py): the correlated Brownian increments of all
+                    # the factors over the step, then the independent normals driving the residuals of the Vasicek integrals
+                    h = num_fine*dt
+                    sqrt_h = math.sqrt(h)
+                    if num_fine != res_chol_num_fine:
+                        vasicek_residual_cholesky(diff_params, R, num_rates, num_diffusions, h, res_chol)
+                        res_chol_num_fine = num_fine
+                    for i in range(num_diffusions):
+                        dW_corr[i] = 0
+                    for i in range(num_draws+num_rates):
+                        if quasi_random and i < num_diffusions:
+                            # coarse increment of the Sobol Brownian bridge
+                            v = bridge_rem[i]
+                        else:
+                            if counter_based:
+                                u, v = philox_uniform_float32_pair(rng_states if t_ <= time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx, i, PHILOX_OUTER)
+                            elif t_ <= time_to_change_seed:
+                                u = xoroshiro128p_uniform_float32(rng_states, pos)
+                                v = xoroshiro128p_uniform_float32(rng_states, pos)
+                            else:
+                                u = xoroshiro128p_uniform_float32(rng_states2, pos)
+                                v = xoroshiro128p_uniform_float32(rng_states2, pos)
+                            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v)
+                            if i < num_draws:
+                                v *= sqrt_h
+                        v *= sign
+                        if i < num_draws:
+                            correlate(dW_corr, L_T, i, v)
+                        else:
+                            res_z[i-num_draws] = v
+                    # correlated residuals, computed in place
+                    for i in range(num_rates-1, -1, -1):
+                        e = 0.
+                        for j in range(i+1):
+                            e += res_chol[i*(i+1)//2+j] * res_z[j]
+                        res_z[i] = e
+
+                    # rate diffusions, jointly with their integrals
+                    for i in range(num_rates):
+                        a = diff_params[i]
+                        sigma = diff_params[2*num_rates+i]
+                        b = diff_params[num_rates+i]
+                        if i != 0:
+                            b += sigma * diff_params[drift_adj_start+i-1] / a
+                        r, r_integral = vasicek_step(tmp_X[i], a, b, sigma, h, dW_corr[i], res_z[i])
+                        tmp_X[i] = r
+                        rate_integrals[i] = r_integral
+                    tmp_dom_rate_integral = rate_integrals[0]
+
+                    # FX log-diffusions, whose drift only involves the rate integrals
+                    for i in range(num_rates-1):
+                        tmp_X[fx_start+i] += rate_integrals[0] - rate_integrals[i+1] - 0.5*diff_params[fx_params_start+i]**2 * h + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
+
+                    # spread diffusions
+                    for i in range(num_spreads):
+                        spread = tmp_X[spread_start+i]
+                        tmp_X[spread_start+i] = cir_qe_step(spread, diff_params[spread_params_start+i], diff_params[spread_params_start+num_spreads+i], diff_params[spread_params_start+2*num_spreads+i], h, dW_corr[spread_start+i] / sqrt_h)
+                        tmp_spread_integrals[i] += 0.5 * (spread + tmp_X[spread_start+i]) * h
+                else:
+                    for fine_idx in range(num_fine):
+                        for i in range(num_diffusions):
+                            dW_corr[i] = 0
+
+                        for i in range(num_draws):
+                            if counter_based:
+                                u, v = philox_uniform_float32_pair(rng_states if t_ <= time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx, fine_idx*num_draws+i, PHILOX_OUTER)
+                            elif t_ <= time_to_change_seed:
+                                u = xoroshiro128p_uniform_float32(rng_states, pos)
+                                v = xoroshiro128p_uniform_float32(rng_states, pos)
+                            else:
+                                u = xoroshiro128p_uniform_float32(rng_states2, pos)
+                                v = xoroshiro128p_uniform_float32(rng_states2, pos)
+                            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
+                            if quasi_random:
+                                v = bridge_rem[i] / (num_fine-fine_idx) + v * math.sqrt((num_fine-fine_idx-1) / (num_fine-fine_idx))
+                                bridge_rem[i] -= v
+                            v *= sign
+                            correlate(dW_corr, L_T, i, v)
+
+                        # FX log-diffusions
+                        for i in range(num_rates-1):
+                            tmp_X[fx_start+i] += (tmp_X[0] - tmp_X[i+1] - 0.5*diff_params[fx_params_start+i]**2) * dt + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
+
+                        # rate diffusions
+                        tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                        for i in range(num_rates):
+                            tmp_X[i] += diff_params[i] * (diff_params[num_rates+i] - tmp_X[i]) * dt
+                            drift_adj = np.float32(0)
+                            if i != 0:
+                                drift_adj = diff_params[drift_adj_start+i-1]
+                            tmp_X[i] += diff_params[2*num_rates+i] * (dW_corr[i] + drift_adj * dt)
+
+                        tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                        # spread diffusions
+                        for i in range(num_spreads):
+                            pos_spread = max(tmp_X[spread_start+i], 0)
+                            tmp_X[spread_start+i] += diff_params[spread_params_start+i] * (diff_params[spread_params_start+num_spreads+i] - pos_spread) * dt
+                            tmp_X[spread_start+i] += diff_params[spread_params_start+2*num_spreads+i] * math.sqrt(pos_spread) * dW_corr[spread_start+i]
+                            tmp_spread_integrals[i] += 0.5 * pos_spread * dt
+                            if tmp_X[spread_start+i] > 0:
+                                tmp_spread_integrals[i] += 0.5 * tmp_X[spread_start+i] * dt
+
+                for i in range(num_rates-1):
+                    tmp_X[fx_start+i] = math.exp(tmp_X[fx_start+i])
+
+                if not large_portfolio:
+                    for cpty in range(num_cpty):
+                        tmp_mtm_by_cpty[cpty] = 0
+                        tmp_cash_flows_by_cpty[cpty] = 0
+
+                    num_irs = _cpu_num_live_irs(irs_f32, irs_i32, t_, dt) if active_trades else irs_f32.shape[0]
+                    for j in range(num_irs):
+                        first_reset = irs_f32[j, 0]
+                        reset_freq = irs_f32[j, 1]
+                        num_resets = irs_i32[j, 0]
+                        if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t_:
+                            continue
+                        notional = irs_f32[j, 2]
+                        cpty = irs_i32[j, 1]
+                        ccy = irs_i32[j, 2]
+                        fx = np.float32(1)
+                        if ccy != 0:
+                            fx = tmp_X[num_rates + ccy - 1]
+                        a = diff_params[ccy]
+                        b = diff_params[num_rates+ccy]
+                        sigma = diff_params[2*num_rates+ccy]
+                        swap_rate = irs_f32[j, 3]
+                        if t_ > first_reset - 0.1*dt:
+                            m = int((t_ - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                            m = int((t_-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                        else:
+                            m = 1
+                        r_prev_reset = X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos]
+                        price = _cpu_price_irs(ccy, swap_rate, r_prev_reset, tmp_X[ccy], t_, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
+                        tmp_mtm_by_cpty[cpty] += notional * fx * price
+                        k = int((t_-first_reset+0.1*dt)/reset_freq)
+                        is_coupon_date = (k >= 1) and (abs(t_-first_reset-k*reset_freq) < 0.1*dt)
+                        if is_coupon_date:
+                            tmp_cash_flows_by_cpty[cpty] += notional * fx * (_cpu_price_zc_bond_inv_tab(ccy, r_prev_reset, reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq)
+
+                for i in range(num_diffusions):
+                    X[coarse_idx+max_coarse_per_reset-1, i, pos] = tmp_X[i]
+
+                for i in range(num_spreads):
+                    spread_integrals[coarse_idx, i, pos] = tmp_spread_integrals[i]
+
+                dom_rate_integral[coarse_idx, pos] = dom_rate_integral[coarse_idx-1, pos] + tmp_dom_rate_integral
+
+                if not large_portfolio:
+                    for cpty in range(num_cpty):
+                        mtm_by_cpty[coarse_idx, cpty, pos] = tmp_mtm_by_cpty[cpty]
+                        cash_flows_by_cpty[coarse_idx, cpty, pos] = tmp_cash_flows_by_cpty[cpty]
+                        tmp_cash_pos_by_cpty[cpty] *= math.exp(tmp_dom_rate_integral)
+                        tmp_cash_pos_by_cpty[cpty] += tmp_cash_flows_by_cpty[cpty]
+                        cash_pos_by_cpty[coarse_idx, cpty, pos] = tmp_cash_pos_by_cpty[cpty]
+
+                if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                    t_ += DT
+                else:
+                    t_ += dt * num_fine_per_coarse
+
+    if not large_portfolio:
+        # finally, return the compiled kernel
+        return _cpu_bulk_diffuse_and_price
+
+    # with large_portfolio, the swaps are priced once the slice is diffused, by blocks of LARGE_PORTFOLIO_PATH_BLOCK
+    # paths, so that each tile of LARGE_PORTFOLIO_TRADE_TILE swaps is read from memory once per block of paths
+    # instead of once per path (the paths of the slice being already stored in X); the swaps are grouped by
+    # counterparty, whose MtM and cash flows are accumulated directly
+    price_sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32, nb.int32, nb.float32[:], nb.float32[:, :], nb.float32, nb.float32[:, :, :])
+
+    @nb.njit(price_sig, parallel=True, cache=cache)
+    def _cpu_price_by_path_blocks(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, dt, max_coarse_per_reset, d_diff_params, d_pathwise_diff_params, DT, zc_tables):
+        if params_in_const:
+            base_diff_params = g_diff_params
+        else:
+            base_diff_params = d_diff_params
+        for path_block in nb.prange((num_paths+LARGE_PORTFOLIO_PATH_BLOCK-1)//LARGE_PORTFOLIO_PATH_BLOCK):
+            pos_start = path_block * LARGE_PORTFOLIO_PATH_BLOCK
+            pos_end = min(pos_start + LARGE_PORTFOLIO_PATH_BLOCK, num_paths)
+            block_mtm = np.empty(LARGE_PORTFOLIO_PATH_BLOCK, np.float32)
+            block_cash_flows = np.empty(LARGE_PORTFOLIO_PATH_BLOCK, np.float32)
+            t_ = t
+
+            for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                for cpty in range(num_cpty):
+                    cpty_start = _cpu_lower_bound(irs_i32, 1, cpty, 0, irs_i32.shape[0])
+                    cpty_end = _cpu_lower_bound(irs_i32, 1, cpty+1, cpty_start, irs_i32.shape[0])
+                    if active_trades:
+                        cpty_end = _cpu_live_irs_end(irs_f32, irs_i32, cpty_start, cpty_end, t_, dt)
+                    for i in range(pos_end-pos_start):
+                        block_mtm[i] = 0
+                        block_cash_flows[i] = 0
+
+                    for tile_start in range(cpty_start, cpty_end, LARGE_PORTFOLIO_TRADE_TILE):
+                        tile_end = min(tile_start + LARGE_PORTFOLIO_TRADE_TILE, cpty_end)
+                        for pos in range(pos_start, pos_end):
+                            if pathwise_params:
+                                diff_params = d_pathwise_diff_params[num_diffusions:, pos]
+                            else:
+                                diff_params = base_diff_params
+                            for j in range(tile_start, tile_end):
+                                first_reset = irs_f32[j, 0]
+                                reset_freq = irs_f32[j, 1]
+                                num_resets = irs_i32[j, 0]
+                                if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t_:
+                                    continue
+                                notional = irs_f32[j, 2]
+                                ccy = irs_i32[j, 2]
+                                fx = np.float32(1)
+                                if ccy != 0:
+                                    fx = X[coarse_idx+max_coarse_per_reset-1, num_rates + ccy - 1, pos]
+                                a = diff_params[ccy]
+                                b = diff_params[num_rates+ccy]
+                                sigma = diff_params[2*num_rates+ccy]
+                                swap_rate = irs_f32[j, 3]
+                                if t_ > first_reset - 0.1*dt:
+                                    m = int((t_ - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                                    m = int((t_-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                                else:
+                                    m = 1
+                                r_prev_reset = X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos]
+                                price = _cpu_price_irs(ccy, swap_rate, r_prev_reset, X[coarse_idx+max_coarse_per_reset-1, ccy, pos], t_, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
+                                block_mtm[pos-pos_start] += notional * fx * price
+                                k = int((t_-first_reset+0.1*dt)/reset_freq)
+                                is_coupon_date = (k >= 1) and (abs(t_-first_reset-k*reset_freq) < 0.1*dt)
+                                if is_coupon_date:
+                                    block_cash_flows[pos-pos_start] += notional * fx * (_cpu_price_zc_bond_inv_tab(ccy, r_prev_reset, reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq)
+
+                    for pos in range(pos_start, pos_end):
+                        mtm_by_cpty[coarse_idx, cpty, pos] = block_mtm[pos-pos_start]
+                        cash_flows_by_cpty[coarse_idx, cpty, pos] = block_cash_flows[pos-pos_start]
+
+                # the cash positions grow at the domestic rate integral of the step, recovered from the stored integrals
+                for pos in range(pos_start, pos_end):
+                    growth = math.exp(dom_rate_integral[coarse_idx, pos] - dom_rate_integral[coarse_idx-1, pos])
+                    for cpty in range(num_cpty):
+                        cash_pos_by_cpty[coarse_idx, cpty, pos] = cash_pos_by_cpty[coarse_idx-1, cpty, pos] * growth + cash_flows_by_cpty[coarse_idx, cpty, pos]
+
+                if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                    t_ += DT
+                else:
+                    t_ += dt * num_fine_per_coarse
+
+    def _cpu_bulk_diffuse_then_price(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, max_coarse_per_reset, d_diff_params, d_R, d_L_T, d_pathwise_diff_params, DT, time_to_change_seed, rng_states2, antithetic, zc_tables):
+        _cpu_bulk_diffuse_and_price(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, max_coarse_per_reset, d_diff_params, d_R, d_L_T, d_pathwise_diff_params, DT, time_to_change_seed, rng_states2, antithetic, zc_tables)
+        _cpu_price_by_path_blocks(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, dt, max_coarse_per_reset, d_diff_params, d_pathwise_diff_params, DT, zc_tables)
+
+    # finally, return the kernels, run one after the other
+    return _cpu_bulk_diffuse_then_price
+
+
+def compile_cpu_oversimulate_defs(num_spreads, num_defs_per_path, num_paths, default_times=False, cache=False):
+    # compile-time constants
+    num_cpty = num_spreads - 1
+
+    if default_times:
+        sig = (nb.int32, nb.int32, nb.int32, nb.int16[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :])
+
+        @nb.njit(sig, parallel=True, cache=cache)
+        def _cpu_oversimulate_default_steps(coarse_start_idx, num_coarse_steps, step_offset, default_steps, spread_integrals, exp_1):
+            for pos in nb.prange(num_paths):
+                for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                    for i in range(num_cpty):
+                        s = spread_integrals[coarse_idx, i+1, pos]
+                        for j in range(num_defs_per_path):
+                            if s > exp_1[i, j, pos] and default_steps[i, j, pos] > step_offset+coarse_idx:
+                                default_steps[i, j, pos] = step_offset+coarse_idx
+
+        return _cpu_oversimulate_default_steps
+
+    sig = (nb.int32, nb.int32, nb.int8[:, :, :, :], nb.float32[:, :, :], nb.float32[:, :, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_oversimulate_defs(coarse_start_idx, num_coarse_steps, def_indicators, spread_integrals, exp_1):
+        for pos in nb.prange(num_paths):
+            for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                for i in range(num_cpty):
+                    s = spread_integrals[coarse_idx, i+1, pos]
+                    q = i // 8
+                    r = i % 8
+                    for j in range(num_defs_per_path):
+                        if s > exp_1[i, j, pos]:
+                            # no common-shock this time
+                            def_indicators[coarse_idx, q, j, pos] |= (1 << r)
+
+    # finally, return the compiled kernel
+    return _cpu_oversimulate_defs
+
+
+def compile_cpu_encode_paths(num_paths, storage_dtype='float16', cache=False):
+    quantized = storage_dtype == 'int16'
+    half = storage_dtype == 'float16'
+
+    sig = (nb.float32[:, :, :], nb.int16[:, :, :], nb.float32[:, :], nb.float32[:, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_encode_paths(src, codes, scale, offset):
+        bits = src.view(np.uint32)
+        num_factors = src.shape[1]
+        for k in nb.prange(src.shape[0]*num_factors):
+            d = k // num_factors
+            f = k % num_factors
+            sc = 0.
+            off = 0.
+            inv_sc = 0.
+            if quantized:
+                lo = math.inf
+                hi = -math.inf
+                for pos in range(num_paths):
+                    lo = min(lo, src[d, f, pos])
+                    hi = max(hi, src[d, f, pos])
+                sc, off = int16_scale_offset(lo, hi)
+                # the codes are computed with the scale and offset as stored
+                sc = nb.float32(sc)
+                off = nb.float32(off)
+                inv_sc = 1/sc if sc > 0 else 0.
+                scale[d, f] = sc
+                offset[d, f] = off
+            for pos in range(num_paths):
+                if quantized:
+                    codes[d, f, pos] = encode_int16(src[d, f, pos], inv_sc, off)
+                elif half:
+                    codes[d, f, pos] = encode_float16(bits[d, f, pos])
+                else:
+                    codes[d, f, pos] = encode_bfloat16(bits[d, f, pos])
+
+    return _cpu_encode_paths
+
+
+def compile_cpu_nested_cva(g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, params_in_const=True, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
+    # compile-time constants
+    num_cpty = num_spreads - 1
+    num_cpty_buckets = (num_cpty+7)//8
+    num_diffusions = 2*num_rates+num_spreads-1
+    fx_start = num_rates
+    fx_params_start = 3*num_rates
+    drift_adj_start = 4*num_rates - 1
+    spread_start = fx_start + num_rates - 1
+    # correlation of the independent normals of a step, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, num_diffusions, corr_pattern, num_factors)
+    num_draws = num_diffusions + num_factors
+    spread_params_start = fx_params_start + 2*num_rates - 2
+
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, see compile_cuda_diffuse_and_price
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.int8[:, :, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], nb.float32[:, :, :], rng_type, nb.float32, nb.int32, nb.bool_, nb.float32[:, :], nb.float32[:, :], nb.float32[:], nb.float32[:], nb.float32[:], nb.float32, nb.float32[:, :, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_nested_cva(coarse_start_idx, num_coarse_steps, t, X, def_indicators, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, exp_1, rng_states, dt, window_length, indicator_in_cva, out1, out2, d_diff_params, d_R, d_L_T, DT, zc_tables):
+        if params_in_const:
+            diff_params = g_diff_params
+            R = g_R
+            L_T = g_L_T
+        else:
+            diff_params = d_diff_params
+            R = d_R
+            L_T = d_L_T
+        sqrt_dt = math.sqrt(dt)
+        rng_stream = 0
+        if counter_based:
+            # coarse_start_idx is local to the device arrays, rng_states[3] holds the global index preceding them
+            rng_stream = PHILOX_NESTED_CVA + PHILOX_NUM_STREAMS*(rng_states[3]+coarse_start_idx)
+
+        # one outer path per prange iteration, its inner paths are simulated sequentially
+        # (this replaces the shared memory reduction done by each block on the GPU)
+        for block in nb.prange(num_paths):
+            dW_corr = np.empty(num_diffusions, np.float32)
+            tmp_X = np.empty(num_diffusions, np.float32)
+            tmp_exp_1 = np.empty((num_cpty, num_defs_per_path), np.float32)
+            tmp_rates_sliding_window = np.empty((max_coarse_per_reset, num_rates), np.float32)
+            tmp_spread_integrals_prev = np.empty(num_spreads, np.float32)
+            tmp_spread_integrals = np.empty(num_spreads, np.float32)
+            tmp_def_indicators = np.empty((num_cpty_buckets, num_defs_per_path), np.int8)
+            tmp_mtm_by_cpty = np.empty(num_cpty, np.float32)
+            tmp_cva_payoff_by_cpty = np.empty((num_cpty, num_defs_per_path), np.float32)
+
+            for j in range(num_defs_per_path):
+                out1[j, block] = 0
+                out2[j, block] = 0
+
+            for inner_idx in range(num_inner_paths):
+                state_idx = num_paths*num_defs_per_path + block*num_inner_paths + inner_idx
+                draw_idx = 0
+                t_ = t
+
+                for i in range(num_cpty):
+                    for j in range(num_defs_per_path):
+                        tmp_cva_payoff_by_cpty[i, j] = 0
+                        if counter_based:
+                            u, _ = philox_uniform_float32_pair(rng_states, block, inner_idx, draw_idx, rng_stream)
+                            draw_idx += 1
+                        else:
+                            u = xoroshiro128p_uniform_float32(rng_states, state_idx)
+                        tmp_exp_1[i, j] = -math.log(u) # simulate exp1 here
+
+                for i in range(num_diffusions):
+                    tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-1, i, block]
+
+                for j in range(max_coarse_per_reset):
+                    for i in range(num_rates):
+                        tmp_rates_sliding_window[max_coarse_per_reset-j-1, i] = X[coarse_start_idx+max_coarse_per_reset-2-j, i, block]
+
+                tmp_dom_rate_integral = 0.
+
+                for i in range(num_spreads):
+                    tmp_spread_integrals[i] = 0
+
+                for q in range(num_cpty_buckets):
+                    for j in range(num_defs_per_path):
+                        tmp_def_indicators[q, j] = def_indicators[coarse_start_idx, q, j, block]
+
+                for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                    if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                        t_ += DT
+                    else:
+                        t_ += dt * num_fine_per_coarse
+                    for i in range(num_rates-1):
+                        tmp_X[fx_start+i] = math.log(tmp_X[fx_start+i])
+                    for i in range(num_spreads):
+                        tmp_spread_integrals_prev[i] = tmp_spread_integrals[i]
+
+                    if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                        num_fine = int((t_-0.01*dt)//dt)+1
+                    elif (DT != 0.) and (coarse_idx == coarse_start_idx+1):
+                        num_fine = int((DT-0.01*dt)//dt)+1
+                    else:
+                        num_fine = num_fine_per_coarse
+
+                    for fine_idx in range(num_fine):
+                        for i in range(num_diffusions):
+                            dW_corr[i] = 0
+
+                        for i in range(num_draws):
+                            if counter_based:
+                                u, v = philox_uniform_float32_pair(rng_states, block, inner_idx, draw_idx, rng_stream)
+                                draw_idx += 1
+                            else:
+                                u = xoroshiro128p_uniform_float32(rng_states, state_idx)
+                                v = xoroshiro128p_uniform_float32(rng_states, state_idx)
+                            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
+                            correlate(dW_corr, L_T, i, v)
+
+                        # FX log-diffusions
+                        for i in range(num_rates-1):
+                            tmp_X[fx_start+i] += (tmp_X[0] - tmp_X[i+1] - 0.5*diff_params[fx_params_start+i]**2) * dt + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
+
+                        # rate diffusions
+                        tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                        for i in range(num_rates):
+                            tmp_X[i] += diff_params[i] * (diff_params[num_rates+i] - tmp_X[i]) * dt
+                            drift_adj = np.float32(0)
+                            if i != 0:
+                                drift_adj = diff_params[drift_adj_start+i-1]
+                            tmp_X[i] += diff_params[2*num_rates+i] * (dW_corr[i] + drift_adj * dt)
+
+                        tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                        # spread diffusions
+                        for i in range(num_spreads):
+                            pos_spread = max(tmp_X[spread_start+i], 0)
+                            tmp_X[spread_start+i] += diff_params[spread_params_start+i] * (diff_params[spread_params_start+num_spreads+i] - pos_spread) * dt
+                            tmp_X[spread_start+i] += diff_params[spread_params_start+2*num_spreads+i] * math.sqrt(pos_spread) * dW_corr[spread_start+i]
+                            tmp_spread_integrals[i] += 0.5 * pos_spread * dt
+                            if tmp_X[spread_start+i] > 0:
+                                tmp_spread_integrals[i] += 0.5 * tmp_X[spread_start+i] * dt
+
+                    for i in range(num_rates):
+                        for j in range(max_coarse_per_reset-1):
+                            tmp_rates_sliding_window[j, i] = tmp_rates_sliding_window[j+1, i]
+                        tmp_rates_sliding_window[max_coarse_per_reset-1, i] = tmp_X[i]
+
+                    for i in range(num_rates-1):
+                        tmp_X[fx_start+i] = math.exp(tmp_X[fx_start+i])
+
+                    for cpty in range(num_cpty):
+                        tmp_mtm_by_cpty[cpty] = 0
+
+                    num_vanillas = _cpu_num_live_vanillas(vanillas_on_fx_f32, t_, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+                    for j in range(num_vanillas):
+                        maturity = vanillas_on_fx_f32[j, 0]
+                        if maturity + 0.1 * dt < t_:
+                            continue
+                        notional = vanillas_on_fx_f32[j, 1]
+                        strike = vanillas_on_fx_f32[j, 2]
+                        cpty = vanillas_on_fx_i32[j, 0]
+                        undl = vanillas_on_fx_i32[j, 1]
+                        call_put = vanillas_on_fx_b8[j, 0]
+                        price = _cpu_price_vanilla_on_fx(call_put, strike, t_, maturity, tmp_X[0], tmp_X[undl],
+                                                         tmp_X[num_rates+undl-1], R[num_rates+undl-1],
+                                                         R[undl*num_diffusions-undl*(undl+1)//2+num_rates+undl-1],
+                                                         R[undl], diff_params[0], diff_params[undl],
+                                                         diff_params[num_rates], diff_params[num_rates+undl],
+                                                         diff_params[2*num_rates], diff_params[2*num_rates+undl],
+                                                         diff_params[3*num_rates+undl-1], dt)
+                        tmp_mtm_by_cpty[cpty] += notional * price
+
+                    num_irs = _cpu_num_live_irs(irs_f32, irs_i32, t_, dt) if active_trades else irs_f32.shape[0]
+                    for j in range(num_irs):
+                        first_reset = irs_f32[j, 0]
+                        reset_freq = irs_f32[j, 1]
+                        num_resets = irs_i32[j, 0]
+                        if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t_:
+                            continue
+                        notional = irs_f32[j, 2]
+                        cpty = irs_i32[j, 1]
+                        ccy = irs_i32[j, 2]
+                        fx = np.float32(1)
+                        if ccy != 0:
+                            fx = tmp_X[num_rates + ccy - 1]
+                        swap_rate = irs_f32[j, 3]
+                        if t_ > first_reset - 0.1*dt:
+                            m = int((t_ - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                            m = int((t_-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                            m = max_coarse_per_reset-m
+                        else:
+                            m = max_coarse_per_reset-1
+                        price = _cpu_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t_, first_reset, reset_freq, num_resets, False,
+                                               diff_params[ccy], diff_params[num_rates+ccy], diff_params[2*num_rates+ccy], dt, zc_tables)
+                        tmp_mtm_by_cpty[cpty] += notional * fx * price
+
+                    discount_factor = math.exp(-tmp_dom_rate_integral)
+
+                    for i in range(num_cpty):
+                        s = tmp_spread_integrals[i+1]
+                        q = i // 8
+                        r = i % 8
+                        if indicator_in_cva:
+                            for j in range(num_defs_per_path):
+                                if s > tmp_exp_1[i, j]:
+                                    # no common-shock this time
+                                    def_prev = tmp_def_indicators[q, j] & (1 << r)
+                                    if not def_prev:
+                                        tmp_def_indicators[q, j] |= (1 << r)
+                                        mtm = tmp_mtm_by_cpty[i]
+                                        if mtm > 0:
+                                            tmp_cva_payoff_by_cpty[i, j] = discount_factor * mtm
+                        else:
+                            s_prev = tmp_spread_integrals_prev[i+1]
+                            mtm = tmp_mtm_by_cpty[i]
+                            cva_payoff_increment = discount_factor * mtm * (math.exp(-s_prev) - math.exp(-s))
+                            for j in range(num_defs_per_path):
+                                def_at_start = def_indicators[coarse_start_idx, q, j, block] & (1 << r)
+                                if (not def_at_start) and (cva_payoff_increment > 0):
+                                    tmp_cva_payoff_by_cpty[i, j] += cva_payoff_increment
+
+                # the GPU reduction accumulates the sum over counterparties and its square
+                for j in range(num_defs_per_path):
+                    c = np.float32(0)
+                    for i in range(num_cpty):
+                        c += tmp_cva_payoff_by_cpty[i, j]
+                    out1[j, block] += c / num_inner_paths
+                    out2[j, block] += c * c / num_inner_paths
+
+    # finally, return the compiled kernel
+    return _cpu_nested_cva
+
+
+def compile_cpu_nested_im(g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, params_in_const=True, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
+    # compile-time constants
+    num_cpty = num_spreads - 1
+
+    simulate_mtm_increments = _compile_cpu_nested_mtm_increments(num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, rng=rng, active_trades=active_trades, corr_pattern=corr_pattern, num_factors=num_factors, cache=cache)
+
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, see compile_cuda_diffuse_and_price
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.float32, nb.bool_, nb.float32, nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], rng_type, nb.float32, nb.float32[:, :], nb.float32[:, :], nb.float32[:, :], nb.float32[:, :], nb.float32, nb.float32, nb.int32, nb.float32[:], nb.float32[:], nb.float32[:], nb.float32, nb.float32[:, :, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_nested_im(alpha, adam_init, step_size, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, out1, out2, out3, out4, adam_b1, adam_b2, adam_iter, d_diff_params, d_R, d_L_T, DT, zc_tables):
+        if params_in_const:
+            diff_params = g_diff_params
+            R = g_R
+            L_T = g_L_T
+        else:
+            diff_params = d_diff_params
+            R = d_R
+            L_T = d_L_T
+        rng_stream = 0
+        if counter_based:
+            # coarse_start_idx is local to the device arrays, rng_states[3] holds the global index preceding them
+            rng_stream = PHILOX_NESTED_IM + PHILOX_NUM_STREAMS*(rng_states[3]+coarse_start_idx + 65536*adam_iter)
+        for block in nb.prange(num_paths):
+            mtm_increments = np.empty((num_inner_paths, num_cpty), np.float32)
+            simulate_mtm_increments(block, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, rng_stream, dt, DT, diff_params, R, L_T, mtm_increments, zc_tables)
+
+            # scalar SGD iteration for the nested quantile
+            for c in range(num_cpty):
+                if adam_init:
+                    tmp_mean = 0.
+                    tmp_sq = 0.
+                    for k in range(num_inner_paths):
+                        tmp_mean += mtm_increments[k, c]
+                        tmp_sq += mtm_increments[k, c]**2
+                    tmp_mean /= num_inner_paths
+                    tmp_std = math.sqrt(tmp_sq / num_inner_paths - tmp_mean**2)
+                    out2[c, block] = tmp_std
+                    # initialize with Gaussian quantile
+                    tmp_quantile = tmp_mean+tmp_std*_cpu_norm_invcdf(1-alpha)
+                    out1[c, block] = tmp_quantile
+                else:
+                    tmp_quantile = out1[c, block]
+                    tmp_std = out2[c, block]
+
+                grad = 0.
+                for k in range(num_inner_paths):
+                    grad += alpha
+                    if mtm_increments[k, c] > tmp_quantile:
+                        grad -= 1
+                grad /= num_inner_paths
+                if not adam_init:
+                    tmp_m = adam_b1 * out3[c, block] + (1 - adam_b1) * grad
+                    tmp_v = adam_b2 * out4[c, block] + (1 - adam_b2) * grad**2
+                else:
+                    tmp_m = (1 - adam_b1) * grad
+                    tmp_v = (1 - adam_b2) * grad**2
+                out3[c, block] = tmp_m
+                out4[c, block] = tmp_v
+                tmp_m /= 1 - adam_b1**(adam_iter+1)
+                tmp_v /= 1 - adam_b2**(adam_iter+1)
+                out1[c, block] -= step_size * tmp_std * tmp_m / (math.sqrt(tmp_v)+1e-8)
+
+    # finally, return the compiled kernel
+    return _cpu_nested_im
+
+
+def compile_cpu_nested_im_err(g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, params_in_const=True, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
+    # compile-time constants
+    num_cpty = num_spreads - 1
+    half = num_inner_paths // 2
+
+    simulate_mtm_increments = _compile_cpu_nested_mtm_increments(num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, rng=rng, active_trades=active_trades, corr_pattern=corr_pattern, num_factors=num_factors, cache=cache)
+
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, see compile_cuda_diffuse_and_price
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.float32, nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], rng_type, nb.float32, nb.float32[:, :], nb.float32[:, :], nb.float32[:], nb.float32[:], nb.float32[:], nb.float32, nb.float32[:, :, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_nested_im_err(alpha, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, quantile, out, d_diff_params, d_R, d_L_T, DT, zc_tables):
+        if params_in_const:
+            diff_params = g_diff_params
+            R = g_R
+            L_T = g_L_T
+        else:
+            diff_params = d_diff_params
+            R = d_R
+            L_T = d_L_T
+        rng_stream = 0
+        if counter_based:
+            # coarse_start_idx is local to the device arrays, rng_states[3] holds the global index preceding them
+            rng_stream = PHILOX_NESTED_IM_ERR + PHILOX_NUM_STREAMS*(rng_states[3]+coarse_start_idx)
+        for block in nb.prange(num_paths):
+            mtm_increments = np.empty((num_inner_paths, num_cpty), np.float32)
+            simulate_mtm_increments(block, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, rng_stream, dt, DT, diff_params, R, L_T, mtm_increments, zc_tables)
+            for c in range(num_cpty):
+                tmp_quantile = quantile[c, block]
+                err = 0.
+                # same pairing as the first step of the GPU tree reduction (works only if num_inner_paths is a power of 2)
+                for k in range(half):
+                    e1 = mtm_increments[k, c]
+                    e2 = mtm_increments[k+half, c]
+                    err += (min(e1, e2) > tmp_quantile)/alpha-((e1 > tmp_quantile)+(e2 > tmp_quantile))
+                out[c, block] = 1 + err / (alpha*num_inner_paths)
+
+    # finally, return the compiled kernel
+    return _cpu_nested_im_err
+
+
+def _compile_cpu_nested_mtm_increments(num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
+    # inner simulation shared by the nested IM kernel and its error kernel (the spreads are not diffused)
+    num_cpty = num_spreads - 1
+    num_diffusions = 2*num_rates+num_spreads-1
+    fx_start = num_rates
+    fx_params_start = 3*num_rates
+    drift_adj_start = 4*num_rates - 1
+    spread_start = fx_start + num_rates - 1
+    # correlation of the normals of the rates and FX rates, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, spread_start, corr_pattern, num_factors)
+    num_draws = spread_start + num_factors
+    counter_based = rng in ('philox', 'sobol')
+
+    @nb.njit(cache=cache)
+    def _cpu_nested_mtm_increments(block, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, rng_stream, dt, DT, diff_params, R, L_T, out, zc_tables):
+        sqrt_dt = math.sqrt(dt)
+        dW_corr = np.empty(spread_start, np.float32)
+        tmp_X = np.empty(spread_start, np.float32)
+        tmp_rates_sliding_window = np.empty((max_coarse_per_reset, num_rates), np.float32)
+
+        for inner_idx in range(num_inner_paths):
+            state_idx = num_paths*num_defs_per_path + block*num_inner_paths + inner_idx
+            draw_idx = 0
+            t_ = t
+
+            for i in range(spread_start):
+                tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-1, i, block]
+
+            for j in range(max_coarse_per_reset):
+                for i in range(num_rates):
+                    tmp_rates_sliding_window[max_coarse_per_reset-j-1, i] = X[coarse_start_idx+max_coarse_per_reset-2-j, i, block]
+
+            tmp_dom_rate_integral = 0.
+
+            for cpty in range(num_cpty):
+                out[inner_idx, cpty] = - mtm_by_cpty[cpty, block]
+
+            for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                discount_factor = math.exp(-tmp_dom_rate_integral)
+
+                # TODO: do it also for calls just in case calls expire inside the IM window
+                num_irs = _cpu_num_live_irs(irs_f32, irs_i32, t_, dt) if active_trades else irs_f32.shape[0]
+                for j in range(num_irs):
+                    first_reset = irs_f32[j, 0]
+                    reset_freq = irs_f32[j, 1]
+                    num_resets = irs_i32[j, 0]
+                    if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t_:
+                        continue
+                    notional = irs_f32[j, 2]
+                    cpty = irs_i32[j, 1]
+                    ccy = irs_i32[j, 2]
+                    fx = np.float32(1)
+                    if ccy != 0:
+                        fx = tmp_X[num_rates + ccy - 1]
+                    swap_rate = irs_f32[j, 3]
+                    if t_ > first_reset - 0.1*dt:
+                        m = int((t_ - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                        m = int((t_-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                        m = max_coarse_per_reset-m
+                    else:
+                        m = max_coarse_per_reset-1
+                    k = int((t_-first_reset+0.1*dt)/reset_freq)
+                    is_coupon_date = (k >= 1) and (abs(t_-first_reset-k*reset_freq) < 0.1*dt)
+                    if is_coupon_date:
+                        cashflow = _cpu_price_zc_bond_inv_tab(ccy, tmp_rates_sliding_window[m, ccy], reset_freq, diff_params[ccy], diff_params[num_rates+ccy], diff_params[2*num_rates+ccy], zc_tables, dt) - 1 - swap_rate * reset_freq
+                        out[inner_idx, cpty] += notional * fx * cashflow * discount_factor
+
+                for i in range(num_rates-1):
+                    tmp_X[fx_start+i] = math.log(tmp_X[fx_start+i])
+
+                for i in range(num_rates):
+                    for j in range(max_coarse_per_reset-1):
+                        tmp_rates_sliding_window[j, i] = tmp_rates_sliding_window[j+1, i]
+                    tmp_rates_sliding_window[max_coarse_per_reset-1, i] = tmp_X[i]
+
+                if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                    num_fine = int((t_-0.01*dt)//dt)+1
+                elif (DT != 0.) and (coarse_idx == coarse_start_idx+1):
+                    num_fine = int((DT-0.01*dt)//dt)+1
+                else:
+                    num_fine = num_fine_per_coarse
+
+                for fine_idx in range(num_fine):
+                    for i in range(spread_start):
+                        dW_corr[i] = 0
+
+                    for i in range(num_draws):
+                        if counter_based:
+                            u, v = philox_uniform_float32_pair(rng_states, block, inner_idx, draw_idx, rng_stream)
+                            draw_idx += 1
+                        else:
+                            u = xoroshiro128p_uniform_float32(rng_states, state_idx)
+                            v = xoroshiro128p_uniform_float32(rng_states, state_idx)
+                        v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
+                        correlate(dW_corr, L_T, i, v)
+
+                    # FX log-diffusions
+                    for i in range(num_rates-1):
+                        tmp_X[fx_start+i] += (tmp_X[0] - tmp_X[i+1] - 0.5*diff_params[fx_params_start+i]**2) * dt + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
+
+                    # rate diffusions
+                    tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                    for i in range(num_rates):
+                        tmp_X[i] += diff_params[i] * (diff_params[num_rates+i] - tmp_X[i]) * dt
+                        drift_adj = np.float32(0)
+                        if i != 0:
+                            drift_adj = diff_params[drift_adj_start+i-1]
+                        tmp_X[i] += diff_params[2*num_rates+i] * (dW_corr[i] + drift_adj * dt)
+
+                    tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                for i in range(num_rates-1):
+                    tmp_X[fx_start+i] = math.exp(tmp_X[fx_start+i])
+
+                if (DT != 0.) and (coarse_idx == coarse_start_idx):
+                    t_ += DT
+                else:
+                    t_ += dt * num_fine_per_coarse
+
+            discount_factor = math.exp(-tmp_dom_rate_integral)
+            num_vanillas = _cpu_num_live_vanillas(vanillas_on_fx_f32, t_, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+            for j in range(num_vanillas):
+                maturity = vanillas_on_fx_f32[j, 0]
+                if maturity + 0.1 * dt < t_:
+                    continue
+                notional = vanillas_on_fx_f32[j, 1]
+                strike = vanillas_on_fx_f32[j, 2]
+                cpty = vanillas_on_fx_i32[j, 0]
+                undl = vanillas_on_fx_i32[j, 1]
+                call_put = vanillas_on_fx_b8[j, 0]
+                price = _cpu_price_vanilla_on_fx(call_put, strike, t_, maturity, tmp_X[0], tmp_X[undl],
+                                                 tmp_X[num_rates+undl-1], R[num_rates+undl-1],
+                                                 R[undl*num_diffusions-undl*(undl+1)//2+num_rates+undl-1],
+                                                 R[undl], diff_params[0], diff_params[undl],
+                                                 diff_params[num_rates], diff_params[num_rates+undl],
+                                                 diff_params[2*num_rates], diff_params[2*num_rates+undl],
+                                                 diff_params[3*num_rates+undl-1], dt)
+                out[inner_idx, cpty] += notional * price * discount_factor
+
+            num_irs = _cpu_num_live_irs(irs_f32, irs_i32, t_, dt) if active_trades else irs_f32.shape[0]
+            for j in range(num_irs):
+                first_reset = irs_f32[j, 0]
+                reset_freq = irs_f32[j, 1]
+                num_resets = irs_i32[j, 0]
+                if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t_:
+                    continue
+                notional = irs_f32[j, 2]
+                cpty = irs_i32[j, 1]
+                ccy = irs_i32[j, 2]
+                fx = np.float32(1)
+                if ccy != 0:
+                    fx = tmp_X[num_rates + ccy - 1]
+                swap_rate = irs_f32[j, 3]
+                if t_ > first_reset - 0.1*dt:
+                    m = int((t_ - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                    m = int((t_-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                    m = max_coarse_per_reset-m
+                else:
+                    m = max_coarse_per_reset-1
+                price = _cpu_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t_, first_reset, reset_freq, num_resets, False,
+                                       diff_params[ccy], diff_params[num_rates+ccy], diff_params[2*num_rates+ccy], dt, zc_tables)
+                out[inner_idx, cpty] += notional * fx * price * discount_factor
+
+    return _cpu_nested_mtm_increments
+
+
+@nb.njit(inline='always')
+def _cpu_norm_cdf(z):
+    return 0.5*(1.+math.erf(z/math.sqrt(2.)))
+
+@nb.njit(inline='always')
+def _cpu_norm_abramowitz_ccdf(z):
+    return z-((0.010328*z+0.802853)*z+2.515517)/(((0.001308*z+0.189269)*z+1.432788)*z+1.)
+
+@nb.njit(inline='always')
+def _cpu_norm_invcdf(z):
+    if 0 < z < 0.5:
+        return -_cpu_norm_abramowitz_ccdf(math.sqrt(-2*math.log(z)))
+    elif 0.5 <= z < 1:
+        return _cpu_norm_abramowitz_ccdf(math.sqrt(-2*math.log(1-z)))
+    else:
+        return math.nan
+
+@nb.njit(inline='always')
+def _cpu_price_zc_bond(r_t, t, mat, a, b, sigma):
+    B = (1.-math.exp(-a*(mat-t)))/a
+    A = (b-0.5*sigma*sigma/(a*a))*(B-mat+t)-0.25*sigma*sigma/a*B*B
+    return math.exp(A-B*r_t)
+
+@nb.njit(inline='always')
+def _cpu_price_zc_bond_inv(r_t, t, mat, a, b, sigma):
+    B = (1.-math.exp(-a*(mat-t)))/a
+    A = (b-0.5*sigma*sigma/(a*a))*(B-mat+t)-0.25*sigma*sigma/a*B*B
+    return math.exp(B*r_t-A)
+
+@nb.njit(inline='always')
+def _cpu_price_zc_bond_tab(ccy, r_t, tau, a, b, sigma, zc_tables, dt):
+    # zero-coupon bond of maturity t+tau, with the coefficients of zc_tables when tau lies on the fine grid (see
+    # zc_tables_pl.py)
+    n = int(tau/dt+0.5)
+    if n >= 0 and n < zc_tables.shape[2] and abs(tau-n*dt) < 0.1*dt:
+        return math.exp(zc_tables[0, ccy, n]-zc_tables[1, ccy, n]*r_t)
+    return _cpu_price_zc_bond(r_t, 0, tau, a, b, sigma)
+
+@nb.njit(inline='always')
+def _cpu_price_zc_bond_inv_tab(ccy, r_t, tau, a, b, sigma, zc_tables, dt):
+    n = int(tau/dt+0.5)
+    if n >= 0 and n < zc_tables.shape[2] and abs(tau-n*dt) < 0.1*dt:
+        return math.exp(zc_tables[1, ccy, n]*r_t-zc_tables[0, ccy, n])
+    return _cpu_price_zc_bond_inv(r_t, 0, tau, a, b, sigma)
+
+@nb.njit(inline='always')
+def _cpu_num_live_irs(irs_f32, irs_i32, t, dt):
+    # with active_trades, the swaps are sorted by decreasing final date, so that the swaps still alive at t are the
+    # first ones: their number is found by a binary search on the expiry test of the pricing loops
+    return _cpu_live_irs_end(irs_f32, irs_i32, 0, irs_f32.shape[0], t, dt)
+
+@nb.njit(inline='always')
+def _cpu_live_irs_end(irs_f32, irs_i32, lo, hi, t, dt):
+    # end of the swaps still alive at t among the rows [lo, hi), sorted by decreasing final date
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if irs_f32[mid, 0] + (irs_i32[mid, 0] - 1) * irs_f32[mid, 1] + 0.1 * dt < t:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+@nb.njit(inline='always')
+def _cpu_num_live_vanillas(vanillas_on_fx_f32, t, dt):
+    # same for the vanilla options, sorted by decreasing maturity
+    lo = 0
+    hi = vanillas_on_fx_f32.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if vanillas_on_fx_f32[mid, 0] + 0.1 * dt < t:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+@nb.njit(inline='always')
+def _cpu_lower_bound(ary, col, value, lo, hi):
+    # first row of [lo, hi) whose column col is at least value, the rows being sorted by increasing column col
+    # (with large_portfolio, the first swap of a counterparty)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if ary[mid, col] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+@nb.njit(inline='always')
+def _cpu_price_irs(ccy, swap_rate, r_prev_reset, r_t, t, first_reset, reset_freq, num_resets, only_fixed_leg, a, b, sigma, dt, zc_tables):
+    if(t > first_reset+(num_resets-1)*reset_freq+0.1*dt):
+        return 0.
+    fixed_leg = 0.
+    k = int((t-first_reset+0.1*dt)/reset_freq)
+    if k < 0:
+        k = 0
+    reset = first_reset+k*reset_freq
+    zc_last = 1.
+    for i in range(k+1, num_resets):
+        reset += reset_freq
+        zc_last = _cpu_price_zc_bond_tab(ccy, r_t, reset-t, a, b, sigma, zc_tables, dt)
+        fixed_leg += zc_last
+    fixed_leg *= reset_freq * swap_rate
+    if t < first_reset - 0.1*dt:
+        floating_leg = _cpu_price_zc_bond_tab(ccy, r_t, first_reset-t, a, b, sigma, zc_tables, dt) - zc_last
+    elif abs(t-first_reset-k*reset_freq) < 0.1*dt:
+        if k == 0:
+            floating_leg = 1 - zc_last
+        else:
+            floating_leg = _cpu_price_zc_bond_inv_tab(ccy, r_prev_reset, reset_freq, a, b, sigma, zc_tables, dt) - zc_last
+            fixed_leg += reset_freq * swap_rate
+    else:
+        t_next_reset = first_reset + (k+1) * reset_freq
+        floating_leg = _cpu_price_zc_bond_tab(ccy, r_t, t_next_reset-t, a, b, sigma, zc_tables, dt)*_cpu_price_zc_bond_inv_tab(ccy, r_prev_reset, reset_freq, a, b, sigma, zc_tables, dt) - zc_last
+    if only_fixed_leg:
+        return fixed_leg
+    else:
+        return floating_leg - fixed_leg
+
+@nb.njit(inline='always')
+def _cpu_price_vanilla_on_fx(call_put, stk, t, mat, r_d_t, r_f_t, fx_t, rho_fx_d, rho_fx_f, rho_f_d, a_d, a_f, b_d, b_f,
+                             s_d, s_f, s_fx, dt):
+    if abs(t-mat) < 0.1*dt:
+        return max(fx_t - stk, 0.)
+    zc_d = _cpu_price_zc_bond(r_d_t, t, mat, a_d, b_d, s_d)
+    zc_f = _cpu_price_zc_bond(r_f_t, t, mat, a_f, b_f, s_f)
+    e_d_resmat = math.exp(-a_d*(mat-t))
+    e_f_resmat = math.exp(-a_f*(mat-t))
+    int_B_d_sq = (mat-t+(2*e_d_resmat-0.5*e_d_resmat*e_d_resmat-1.5)/a_d)/(a_d*a_d)
+    int_B_f_sq = (mat-t+(2*e_f_resmat-0.5*e_f_resmat*e_f_resmat-1.5)/a_f)/(a_f*a_f)
+    int_B_d = (mat-t+(e_d_resmat-1)/a_d)/a_d
+    int_B_f = (mat-t+(e_f_resmat-1)/a_f)/a_f
+    int_B_d_B_f = ((mat-t)+(e_f_resmat+e_d_resmat-e_d_resmat*e_f_resmat-1)/(a_d+a_f)) / \
+        a_d+(e_f_resmat-1)/(a_f*(a_d+a_f))+(e_d_resmat-1)/(a_d*a_d*(a_d+a_f))
+    pricing_vol = math.sqrt(s_fx*s_fx*(mat-t)+s_d*s_d*int_B_d_sq+s_f*s_f*int_B_f_sq+2 *
+                            rho_fx_d*s_fx*s_d*int_B_d-2*rho_f_d*s_f*s_d*int_B_d_B_f-2*rho_fx_f*s_fx*s_f*int_B_f)
+    d_1 = math.log(fx_t/stk*zc_f/zc_d)/pricing_vol+0.5*pricing_vol
+    d_2 = d_1-pricing_vol
+    if call_put:
+        return zc_f*fx_t*_cpu_norm_cdf(d_1)-zc_d*stk*_cpu_norm_cdf(d_2)
+    else:
+        return -zc_f*fx_t*_cpu_norm_cdf(-d_1)+zc_d*stk*_cpu_norm_cdf(-d_2)
+
+def compile_cpu_compute_mtm(g_diff_params, g_R, num_fine_per_coarse, num_rates, num_spreads, num_paths, params_in_const=True, active_trades=False, pathwise_params=True, cache=False):
+    # compile-time constants
+    num_diffusions = 2*num_rates+num_spreads-1
+
+    if not params_in_const:
+        g_diff_params, g_R = np.zeros_like(g_diff_params), np.zeros_like(g_R)
+
+    sig = (nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :],
+           nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :],
+           nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :],
+           nb.float32, nb.int32, nb.int32, nb.bool_, nb.float32[:], nb.float32[:], nb.float32[:, :], nb.float32[:, :, :])
+
+    @nb.njit(sig, parallel=True, cache=cache)
+    def _cpu_compute_mtm(coarse_idx, t, X, mtm_by_cpty, cash_flows_by_cpty, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, irs_f32, irs_i32, zcs_f32, zcs_i32, dt, max_coarse_per_reset, window_length, set_irs_at_par, d_diff_params, d_R, d_pathwise_diff_params, zc_tables):
+        if params_in_const:
+            R = g_R
+            base_diff_params = g_diff_params
+        else:
+            R = d_R
+            base_diff_params = d_diff_params
+        for pos in nb.prange(num_paths):
+            if pathwise_params:
+                diff_params = d_pathwise_diff_params[num_diffusions:, pos]
+            else:
+                diff_params = base_diff_params
+
+            for cpty in range(num_spreads-1):
+                mtm_by_cpty[coarse_idx, cpty, pos] = 0.
+                cash_flows_by_cpty[coarse_idx, cpty, pos] = 0.
+
+            num_vanillas = _cpu_num_live_vanillas(vanillas_on_fx_f32, t, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+            for j in range(num_vanillas):
+                maturity = vanillas_on_fx_f32[j, 0]
+                if maturity + 0.1 * dt < t:
+                    continue
+                notional = vanillas_on_fx_f32[j, 1]
+                strike = vanillas_on_fx_f32[j, 2]
+                cpty = vanillas_on_fx_i32[j, 0]
+                undl = vanillas_on_fx_i32[j, 1]
+                call_put = vanillas_on_fx_b8[j, 0]
+                fx_t = X[coarse_idx+max_coarse_per_reset-1, num_rates+undl-1, pos]
+                price = _cpu_price_vanilla_on_fx(call_put, strike, t, maturity, X[coarse_idx+max_coarse_per_reset-1, 0, pos], X[coarse_idx+max_coarse_per_reset-1, undl, pos],
+                                                 fx_t, R[num_rates+undl-1],
+                                                 R[undl*num_diffusions-undl*(undl+1)//2+num_rates+undl-1],
+                                                 R[undl], diff_params[0], diff_params[undl],
+                                                 diff_params[num_rates], diff_params[num_rates+undl],
+                                                 diff_params[2*num_rates], diff_params[2*num_rates+undl],
+                                                 diff_params[3*num_rates+undl-1], dt)
+                mtm_by_cpty[coarse_idx, cpty, pos] += notional * price
+                if t > maturity - 0.1*dt:
+                    if call_put:
+                        payoff = fx_t - strike
+                    else:
+                        payoff = strike - fx_t
+                    if payoff < 0:
+                        payoff = 0
+                    cash_flows_by_cpty[coarse_idx, cpty, pos] += notional * payoff
+
+            num_irs = _cpu_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+            for j in range(num_irs):
+                first_reset = irs_f32[j, 0]
+                reset_freq = irs_f32[j, 1]
+                num_resets = irs_i32[j, 0]
+                if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t:
+                    continue
+                notional = irs_f32[j, 2]
+                cpty = irs_i32[j, 1]
+                ccy = irs_i32[j, 2]
+                fx = np.float32(1)
+                if ccy != 0:
+                    fx = X[coarse_idx+max_coarse_per_reset-1, num_rates + ccy - 1, pos]
+                a = diff_params[ccy]
+                b = diff_params[num_rates+ccy]
+                sigma = diff_params[2*num_rates+ccy]
+                if set_irs_at_par and coarse_idx == 0:
+                    fixed = _cpu_price_irs(ccy, 1., 0., X[max_coarse_per_reset-1, ccy, pos], 0., first_reset, reset_freq,
+                                           num_resets, True, a, b, sigma, dt, zc_tables)
+                    floating = _cpu_price_irs(ccy, 0., 0., X[max_coarse_per_reset-1, ccy, pos], 0., first_reset, reset_freq,
+                                              num_resets, False, a, b, sigma, dt, zc_tables)
+                    swap_rate = floating/fixed
+                    if pos == 0:
+                        irs_f32[j, 3] = swap_rate
+                else:
+                    swap_rate = irs_f32[j, 3]
+                if t > first_reset - 0.1*dt:
+                    num_coarse_per_reset = int((reset_freq+dt)/(num_fine_per_coarse*dt))
+                    m = int((t - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                    m = int((first_reset+m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                    m = (m-coarse_idx+num_coarse_per_reset) % window_length + coarse_idx-num_coarse_per_reset # locate in (extended) local window
+                else:
+                    m = 0
+                price = _cpu_price_irs(ccy, swap_rate, X[m+max_coarse_per_reset-1, ccy, pos], X[coarse_idx+max_coarse_per_reset-1, ccy, pos], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
+                mtm_by_cpty[coarse_idx, cpty, pos] += notional * fx * price
+                k = int((t-first_reset+0.1*dt)/reset_freq)
+                is_coupon_date = (k >= 1) and (abs(t-first_reset-k*reset_freq) < 0.1*dt)
+                if is_coupon_date:
+                    cash_flows_by_cpty[coarse_idx, cpty, pos] += notional * fx * (_cpu_price_zc_bond_inv_tab(ccy, X[m+max_coarse_per_reset-1, ccy, pos], reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq)
+
+    # returning the compiled kernel
+    return _cpu_compute_mtm
@@ -18,18 +18,32 @@
 
 import math
 import numba as nb
+import numpy as np
 from numba import cuda
+from numba.cuda import libdevice
 from numba.cuda.random import xoroshiro128p_normal_float32, xoroshiro128p_uniform_float32, xoroshiro128p_dtype
+from simulation.sobol_pl import sobol_bridge_point
+from simulation.exact_pl import vasicek_residual_cholesky, vasicek_step, cir_qe_step
+from simulation.correlation_pl import compile_correlate
+from simulation.compact_pl import encode_float16, encode_bfloat16, encode_int16, int16_scale_offset
+from simulation.philox_pl import philox4x32_10, philox_uniform_float32_pair, PHILOX_EXP1, PHILOX_OUTER, PHILOX_NESTED_CVA, PHILOX_NESTED_IM, PHILOX_NESTED_IM_ERR, PHILOX_NUM_STREAMS, PHILOX_PARAMS
+from simulation.shocks_pl import permute_stratum, stratified_normal
 
 
-def compile_cuda_generate_exp1(num_spreads, num_defs_per_path, num_paths, ntpb, stream):
+def compile_cuda_generate_exp1(num_spreads, num_defs_per_path, num_paths, ntpb, stream, rng='xoroshiro128p', cache=False):
 
     num_names = num_spreads - 1
 
-    sig = (nb.float32[:, :, :], nb.from_dtype(xoroshiro128p_dtype)[:])
+    # 'xoroshiro128p': stateful streams indexed by thread, 'philox': counter-based generator keyed by the
+    # global path index, whose "states" are the key array of philox_pl.py, 'sobol': same, except for the
+    # coarse skeleton of the outer diffusion, which is quasi-random (see sobol_pl.py)
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.float32[:, :, :], rng_type, nb.bool_)
     
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_generate_exp1(out, rng_states):
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_generate_exp1(out, rng_states, antithetic):
         block_x = cuda.blockIdx.x
         block_y = cuda.blockIdx.y
         block_size = cuda.blockDim.x
@@ -37,7 +51,17 @@ def compile_cuda_generate_exp1(num_spreads, num_defs_per_path, num_paths, ntpb,
         pos = tidx + block_y * block_size
         if pos < num_paths:
             for i in range(num_names):
-                out[i, block_x, pos] = -math.log(xoroshiro128p_uniform_float32(rng_states, block_x*num_paths+pos))
+                if counter_based:
+                    if antithetic:
+                        # mirrored uniform of the even path of the pair, still in (0, 1]
+                        u, _ = philox_uniform_float32_pair(rng_states, pos - pos % 2, block_x, i, PHILOX_EXP1)
+                        if pos % 2:
+                            u = nb.float32(1) - u + nb.float32(5.9604644775390625e-08)
+                    else:
+                        u, _ = philox_uniform_float32_pair(rng_states, pos, block_x, i, PHILOX_EXP1)
+                else:
+                    u = xoroshiro128p_uniform_float32(rng_states, block_x*num_paths+pos)
+                out[i, block_x, pos] = -math.log(u)
 
     #_cuda_generate_exp1._func.get().cache_config(prefer_cache=True)
     cuda_generate_exp1 = _cuda_generate_exp1[(num_defs_per_path, (num_paths+ntpb-1)//ntpb), ntpb, stream]
@@ -46,29 +70,44 @@ def compile_cuda_generate_exp1(num_spreads, num_defs_per_path, num_paths, ntpb,
     return cuda_generate_exp1
 
 
-def compile_cuda_gen_diff_params(ntpb, num_paths, num_diffusions, stream):
-    
-    sig = (nb.float32[:, :], nb.from_dtype(xoroshiro128p_dtype)[:], nb.float32[:], nb.float32[:], nb.float32)
-    
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_gen_diff_params(out, rng_states, loc_init, loc_params, scale_mixture):
+def compile_cuda_gen_diff_params(num_params, num_paths, ntpb, stream, sampling='normal', cache=False):
+    # pathwise parameters drawn from a ShockSpec (see shocks_pl.py): out[:, pos] holds the initial values and the
+    # diffusion parameters of path pos, base_params the unshocked ones, and rows, row_scales, group_starts and batch_size
+    # the flattened spec of shock_layout, for a run of num_run_paths paths of which path pos is path first_path+pos
+    bump = sampling == 'bump'
+    lhs = sampling == 'lhs'
+    stratified = sampling == 'stratified'
+
+    sig = (nb.float32[:, :], nb.float32[:], nb.uint32[:], nb.int32[:], nb.float32[:], nb.int32[:], nb.int32, nb.int32, nb.int32)
+
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_gen_diff_params(out, base_params, rng_key, rows, row_scales, group_starts, batch_size, first_path, num_run_paths):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
         tidx = cuda.threadIdx.x
         pos = tidx + block * block_size
-        num_params = out.shape[0]
-        for i, mean_init in enumerate(loc_init):
-            u = xoroshiro128p_uniform_float32(rng_states, pos)
-            v = xoroshiro128p_uniform_float32(rng_states, pos)
-            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v)
-            if i < num_params:
-                out[i, pos] = v * scale_mixture * mean_init + mean_init
-        for i, mean_param in enumerate(loc_params):
-            u = xoroshiro128p_uniform_float32(rng_states, pos)
-            v = xoroshiro128p_uniform_float32(rng_states, pos)
-            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v)
-            if i  + num_diffusions < num_params:
-                out[i + num_diffusions, pos] = v * scale_mixture * mean_param + mean_param
+        if pos < num_paths:
+            for i in range(num_params):
+                out[i, pos] = base_params[i]
+            # batch of the path in the run, and its index k among the n paths of the batch
+            num_groups = group_starts.shape[0] - 1
+            g = min((first_path + pos) // batch_size, num_groups - 1)
+            k = first_path + pos - g*batch_size
+            n = batch_size if g < num_groups - 1 else num_run_paths - g*batch_size
+            for j in range(group_starts[g], group_starts[g+1]):
+                if bump:
+                    z = 1.
+                else:
+                    u, v = philox_uniform_float32_pair(rng_key, pos, j, 0, PHILOX_PARAMS)
+                    if lhs or (stratified and j == group_starts[g]):
+                        # same permutation of the strata for all the paths of the batch, whatever the path offset
+                        key, _, _, _ = philox4x32_10(rng_key[0], rng_key[1], 0, j, 1, PHILOX_PARAMS)
+                        z = stratified_normal(permute_stratum(k, n, key), n, u)
+                    else:
+                        z = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v)
+                # relative shock, applied as in DiffusionEngine._gen_diff_params
+                row = rows[j]
+                out[row, pos] = base_params[row] + nb.float32(row_scales[j] * z) * base_params[row]
 
     cuda_gen_diff_params = _cuda_gen_diff_params[(num_paths+ntpb-1)//ntpb, ntpb, stream]
 
@@ -77,7 +116,7 @@ def compile_cuda_gen_diff_params(ntpb, num_paths, num_diffusions, stream):
 
 def compile_cuda_bulk_diffuse(g_diff_params, g_L_T, num_fine_per_coarse,
                               num_rates, num_spreads, num_defs_per_path, num_paths, ntpb,
-                              stream):
+                              stream, cache=False):
     # compile-time constants
     num_diffusions = 2*num_rates+num_spreads-1
     fx_start = num_rates
@@ -89,7 +128,7 @@ def compile_cuda_bulk_diffuse(g_diff_params, g_L_T, num_fine_per_coarse,
     sig = (nb.int32, nb.float32, nb.float32[:, :, :], nb.int8[:, :, :, :], nb.float32[:, :], nb.float32[:, :, :],
            nb.float32[:, :], nb.int32[:, :], nb.float32[:, :, :], nb.from_dtype(xoroshiro128p_dtype)[:], nb.float32, nb.int32)
 
-    @cuda.jit(func_or_sig=sig, max_registers=64)
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
     def _cuda_bulk_diffuse(coarse_idx, t, X, def_indicators, dom_rate_integral, spread_integrals, irs_f32, irs_i32, exp_1, rng_states, dt, max_coarse_per_reset):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
@@ -195,7 +234,7 @@ def compile_cuda_bulk_diffuse(g_diff_params, g_L_T, num_fine_per_coarse,
     return cuda_bulk_diffuse
 
 
-def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_paths, ntpb, stream, params_in_const=True):
+def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_paths, ntpb, stream, params_in_const=True, rng='xoroshiro128p', scheme='euler', active_trades=False, large_portfolio=False, pathwise_params=True, corr_pattern=None, num_factors=0, cache=False):
     # compile-time constants
     num_cpty = num_spreads - 1
     num_diffusions = 2*num_rates+num_spreads-1
@@ -203,13 +242,28 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
     fx_params_start = 3*num_rates
     drift_adj_start = 4*num_rates - 1
     spread_start = fx_start + num_rates - 1
+    # correlation of the independent normals of a step, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, num_diffusions, corr_pattern, num_factors)
+    num_draws = num_diffusions + num_factors
     spread_params_start = fx_params_start + 2*num_rates - 2
     num_diff_params = 5*num_rates-2+3*num_spreads
 
-    sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], nb.from_dtype(xoroshiro128p_dtype)[:], nb.float32, nb.int32, nb.float32[:], nb.float32[:], nb.float32[:], nb.float32[:, :], nb.float32, nb.float32, nb.from_dtype(xoroshiro128p_dtype)[:])
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, the kernel then reads their values from its arguments
+        # (the compiled code, and its cache entry, no longer depend on the market parameters)
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
 
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_bulk_diffuse_and_price(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, max_coarse_per_reset, d_diff_params, d_R, d_L_T, d_pathwise_diff_params, DT = None, time_to_change_seed = math.inf, rng_states2 = None):
+    counter_based = rng in ('philox', 'sobol')
+    quasi_random = rng == 'sobol'
+    # 'euler': num_fine_per_coarse Euler steps per coarse step, 'exact': one exact (Vasicek, FX) or
+    # moment-matched (CIR) transition per coarse step, see exact_pl.py
+    exact = scheme == 'exact'
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], rng_type, nb.float32, nb.int32, nb.float32[:], nb.float32[:], nb.float32[:], nb.float32[:, :], nb.float32, nb.float32, rng_type, nb.bool_, nb.float32[:, :, :])
+
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_bulk_diffuse_and_price(coarse_start_idx, num_coarse_steps, t, X, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, cash_pos_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, max_coarse_per_reset, d_diff_params, d_R, d_L_T, d_pathwise_diff_params, DT = None, time_to_change_seed = math.inf, rng_states2 = None, antithetic = False, zc_tables = None):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
         tidx = cuda.threadIdx.x
@@ -224,7 +278,9 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
                 diff_params = d_diff_params
                 R = d_R
                 L_T = d_L_T
-            if True:
+            if pathwise_params:
+                # per-path parameters, read from global memory at each step (pathwise_params=False: the parameters
+                # above, the same for all the threads, and d_pathwise_diff_params is not read)
                 diff_params = cuda.local.array(num_diff_params, dtype=nb.float32) # [TODO] use len(g_diff_params) instead of 75
                 #diff_params = g_diff_params[:]
                 diff_params = d_pathwise_diff_params[num_diffusions:, pos]
@@ -240,9 +296,18 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
             tmp_mtm_by_cpty = cuda.local.array(num_cpty, nb.float32)
             tmp_cash_flows_by_cpty = cuda.local.array(num_cpty, nb.float32)
             tmp_cash_pos_by_cpty = cuda.local.array(num_cpty, nb.float32)
+            sobol_W = cuda.local.array(num_diffusions, nb.float32)
+            bridge_rem = cuda.local.array(num_diffusions, nb.float32)
+            res_chol = cuda.local.array(num_rates*(num_rates+1)//2, nb.float32)
+            res_z = cuda.local.array(num_rates, nb.float32)
+            rate_integrals = cuda.local.array(num_rates, nb.float32)
 
             sqrt_dt = math.sqrt(dt)
 
+            # antithetic pairs: the odd path of each pair reuses the draws of the even one, with the opposite sign
+            rng_pos = pos - pos % 2 if antithetic else pos
+            sign = -1 if antithetic and pos % 2 else 1
+
             for i in range(num_diffusions):
                 tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-2, i, pos]
             
@@ -252,6 +317,8 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
             for i in range(num_cpty):
                 tmp_cash_pos_by_cpty[i] = cash_pos_by_cpty[coarse_start_idx - 1, i, pos]
 
+            prev_seed_changed = False
+            res_chol_num_fine = -1
             for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
                 tmp_dom_rate_integral = 0
                 for i in range(num_rates-1):
@@ -266,52 +333,129 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
                 else:
                     num_fine = num_fine_per_coarse
 
-                for fine_idx in range(num_fine):
-                #for fine_idx in range(num_fine_per_coarse):
+                if quasi_random:
+                    # coarse increments of the scrambled Sobol Brownian bridge (see sobol_pl.py), with the same choice of
+                    # stream as the fine draws; the previous coarse point is only recomputed at the start of the launch
+                    # or when the seed changes
+                    seed_changed = t > time_to_change_seed
+                    sqrt_dT = math.sqrt(num_fine*dt)
                     for i in range(num_diffusions):
-                        dW_corr[i] = 0
-
+                        if coarse_idx == coarse_start_idx or seed_changed != prev_seed_changed:
+                            sobol_W[i] = sobol_bridge_point(rng_states if t<=time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx-1, i)
+                        w = sobol_bridge_point(rng_states if t<=time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx, i)
+                        bridge_rem[i] = (w - sobol_W[i]) * sqrt_dT
+                        sobol_W[i] = w
+                    prev_seed_changed = seed_changed
+
+                if exact:
+                    # exact transition over the coarse step (see exact_pl.py): the correlated Brownian increments of all
+                    # the factors over the step, then the independent normals driving the residuals of the Vasicek integrals
+                    h = num_fine*dt
+                    sqrt_h = math.sqrt(h)
+                    if num_fine != res_chol_num_fine:
+                        vasicek_residual_cholesky(diff_params, R, num_rates, num_diffusions, h, res_chol)
+                        res_chol_num_fine = num_fine
                     for i in range(num_diffusions):
-                        u = xoroshiro128p_uniform_float32(rng_states if t<=time_to_change_seed else rng_states2, pos)
-                        v = xoroshiro128p_uniform_float32(rng_states if t<=time_to_change_seed else rng_states2, pos)
-                        v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
-                        for j in range(i, num_diffusions):
-                            # L_T is the transpose of the lower-triangular L such that Corr=L*L_T
-                            dW_corr[j] += L_T[i*num_diffusions-i*(i+1)//2+j] * v
-                    # E[Au*(Au)^T] = E[A*u*u^T*A^T] = A*Cov*A^T -> for unit Cov, it is enough to choose A=L
-                    # E[LdW*(LdW)^T] = dt*LL^T = dt*Corr
-                    # dW_corr[k] = sum_j L_{i,j} * dW_j
-
-                    # FX log-diffusions
-                    for i in range(num_rates-1):
-                        tmp_X[fx_start+i] += (tmp_X[0] - tmp_X[i+1] - 0.5*diff_params[fx_params_start+i]** 2) * dt + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
-
-                    # rate diffusions
-                    # TODO: change this and diffuse jointly the short rate and its integral exactly
-                    # (but for now let's just stick with a numerical integral)
-                    tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
-
+                        dW_corr[i] = 0
+                    for i in range(num_draws+num_rates):
+                        if quasi_random and i < num_diffusions:
+                            # coarse increment of the Sobol Brownian bridge
+                            v = bridge_rem[i]
+                        else:
+                            if counter_based:
+                                u, v = philox_uniform_float32_pair(rng_states if t<=time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx, i, PHILOX_OUTER)
+                            else:
+                                u = xoroshiro128p_uniform_float32(rng_states if t<=time_to_change_seed else rng_states2, pos)
+                                v = xoroshiro128p_uniform_float32(rng_states if t<=time_to_change_seed else rng_states2, pos)
+                            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v)
+                            if i < num_draws:
+                                v *= sqrt_h
+                        v *= sign
+                        if i < num_draws:
+                            correlate(dW_corr, L_T, i, v)
+                        else:
+                            res_z[i-num_draws] = v
+                    # correlated residuals, computed in place
+                    for i in range(num_rates-1, -1, -1):
+                        e = 0.
+                        for j in range(i+1):
+                            e += res_chol[i*(i+1)//2+j] * res_z[j]
+                        res_z[i] = e
+
+                    # rate diffusions, jointly with their integrals
                     for i in range(num_rates):
-                        tmp_X[i] += diff_params[i] * \
-                            (diff_params[num_rates+i] - tmp_X[i]) * dt
-                        drift_adj = nb.float32(0)
+                        a = diff_params[i]
+                        sigma = diff_params[2*num_rates+i]
+                        b = diff_params[num_rates+i]
                         if i != 0:
-                            drift_adj = diff_params[drift_adj_start+i-1]
-                        tmp_X[i] += diff_params[2*num_rates+i] * (dW_corr[i] + drift_adj * dt)
+                            b += sigma * diff_params[drift_adj_start+i-1] / a
+                        r, r_integral = vasicek_step(tmp_X[i], a, b, sigma, h, dW_corr[i], res_z[i])
+                        tmp_X[i] = r
+                        rate_integrals[i] = r_integral
+                    tmp_dom_rate_integral = rate_integrals[0]
 
-                    tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+                    # FX log-diffusions, whose drift only involves the rate integrals
+                    for i in range(num_rates-1):
+                        tmp_X[fx_start+i] += rate_integrals[0] - rate_integrals[i+1] - 0.5*diff_params[fx_params_start+i]**2 * h + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
 
                     # spread diffusions
                     for i in range(num_spreads):
+                        spread = tmp_X[spread_start+i]
+                        tmp_X[spread_start+i] = cir_qe_step(spread, diff_params[spread_params_start+i], diff_params[spread_params_start+num_spreads+i], diff_params[spread_params_start+2*num_spreads+i], h, dW_corr[spread_start+i] / sqrt_h)
+                        tmp_spread_integrals[i] += 0.5 * (spread + tmp_X[spread_start+i]) * h
+                else:
+                    for fine_idx in range(num_fine):
+                    #for fine_idx in range(num_fine_per_coarse):
+                        for i in range(num_diffusions):
+                            dW_corr[i] = 0
+
+                        for i in range(num_draws):
+                            if counter_based:
+                                u, v = philox_uniform_float32_pair(rng_states if t<=time_to_change_seed else rng_states2, rng_pos, rng_states[3]+coarse_idx, fine_idx*num_draws+i, PHILOX_OUTER)
+                            else:
+                                u = xoroshiro128p_uniform_float32(rng_states if t<=time_to_change_seed else rng_states2, pos)
+                                v = xoroshiro128p_uniform_float32(rng_states if t<=time_to_change_seed else rng_states2, pos)
+                            v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
+                            if quasi_random:
+                                # fine increment of the Brownian bridge between the two coarse points
+                                v = bridge_rem[i] / (num_fine-fine_idx) + v * math.sqrt((num_fine-fine_idx-1) / (num_fine-fine_idx))
+                                bridge_rem[i] -= v
+                            v *= sign
+                            correlate(dW_corr, L_T, i, v)
+                        # E[Au*(Au)^T] = E[A*u*u^T*A^T] = A*Cov*A^T -> for unit Cov, it is enough to choose A=L
+                        # E[LdW*(LdW)^T] = dt*LL^T = dt*Corr
+                        # dW_corr[k] = sum_j L_{i,j} * dW_j
+
+                        # FX log-diffusions
+                        for i in range(num_rates-1):
+                            tmp_X[fx_start+i] += (tmp_X[0] - tmp_X[i+1] - 0.5*diff_params[fx_params_start+i]** 2) * dt + diff_params[fx_params_start+i] * dW_corr[fx_start+i]
+
+                        # rate diffusions
+                        # TODO: change this and diffuse jointly the short rate and its integral exactly
+                        # (but for now let's just stick with a numerical integral)
+                        tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                        for i in range(num_rates):
+                            tmp_X[i] += diff_params[i] * \
+                                (diff_params[num_rates+i] - tmp_X[i]) * dt
+                            drift_adj = nb.float32(0)
+                            if i != 0:
+                                drift_adj = diff_params[drift_adj_start+i-1]
+                            tmp_X[i] += diff_params[2*num_rates+i] * (dW_corr[i] + drift_adj * dt)
+
+                        tmp_dom_rate_integral += 0.5 * tmp_X[0] * dt
+
+                        # spread diffusions
+                        for i in range(num_spreads):
            
-                        if tmp_X[spread_start+i]<0:
-                            print('opsss')
-                        pos_spread = max(tmp_X[spread_start+i], 0)
-                        tmp_X[spread_start+i] += diff_params[spread_params_start+i] * (diff_params[spread_params_start + num_spreads+i] - pos_spread) * dt
-                        tmp_X[spread_start+i] += diff_params[spread_params_start+2*num_spreads+i] * math.sqrt(pos_spread) * dW_corr[spread_start+i]
-                        tmp_spread_integrals[i] += 0.5 * pos_spread * dt
-                        if tmp_X[spread_start+i] > 0:
-                            tmp_spread_integrals[i] += 0.5 * tmp_X[spread_start+i] * dt
+                            if tmp_X[spread_start+i]<0:
+                                print('opsss')
+                            pos_spread = max(tmp_X[spread_start+i], 0)
+                            tmp_X[spread_start+i] += diff_params[spread_params_start+i] * (diff_params[spread_params_start + num_spreads+i] - pos_spread) * dt
+                            tmp_X[spread_start+i] += diff_params[spread_params_start+2*num_spreads+i] * math.sqrt(pos_spread) * dW_corr[spread_start+i]
+                            tmp_spread_integrals[i] += 0.5 * pos_spread * dt
+                            if tmp_X[spread_start+i] > 0:
+                                tmp_spread_integrals[i] += 0.5 * tmp_X[spread_start+i] * dt
 
                 for i in range(num_rates-1):
                     tmp_X[fx_start+i] = math.exp(tmp_X[fx_start+i])
@@ -324,52 +468,102 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
                     tmp_cash_flows_by_cpty[cpty] = 0
                 
                 
-                #print('check here', t)
-                for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
-                    cuda.syncthreads()
-                    if tidx == 0:
-                        for i in range(irs_batch_size):
-                            if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
-                                for j in range(irs_f32.shape[1]):
-                                    irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
-                                for j in range(irs_i32.shape[1]):
-                                    irs_i32_sh[i, j] = irs_i32[batch_idx*irs_batch_size+i, j]
-                            else:
-                                i -= 1
-                                break
-                    else:
-                        i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
-                    cuda.syncthreads()
-                    for j in range(i+1):
-                        first_reset = irs_f32_sh[j, 0]
-                        reset_freq = irs_f32_sh[j, 1]
-                        num_resets = irs_i32_sh[j, 0]
-                        if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t:
-                            continue
-                        notional = irs_f32_sh[j, 2]
-                        cpty = irs_i32_sh[j, 1]
-                        ccy = irs_i32_sh[j, 2]
-                        fx = nb.float32(1)
-                        if ccy != 0:
-                            fx = tmp_X[num_rates + ccy - 1]
-                        a = diff_params[ccy]
-                        b = diff_params[num_rates+ccy]
-                        sigma = diff_params[2*num_rates+ccy]
-                        swap_rate = irs_f32_sh[j, 3]
-                        if t > first_reset - 0.1*dt:
-                            m = int((t - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
-                            m = int((t-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                if large_portfolio:
+                    # the swaps are grouped by counterparty, so that the MtM and the cash flows of each counterparty are
+                    # accumulated in registers, and its swaps are loaded in shared memory by all the threads of the block
+                    num_loaders = min(block_size, num_paths - block * block_size)
+                    for cpty in range(num_cpty):
+                        cpty_start = _cuda_lower_bound(irs_i32, 1, cpty, 0, irs_i32.shape[0])
+                        cpty_end = _cuda_lower_bound(irs_i32, 1, cpty+1, cpty_start, irs_i32.shape[0])
+                        if active_trades:
+                            cpty_end = _cuda_live_irs_end(irs_f32, irs_i32, cpty_start, cpty_end, t, dt)
+                        cpty_mtm = nb.float32(0)
+                        cpty_cash_flows = nb.float32(0)
+                        for batch_start in range(cpty_start, cpty_end, irs_batch_size):
+                            batch_len = min(cpty_end - batch_start, irs_batch_size)
+                            cuda.syncthreads()
+                            # coalesced loads, the specs being stored by row
+                            for k in range(tidx, batch_len*irs_f32.shape[1], num_loaders):
+                                irs_f32_sh[k // irs_f32.shape[1], k % irs_f32.shape[1]] = irs_f32[batch_start + k // irs_f32.shape[1], k % irs_f32.shape[1]]
+                            for k in range(tidx, batch_len*irs_i32.shape[1], num_loaders):
+                                irs_i32_sh[k // irs_i32.shape[1], k % irs_i32.shape[1]] = irs_i32[batch_start + k // irs_i32.shape[1], k % irs_i32.shape[1]]
+                            cuda.syncthreads()
+                            for j in range(batch_len):
+                                first_reset = irs_f32_sh[j, 0]
+                                reset_freq = irs_f32_sh[j, 1]
+                                num_resets = irs_i32_sh[j, 0]
+                                if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t:
+                                    continue
+                                notional = irs_f32_sh[j, 2]
+                                ccy = irs_i32_sh[j, 2]
+                                fx = nb.float32(1)
+                                if ccy != 0:
+                                    fx = tmp_X[num_rates + ccy - 1]
+                                a = diff_params[ccy]
+                                b = diff_params[num_rates+ccy]
+                                sigma = diff_params[2*num_rates+ccy]
+                                swap_rate = irs_f32_sh[j, 3]
+                                if t > first_reset - 0.1*dt:
+                                    m = int((t - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                                    m = int((t-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                                else:
+                                    m = nb.int32(1)
+                                price = _cuda_price_irs(ccy, swap_rate, X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
+                                cpty_mtm += notional * fx * price
+                                k = int((t-first_reset+0.1*dt)/reset_freq)
+                                is_coupon_date = (k >= 1) and (abs(t-first_reset-k*reset_freq) < 0.1*dt)
+                                if is_coupon_date:
+                                    cpty_cash_flows += notional * fx * (_cuda_price_zc_bond_inv_tab(ccy, X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos], reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq)
+                        tmp_mtm_by_cpty[cpty] = cpty_mtm
+                        tmp_cash_flows_by_cpty[cpty] = cpty_cash_flows
+                else:
+                    #print('check here', t)
+                    num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+                    for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
+                        cuda.syncthreads()
+                        if tidx == 0:
+                            for i in range(irs_batch_size):
+                                if batch_idx*irs_batch_size+i < num_irs:
+                                    for j in range(irs_f32.shape[1]):
+                                        irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
+                                    for j in range(irs_i32.shape[1]):
+                                        irs_i32_sh[i, j] = irs_i32[batch_idx*irs_batch_size+i, j]
+                                else:
+                                    i -= 1
+                                    break
                         else:
-                            m = nb.int32(1)
-                        price = _cuda_price_irs(ccy, swap_rate, X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt)
-                        for _cpty in range(num_cpty):
-                            tmp_mtm_by_cpty[_cpty] += notional * fx * price * (_cpty == cpty)
-                        k = int((t-first_reset+0.1*dt)/reset_freq)
-                        is_coupon_date = (k >= 1) and (abs(t-first_reset-k*reset_freq) < 0.1*dt)
-                        if is_coupon_date:
+                            i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
+                        cuda.syncthreads()
+                        for j in range(i+1):
+                            first_reset = irs_f32_sh[j, 0]
+                            reset_freq = irs_f32_sh[j, 1]
+                            num_resets = irs_i32_sh[j, 0]
+                            if first_reset + (num_resets - 1) * reset_freq + 0.1 * dt < t:
+                                continue
+                            notional = irs_f32_sh[j, 2]
+                            cpty = irs_i32_sh[j, 1]
+                            ccy = irs_i32_sh[j, 2]
+                            fx = nb.float32(1)
+                            if ccy != 0:
+                                fx = tmp_X[num_rates + ccy - 1]
+                            a = diff_params[ccy]
+                            b = diff_params[num_rates+ccy]
+                            sigma = diff_params[2*num_rates+ccy]
+                            swap_rate = irs_f32_sh[j, 3]
+                            if t > first_reset - 0.1*dt:
+                                m = int((t - first_reset - (num_fine_per_coarse-1)*dt) / reset_freq) # locate the strictly previous reset date in the resets grid
+                                m = int((t-first_reset-m*reset_freq+dt)/(num_fine_per_coarse*dt)) # locate it now in the coarse grid
+                            else:
+                                m = nb.int32(1)
+                            price = _cuda_price_irs(ccy, swap_rate, X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
                             for _cpty in range(num_cpty):
-                                tmp_cash_flows_by_cpty[_cpty] += notional * fx * (_cuda_price_zc_bond_inv(ccy, X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos], 0, reset_freq, a, b, sigma) - 1 - swap_rate * reset_freq) * (_cpty == cpty)
-                
+                                tmp_mtm_by_cpty[_cpty] += notional * fx * price * (_cpty == cpty)
+                            k = int((t-first_reset+0.1*dt)/reset_freq)
+                            is_coupon_date = (k >= 1) and (abs(t-first_reset-k*reset_freq) < 0.1*dt)
+                            if is_coupon_date:
+                                for _cpty in range(num_cpty):
+                                    tmp_cash_flows_by_cpty[_cpty] += notional * fx * (_cuda_price_zc_bond_inv_tab(ccy, X[coarse_idx-m+max_coarse_per_reset-1, ccy, pos], reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq) * (_cpty == cpty)
+
                 for i in range(num_diffusions):
                     X[coarse_idx+max_coarse_per_reset-1, i, pos] = tmp_X[i]
 
@@ -395,13 +589,35 @@ def compile_cuda_diffuse_and_price(irs_batch_size, vanilla_batch_size, g_diff_pa
     # finally, return the compiled kernel
     return cuda_bulk_diffuse_and_price
 
-def compile_cuda_oversimulate_defs(num_spreads, num_defs_per_path, num_paths, ntpb, stream):
+def compile_cuda_oversimulate_defs(num_spreads, num_defs_per_path, num_paths, ntpb, stream, default_times=False, cache=False):
     # compile-time constants
     num_cpty = num_spreads - 1
 
+    if default_times:
+        # records the first coarse step (step_offset+coarse_idx) at which each counterparty defaults, instead of
+        # setting the bits of the default indicators
+        sig = (nb.int32, nb.int32, nb.int32, nb.int16[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :])
+
+        @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+        def _cuda_oversimulate_default_steps(coarse_start_idx, num_coarse_steps, step_offset, default_steps, spread_integrals, exp_1):
+            block_x = cuda.blockIdx.x
+            block_y = cuda.blockIdx.y
+            block_size = cuda.blockDim.x
+            tidx = cuda.threadIdx.x
+            pos = tidx + block_y * block_size
+
+            if pos < num_paths:
+                for coarse_idx in range(coarse_start_idx, coarse_start_idx+num_coarse_steps):
+                    for i in range(num_cpty):
+                        s = spread_integrals[coarse_idx, i+1, pos]
+                        if s > exp_1[i, block_x, pos] and default_steps[i, block_x, pos] > step_offset+coarse_idx:
+                            default_steps[i, block_x, pos] = step_offset+coarse_idx
+
+        return _cuda_oversimulate_default_steps[(num_defs_per_path, (num_paths+ntpb-1)//ntpb), ntpb, stream]
+
     sig = (nb.int32, nb.int32, nb.int8[:, :, :, :], nb.float32[:, :, :], nb.float32[:, :, :])
 
-    @cuda.jit(func_or_sig=sig, max_registers=64)
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
     def _cuda_oversimulate_defs(coarse_start_idx, num_coarse_steps, def_indicators, spread_integrals, exp_1):
         block_x = cuda.blockIdx.x
         block_y = cuda.blockIdx.y
@@ -424,7 +640,64 @@ def compile_cuda_oversimulate_defs(num_spreads, num_defs_per_path, num_paths, nt
     # finally, return the compiled kernel
     return cuda_oversimulate_defs
 
-def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, stream):
+
+def compile_cuda_encode_paths(num_paths, max_dates, max_factors, ntpb, stream, storage_dtype='float16', cache=False):
+    # encodes slices of the path arrays into the 16-bit codes of compact_pl.py, one block per (date, factor)
+    quantized = storage_dtype == 'int16'
+    half = storage_dtype == 'float16'
+
+    sig = (nb.float32[:, :, :], nb.int16[:, :, :], nb.float32[:, :], nb.float32[:, :])
+
+    @cuda.jit(func_or_sig=sig, max_registers=32, cache=cache)
+    def _cuda_encode_paths(src, codes, scale, offset):
+        d = cuda.blockIdx.x
+        f = cuda.blockIdx.y
+        tidx = cuda.threadIdx.x
+        if d >= src.shape[0] or f >= src.shape[1]:
+            return
+        sc = 0.
+        off = 0.
+        inv_sc = 0.
+        if quantized:
+            # range of the factor over the paths, by a reduction in shared memory
+            s_lo = cuda.shared.array(ntpb, nb.float32)
+            s_hi = cuda.shared.array(ntpb, nb.float32)
+            lo = math.inf
+            hi = -math.inf
+            for pos in range(tidx, num_paths, ntpb):
+                lo = min(lo, src[d, f, pos])
+                hi = max(hi, src[d, f, pos])
+            s_lo[tidx] = lo
+            s_hi[tidx] = hi
+            cuda.syncthreads()
+            step = ntpb // 2
+            while step > 0:
+                if tidx < step:
+                    s_lo[tidx] = min(s_lo[tidx], s_lo[tidx+step])
+                    s_hi[tidx] = max(s_hi[tidx], s_hi[tidx+step])
+                cuda.syncthreads()
+                step //= 2
+            sc, off = int16_scale_offset(s_lo[0], s_hi[0])
+            # the codes are computed with the scale and offset as stored
+            sc = nb.float32(sc)
+            off = nb.float32(off)
+            inv_sc = 1/sc if sc > 0 else 0.
+            if tidx == 0:
+                scale[d, f] = sc
+                offset[d, f] = off
+        for pos in range(tidx, num_paths, ntpb):
+            if quantized:
+                codes[d, f, pos] = encode_int16(src[d, f, pos], inv_sc, off)
+            elif half:
+                codes[d, f, pos] = encode_float16(libdevice.float_as_int(src[d, f, pos]))
+            else:
+                codes[d, f, pos] = encode_bfloat16(libdevice.float_as_int(src[d, f, pos]))
+
+    cuda_encode_paths = _cuda_encode_paths[(max_dates, max_factors), ntpb, stream]
+
+    return cuda_encode_paths
+
+def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, stream, params_in_const=True, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
     # compile-time constants
     num_cpty = num_spreads - 1
     num_cpty_buckets = (num_cpty+7)//8
@@ -434,6 +707,9 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
     fx_params_start = 3*num_rates
     drift_adj_start = 4*num_rates - 1
     spread_start = fx_start + num_rates - 1
+    # correlation of the independent normals of a step, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, num_diffusions, corr_pattern, num_factors)
+    num_draws = num_diffusions + num_factors
     spread_params_start = fx_params_start + 2*num_rates - 2
     full_mask = nb.uint32(-1)
 
@@ -447,23 +723,36 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
             c += 1
         inner_stride = 1 << c
 
-    sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.int8[:, :, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], nb.float32[:, :, :], nb.from_dtype(xoroshiro128p_dtype)[:], nb.float32, nb.int32, nb.bool_, nb.float32[:, :], nb.float32[:, :], nb.float32)
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, the kernel then reads their values from its arguments
+        # (the compiled code, and its cache entry, no longer depend on the market parameters)
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.int8[:, :, :, :], nb.float32[:, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], nb.float32[:, :, :], rng_type, nb.float32, nb.int32, nb.bool_, nb.float32[:, :], nb.float32[:, :], nb.float32[:], nb.float32[:], nb.float32[:], nb.float32, nb.float32[:, :, :])
 
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_nested_cva(coarse_start_idx, num_coarse_steps, t, X, def_indicators, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, exp_1, rng_states, dt, window_length, indicator_in_cva, out1, out2, DT = None):
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_nested_cva(coarse_start_idx, num_coarse_steps, t, X, def_indicators, dom_rate_integral, spread_integrals, mtm_by_cpty, cash_flows_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, exp_1, rng_states, dt, window_length, indicator_in_cva, out1, out2, d_diff_params, d_R, d_L_T, DT = None, zc_tables = None):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
         tidx = cuda.threadIdx.x
         pos = tidx + block * block_size
 
-        diff_params = cuda.const.array_like(g_diff_params)
-        R = cuda.const.array_like(g_R)
+        if params_in_const:
+            diff_params = cuda.const.array_like(g_diff_params)
+            R = cuda.const.array_like(g_R)
+            L_T = cuda.const.array_like(g_L_T)
+        else:
+            diff_params = d_diff_params
+            R = d_R
+            L_T = d_L_T
         irs_f32_sh = cuda.shared.array(shape=(irs_batch_size, 4), dtype=nb.float32)
         irs_i32_sh = cuda.shared.array(shape=(irs_batch_size, 3), dtype=nb.int32)
         vanillas_on_fx_f32_sh = cuda.shared.array(shape=(vanilla_batch_size, 3), dtype=nb.float32)
         vanillas_on_fx_i32_sh = cuda.shared.array(shape=(vanilla_batch_size, 2), dtype=nb.int32)
         vanillas_on_fx_b8_sh = cuda.shared.array(shape=(vanilla_batch_size, 1), dtype=nb.bool_)
-        L_T = cuda.const.array_like(g_L_T)
         dW_corr = cuda.local.array(num_diffusions, nb.float32)
         tmp_X = cuda.local.array(num_diffusions, nb.float32)
         tmp_exp_1 = cuda.local.array((num_cpty, num_defs_per_path), nb.float32)
@@ -482,11 +771,21 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
         
         if tidx < num_inner_paths:
             sqrt_dt = math.sqrt(dt)
+            draw_idx = 0
+            rng_stream = 0
+            if counter_based:
+                # coarse_start_idx is local to the device arrays, rng_states[3] holds the global index preceding them
+                rng_stream = PHILOX_NESTED_CVA + PHILOX_NUM_STREAMS*(rng_states[3]+coarse_start_idx)
 
             for i in range(num_cpty):
                 for j in range(num_defs_per_path):
                     tmp_cva_payoff_by_cpty[i, j] = 0
-                    tmp_exp_1[i, j] = -math.log(xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)) # simulate exp1 here
+                    if counter_based:
+                        u, _ = philox_uniform_float32_pair(rng_states, block, tidx, draw_idx, rng_stream)
+                        draw_idx += 1
+                    else:
+                        u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                    tmp_exp_1[i, j] = -math.log(u) # simulate exp1 here
 
             for i in range(num_diffusions):
                 tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-1, i, block]
@@ -527,13 +826,15 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
                     for i in range(num_diffusions):
                         dW_corr[i] = 0
 
-                    for i in range(num_diffusions):
-                        u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
-                        v = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                    for i in range(num_draws):
+                        if counter_based:
+                            u, v = philox_uniform_float32_pair(rng_states, block, tidx, draw_idx, rng_stream)
+                            draw_idx += 1
+                        else:
+                            u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                            v = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
                         v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
-                        for j in range(i, num_diffusions):
-                            # L_T is the transpose of the lower-triangular L such that Corr=L*L_T
-                            dW_corr[j] += L_T[i*num_diffusions-i*(i+1)//2+j] * v
+                        correlate(dW_corr, L_T, i, v)
                     # E[Au*(Au)^T] = E[A*u*u^T*A^T] = A*Cov*A^T -> for unit Cov, it is enough to choose A=L
                     # E[LdW*(LdW)^T] = dt*LL^T = dt*Corr
                     # dW_corr[k] = sum_j L_{i,j} * dW_j
@@ -580,11 +881,12 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
                 for cpty in range(num_cpty):
                     tmp_mtm_by_cpty[cpty] = 0
 
-                for batch_idx in range((vanillas_on_fx_f32.shape[0]+vanilla_batch_size-1)//vanilla_batch_size):
+                num_vanillas = _cuda_num_live_vanillas(vanillas_on_fx_f32, t, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+                for batch_idx in range((num_vanillas+vanilla_batch_size-1)//vanilla_batch_size):
                     cuda.syncthreads()
                     if tidx == 0:
                         for i in range(vanilla_batch_size):
-                            if batch_idx*vanilla_batch_size+i < vanillas_on_fx_f32.shape[0]:
+                            if batch_idx*vanilla_batch_size+i < num_vanillas:
                                 for j in range(vanillas_on_fx_f32.shape[1]):
                                     vanillas_on_fx_f32_sh[i, j] = vanillas_on_fx_f32[batch_idx*vanilla_batch_size+i, j]
                                 for j in range(vanillas_on_fx_i32.shape[1]):
@@ -595,7 +897,7 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
                                 i -= 1
                                 break
                     else:
-                        i = min(vanillas_on_fx_f32.shape[0]-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
+                        i = min(num_vanillas-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
                     cuda.syncthreads()
                     for j in range(i+1):
                         maturity = vanillas_on_fx_f32_sh[j, 0]
@@ -620,11 +922,12 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
                         for _cpty in range(num_cpty):
                             tmp_mtm_by_cpty[_cpty] += notional * price * (_cpty == cpty)
                 
-                for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
+                num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+                for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
                     cuda.syncthreads()
                     if tidx == 0:
                         for i in range(irs_batch_size):
-                            if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
+                            if batch_idx*irs_batch_size+i < num_irs:
                                 for j in range(irs_f32.shape[1]):
                                     irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
                                 for j in range(irs_i32.shape[1]):
@@ -633,7 +936,7 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
                                 i -= 1
                                 break
                     else:
-                        i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
+                        i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
                     cuda.syncthreads()
                     for j in range(i+1):
                         first_reset = irs_f32_sh[j, 0]
@@ -657,7 +960,7 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
                             m = nb.int32(max_coarse_per_reset-m)
                         else:
                             m = nb.int32(max_coarse_per_reset-1)
-                        price = _cuda_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt)
+                        price = _cuda_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
                         tmp_mtm_by_cpty[cpty] += notional * fx * price
                 
                 discount_factor = math.exp(-tmp_dom_rate_integral)
@@ -721,7 +1024,7 @@ def compile_cuda_nested_cva(irs_batch_size, vanilla_batch_size, g_diff_params, g
     # finally, return the compiled kernel
     return cuda_nested_cva
 
-def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, stream):
+def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, stream, params_in_const=True, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
     # compile-time constants
     num_cpty = num_spreads - 1
     num_diffusions = 2*num_rates+num_spreads-1
@@ -729,6 +1032,9 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
     fx_params_start = 3*num_rates
     drift_adj_start = 4*num_rates - 1
     spread_start = fx_start + num_rates - 1
+    # correlation of the normals of the rates and FX rates, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, spread_start, corr_pattern, num_factors)
+    num_draws = spread_start + num_factors
     
     if num_inner_paths & (num_inner_paths-1) == 0:
         inner_stride = num_inner_paths
@@ -740,23 +1046,36 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
             c += 1
         inner_stride = 1 << c
 
-    sig = (nb.float32, nb.bool_, nb.float32, nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], nb.from_dtype(xoroshiro128p_dtype)[:], nb.float32, nb.float32[:, :], nb.float32[:, :], nb.float32[:, :], nb.float32[:, :], nb.float32, nb.float32, nb.int32, nb.float32)
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, the kernel then reads their values from its arguments
+        # (the compiled code, and its cache entry, no longer depend on the market parameters)
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
 
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_nested_im(alpha, adam_init, step_size, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, out1, out2, out3, out4, adam_b1, adam_b2, adam_iter, DT = None):
+    sig = (nb.float32, nb.bool_, nb.float32, nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], rng_type, nb.float32, nb.float32[:, :], nb.float32[:, :], nb.float32[:, :], nb.float32[:, :], nb.float32, nb.float32, nb.int32, nb.float32[:], nb.float32[:], nb.float32[:], nb.float32, nb.float32[:, :, :])
+
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_nested_im(alpha, adam_init, step_size, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, out1, out2, out3, out4, adam_b1, adam_b2, adam_iter, d_diff_params, d_R, d_L_T, DT = None, zc_tables = None):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
         tidx = cuda.threadIdx.x
         pos = tidx + block * block_size
 
-        diff_params = cuda.const.array_like(g_diff_params)
-        R = cuda.const.array_like(g_R)
+        if params_in_const:
+            diff_params = cuda.const.array_like(g_diff_params)
+            R = cuda.const.array_like(g_R)
+            L_T = cuda.const.array_like(g_L_T)
+        else:
+            diff_params = d_diff_params
+            R = d_R
+            L_T = d_L_T
         irs_f32_sh = cuda.shared.array(shape=(irs_batch_size, 4), dtype=nb.float32)
         irs_i32_sh = cuda.shared.array(shape=(irs_batch_size, 3), dtype=nb.int32)
         vanillas_on_fx_f32_sh = cuda.shared.array(shape=(vanilla_batch_size, 3), dtype=nb.float32)
         vanillas_on_fx_i32_sh = cuda.shared.array(shape=(vanilla_batch_size, 2), dtype=nb.int32)
         vanillas_on_fx_b8_sh = cuda.shared.array(shape=(vanilla_batch_size, 1), dtype=nb.bool_)
-        L_T = cuda.const.array_like(g_L_T)
         dW_corr = cuda.local.array(spread_start, nb.float32)
         tmp_X = cuda.local.array(spread_start, nb.float32)
         tmp_rates_sliding_window = cuda.local.array((max_coarse_per_reset, num_rates), nb.float32)
@@ -767,6 +1086,11 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
 
         if tidx < num_inner_paths:
             sqrt_dt = math.sqrt(dt)
+            draw_idx = 0
+            rng_stream = 0
+            if counter_based:
+                # coarse_start_idx is local to the device arrays, rng_states[3] holds the global index preceding them
+                rng_stream = PHILOX_NESTED_IM + PHILOX_NUM_STREAMS*(rng_states[3]+coarse_start_idx + 65536*adam_iter)
 
             for i in range(spread_start):
                 tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-1, i, block]
@@ -792,11 +1116,12 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                 discount_factor = math.exp(-tmp_dom_rate_integral)
 
                 # TODO: do it also for calls just in case calls expire inside the IM window
-                for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
+                num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+                for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
                     cuda.syncthreads()
                     if tidx == 0:
                         for i in range(irs_batch_size):
-                            if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
+                            if batch_idx*irs_batch_size+i < num_irs:
                                 for j in range(irs_f32.shape[1]):
                                     irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
                                 for j in range(irs_i32.shape[1]):
@@ -805,7 +1130,7 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                                 i -= 1
                                 break
                     else:
-                        i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
+                        i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
                     cuda.syncthreads()
                     for j in range(i+1):
                         first_reset = irs_f32_sh[j, 0]
@@ -836,7 +1161,7 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                         # is_coupon_date = False
                         if is_coupon_date:
                             for _cpty in range(num_cpty):
-                                cashflow = _cuda_price_zc_bond_inv(ccy, tmp_rates_sliding_window[m, ccy], 0, reset_freq, a, b, sigma) - 1 - swap_rate * reset_freq
+                                cashflow = _cuda_price_zc_bond_inv_tab(ccy, tmp_rates_sliding_window[m, ccy], reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq
                                 tmp_mtm_increment_by_cpty[_cpty] += notional * fx * cashflow * (_cpty == cpty) * discount_factor
                 
                 for i in range(num_rates-1):
@@ -860,14 +1185,15 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                     for i in range(spread_start):
                         dW_corr[i] = 0
 
-                    for i in range(spread_start):
-                        u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
-                        v = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                    for i in range(num_draws):
+                        if counter_based:
+                            u, v = philox_uniform_float32_pair(rng_states, block, tidx, draw_idx, rng_stream)
+                            draw_idx += 1
+                        else:
+                            u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                            v = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
                         v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
-                        # for j in range(i, num_diffusions):
-                        for j in range(i, spread_start):
-                            # L_T is the transpose of the lower-triangular L such that Corr=L*L_T
-                            dW_corr[j] += L_T[i*num_diffusions-i*(i+1)//2+j] * v
+                        correlate(dW_corr, L_T, i, v)
                     # E[Au*(Au)^T] = E[A*u*u^T*A^T] = A*Cov*A^T -> for unit Cov, it is enough to choose A=L
                     # E[LdW*(LdW)^T] = dt*LL^T = dt*Corr
                     # dW_corr[k] = sum_j L_{i,j} * dW_j
@@ -912,11 +1238,12 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
             #     print('--')
 
             discount_factor = math.exp(-tmp_dom_rate_integral)
-            for batch_idx in range((vanillas_on_fx_f32.shape[0]+vanilla_batch_size-1)//vanilla_batch_size):
+            num_vanillas = _cuda_num_live_vanillas(vanillas_on_fx_f32, t, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+            for batch_idx in range((num_vanillas+vanilla_batch_size-1)//vanilla_batch_size):
                 cuda.syncthreads()
                 if tidx == 0:
                     for i in range(vanilla_batch_size):
-                        if batch_idx*vanilla_batch_size+i < vanillas_on_fx_f32.shape[0]:
+                        if batch_idx*vanilla_batch_size+i < num_vanillas:
                             for j in range(vanillas_on_fx_f32.shape[1]):
                                 vanillas_on_fx_f32_sh[i, j] = vanillas_on_fx_f32[batch_idx*vanilla_batch_size+i, j]
                             for j in range(vanillas_on_fx_i32.shape[1]):
@@ -927,7 +1254,7 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                             i -= 1
                             break
                 else:
-                    i = min(vanillas_on_fx_f32.shape[0]-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
+                    i = min(num_vanillas-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
                 cuda.syncthreads()
                 for j in range(i+1):
                     maturity = vanillas_on_fx_f32_sh[j, 0]
@@ -952,11 +1279,12 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                     for _cpty in range(num_cpty):
                         tmp_mtm_increment_by_cpty[_cpty] += notional * price * (_cpty == cpty) * discount_factor
             
-            for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
+            num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+            for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
                 cuda.syncthreads()
                 if tidx == 0:
                     for i in range(irs_batch_size):
-                        if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
+                        if batch_idx*irs_batch_size+i < num_irs:
                             for j in range(irs_f32.shape[1]):
                                 irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
                             for j in range(irs_i32.shape[1]):
@@ -965,7 +1293,7 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                             i -= 1
                             break
                 else:
-                    i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
+                    i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
                 cuda.syncthreads()
                 for j in range(i+1):
                     first_reset = irs_f32_sh[j, 0]
@@ -989,7 +1317,7 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
                         m = nb.int32(max_coarse_per_reset-m)
                     else:
                         m = nb.int32(max_coarse_per_reset-1)
-                    price = _cuda_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt)
+                    price = _cuda_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
                     for _cpty in range(num_cpty):
                         tmp_mtm_increment_by_cpty[_cpty] += notional * fx * price * (_cpty == cpty) * discount_factor
         
@@ -1072,7 +1400,7 @@ def compile_cuda_nested_im(irs_batch_size, vanilla_batch_size, g_diff_params, g_
     # finally, return the compiled kernel
     return cuda_nested_im
 
-def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, stream):
+def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, g_L_T, num_fine_per_coarse, num_rates, num_spreads, num_defs_per_path, num_paths, num_inner_paths, max_coarse_per_reset, stream, params_in_const=True, rng='xoroshiro128p', active_trades=False, corr_pattern=None, num_factors=0, cache=False):
     # compile-time constants
     num_cpty = num_spreads - 1
     num_diffusions = 2*num_rates+num_spreads-1
@@ -1080,6 +1408,9 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
     fx_params_start = 3*num_rates
     drift_adj_start = 4*num_rates - 1
     spread_start = fx_start + num_rates - 1
+    # correlation of the normals of the rates and FX rates, see correlation_pl.py
+    correlate = compile_correlate(num_diffusions, spread_start, corr_pattern, num_factors)
+    num_draws = spread_start + num_factors
 
     if num_inner_paths & (num_inner_paths-1) == 0:
         inner_stride = num_inner_paths
@@ -1091,23 +1422,36 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
             c += 1
         inner_stride = 1 << c
 
-    sig = (nb.float32, nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], nb.from_dtype(xoroshiro128p_dtype)[:], nb.float32, nb.float32[:, :], nb.float32[:, :], nb.float32)
+    if not params_in_const:
+        # only the shapes of the parameter arrays are baked in, the kernel then reads their values from its arguments
+        # (the compiled code, and its cache entry, no longer depend on the market parameters)
+        g_diff_params, g_R, g_L_T = np.zeros_like(g_diff_params), np.zeros_like(g_R), np.zeros_like(g_L_T)
+
+    counter_based = rng in ('philox', 'sobol')
+    rng_type = nb.uint32[:] if counter_based else nb.from_dtype(xoroshiro128p_dtype)[:]
+
+    sig = (nb.float32, nb.int32, nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :], nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], rng_type, nb.float32, nb.float32[:, :], nb.float32[:, :], nb.float32[:], nb.float32[:], nb.float32[:], nb.float32, nb.float32[:, :, :])
 
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_nested_im_err(alpha, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, quantile, out, DT = None):
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_nested_im_err(alpha, coarse_start_idx, num_coarse_steps, t, X, mtm_by_cpty, irs_f32, irs_i32, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, rng_states, dt, quantile, out, d_diff_params, d_R, d_L_T, DT = None, zc_tables = None):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
         tidx = cuda.threadIdx.x
         pos = tidx + block * block_size
 
-        diff_params = cuda.const.array_like(g_diff_params)
-        R = cuda.const.array_like(g_R)
+        if params_in_const:
+            diff_params = cuda.const.array_like(g_diff_params)
+            R = cuda.const.array_like(g_R)
+            L_T = cuda.const.array_like(g_L_T)
+        else:
+            diff_params = d_diff_params
+            R = d_R
+            L_T = d_L_T
         irs_f32_sh = cuda.shared.array(shape=(irs_batch_size, 4), dtype=nb.float32)
         irs_i32_sh = cuda.shared.array(shape=(irs_batch_size, 3), dtype=nb.int32)
         vanillas_on_fx_f32_sh = cuda.shared.array(shape=(vanilla_batch_size, 3), dtype=nb.float32)
         vanillas_on_fx_i32_sh = cuda.shared.array(shape=(vanilla_batch_size, 2), dtype=nb.int32)
         vanillas_on_fx_b8_sh = cuda.shared.array(shape=(vanilla_batch_size, 1), dtype=nb.bool_)
-        L_T = cuda.const.array_like(g_L_T)
         dW_corr = cuda.local.array(spread_start, nb.float32)
         tmp_X = cuda.local.array(spread_start, nb.float32)
         tmp_rates_sliding_window = cuda.local.array((max_coarse_per_reset, num_rates), nb.float32)
@@ -1118,6 +1462,11 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
 
         if tidx < num_inner_paths:
             sqrt_dt = math.sqrt(dt)
+            draw_idx = 0
+            rng_stream = 0
+            if counter_based:
+                # coarse_start_idx is local to the device arrays, rng_states[3] holds the global index preceding them
+                rng_stream = PHILOX_NESTED_IM_ERR + PHILOX_NUM_STREAMS*(rng_states[3]+coarse_start_idx)
 
             for i in range(spread_start):
                 tmp_X[i] = X[coarse_start_idx+max_coarse_per_reset-1, i, block]
@@ -1143,11 +1492,12 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                 discount_factor = math.exp(-tmp_dom_rate_integral)
 
                 # TODO: do it also for calls just in case calls expire inside the IM window
-                for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
+                num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+                for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
                     cuda.syncthreads()
                     if tidx == 0:
                         for i in range(irs_batch_size):
-                            if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
+                            if batch_idx*irs_batch_size+i < num_irs:
                                 for j in range(irs_f32.shape[1]):
                                     irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
                                 for j in range(irs_i32.shape[1]):
@@ -1156,7 +1506,7 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                                 i -= 1
                                 break
                     else:
-                        i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
+                        i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
                     cuda.syncthreads()
                     for j in range(i+1):
                         first_reset = irs_f32_sh[j, 0]
@@ -1187,7 +1537,7 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                         # is_coupon_date = False
                         if is_coupon_date:
                             for _cpty in range(num_cpty):
-                                cashflow = _cuda_price_zc_bond_inv(ccy, tmp_rates_sliding_window[m, ccy], 0, reset_freq, a, b, sigma) - 1 - swap_rate * reset_freq
+                                cashflow = _cuda_price_zc_bond_inv_tab(ccy, tmp_rates_sliding_window[m, ccy], reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq
                                 tmp_mtm_increment_by_cpty[_cpty] += notional * fx * cashflow * (_cpty == cpty) * discount_factor
                 
                 for i in range(num_rates-1):
@@ -1211,14 +1561,15 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                     for i in range(spread_start):
                         dW_corr[i] = 0
 
-                    for i in range(spread_start):
-                        u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
-                        v = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                    for i in range(num_draws):
+                        if counter_based:
+                            u, v = philox_uniform_float32_pair(rng_states, block, tidx, draw_idx, rng_stream)
+                            draw_idx += 1
+                        else:
+                            u = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
+                            v = xoroshiro128p_uniform_float32(rng_states, num_paths*num_defs_per_path+pos)
                         v = math.sqrt(-2*math.log(u)) * math.cos(2*math.pi*v) * sqrt_dt # Box-Muller, throwing the other normal away
-                        # for j in range(i, num_diffusions):
-                        for j in range(i, spread_start):
-                            # L_T is the transpose of the lower-triangular L such that Corr=L*L_T
-                            dW_corr[j] += L_T[i*num_diffusions-i*(i+1)//2+j] * v
+                        correlate(dW_corr, L_T, i, v)
                     # E[Au*(Au)^T] = E[A*u*u^T*A^T] = A*Cov*A^T -> for unit Cov, it is enough to choose A=L
                     # E[LdW*(LdW)^T] = dt*LL^T = dt*Corr
                     # dW_corr[k] = sum_j L_{i,j} * dW_j
@@ -1263,11 +1614,12 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
             #     print('--')
 
             discount_factor = math.exp(-tmp_dom_rate_integral)
-            for batch_idx in range((vanillas_on_fx_f32.shape[0]+vanilla_batch_size-1)//vanilla_batch_size):
+            num_vanillas = _cuda_num_live_vanillas(vanillas_on_fx_f32, t, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+            for batch_idx in range((num_vanillas+vanilla_batch_size-1)//vanilla_batch_size):
                 cuda.syncthreads()
                 if tidx == 0:
                     for i in range(vanilla_batch_size):
-                        if batch_idx*vanilla_batch_size+i < vanillas_on_fx_f32.shape[0]:
+                        if batch_idx*vanilla_batch_size+i < num_vanillas:
                             for j in range(vanillas_on_fx_f32.shape[1]):
                                 vanillas_on_fx_f32_sh[i, j] = vanillas_on_fx_f32[batch_idx*vanilla_batch_size+i, j]
                             for j in range(vanillas_on_fx_i32.shape[1]):
@@ -1278,7 +1630,7 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                             i -= 1
                             break
                 else:
-                    i = min(vanillas_on_fx_f32.shape[0]-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
+                    i = min(num_vanillas-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
                 cuda.syncthreads()
                 for j in range(i+1):
                     maturity = vanillas_on_fx_f32_sh[j, 0]
@@ -1303,11 +1655,12 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                     for _cpty in range(num_cpty):
                         tmp_mtm_increment_by_cpty[_cpty] += notional * price * (_cpty == cpty) * discount_factor
             
-            for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
+            num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+            for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
                 cuda.syncthreads()
                 if tidx == 0:
                     for i in range(irs_batch_size):
-                        if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
+                        if batch_idx*irs_batch_size+i < num_irs:
                             for j in range(irs_f32.shape[1]):
                                 irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
                             for j in range(irs_i32.shape[1]):
@@ -1316,7 +1669,7 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                             i -= 1
                             break
                 else:
-                    i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
+                    i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
                 cuda.syncthreads()
                 for j in range(i+1):
                     first_reset = irs_f32_sh[j, 0]
@@ -1340,7 +1693,7 @@ def compile_cuda_nested_im_err(irs_batch_size, vanilla_batch_size, g_diff_params
                         m = nb.int32(max_coarse_per_reset-m)
                     else:
                         m = nb.int32(max_coarse_per_reset-1)
-                    price = _cuda_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt)
+                    price = _cuda_price_irs(ccy, swap_rate, tmp_rates_sliding_window[m, ccy], tmp_X[ccy], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
                     for _cpty in range(num_cpty):
                         tmp_mtm_increment_by_cpty[_cpty] += notional * fx * price * (_cpty == cpty) * discount_factor
         
@@ -1401,7 +1754,65 @@ def _cuda_price_zc_bond_inv(ccy, r_t, t, mat, a, b, sigma):
     return math.exp(B*r_t-A)
 
 @cuda.jit(device=True, inline=True)
-def _cuda_price_irs(ccy, swap_rate, r_prev_reset, r_t, t, first_reset, reset_freq, num_resets, only_fixed_leg, a, b, sigma, dt):
+def _cuda_price_zc_bond_tab(ccy, r_t, tau, a, b, sigma, zc_tables, dt):
+    # zero-coupon bond of maturity t+tau, with the coefficients of zc_tables when tau lies on the fine grid (see
+    # zc_tables_pl.py)
+    n = int(tau/dt+0.5)
+    if n >= 0 and n < zc_tables.shape[2] and abs(tau-n*dt) < 0.1*dt:
+        return math.exp(zc_tables[0, ccy, n]-zc_tables[1, ccy, n]*r_t)
+    return _cuda_price_zc_bond(ccy, r_t, 0, tau, a, b, sigma)
+
+@cuda.jit(device=True, inline=True)
+def _cuda_price_zc_bond_inv_tab(ccy, r_t, tau, a, b, sigma, zc_tables, dt):
+    n = int(tau/dt+0.5)
+    if n >= 0 and n < zc_tables.shape[2] and abs(tau-n*dt) < 0.1*dt:
+        return math.exp(zc_tables[1, ccy, n]*r_t-zc_tables[0, ccy, n])
+    return _cuda_price_zc_bond_inv(ccy, r_t, 0, tau, a, b, sigma)
+
+@cuda.jit(device=True, inline=True)
+def _cuda_num_live_irs(irs_f32, irs_i32, t, dt):
+    # with active_trades, the swaps are sorted by decreasing final date, so that the swaps still alive at t are the
+    # first ones: their number is found by a binary search on the expiry test of the pricing loops
+    return _cuda_live_irs_end(irs_f32, irs_i32, 0, irs_f32.shape[0], t, dt)
+
+@cuda.jit(device=True, inline=True)
+def _cuda_live_irs_end(irs_f32, irs_i32, lo, hi, t, dt):
+    # end of the swaps still alive at t among the rows [lo, hi), sorted by decreasing final date
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if irs_f32[mid, 0] + (irs_i32[mid, 0] - 1) * irs_f32[mid, 1] + 0.1 * dt < t:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+@cuda.jit(device=True, inline=True)
+def _cuda_num_live_vanillas(vanillas_on_fx_f32, t, dt):
+    # same for the vanilla options, sorted by decreasing maturity
+    lo = 0
+    hi = vanillas_on_fx_f32.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if vanillas_on_fx_f32[mid, 0] + 0.1 * dt < t:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+@cuda.jit(device=True, inline=True)
+def _cuda_lower_bound(ary, col, value, lo, hi):
+    # first row of [lo, hi) whose column col is at least value, the rows being sorted by increasing column col
+    # (with large_portfolio, the first swap of a counterparty)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if ary[mid, col] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+@cuda.jit(device=True, inline=True)
+def _cuda_price_irs(ccy, swap_rate, r_prev_reset, r_t, t, first_reset, reset_freq, num_resets, only_fixed_leg, a, b, sigma, dt, zc_tables):
     if(t > first_reset+(num_resets-1)*reset_freq+0.1*dt):
         return nb.float32(0)
     fixed_leg = nb.float32(0)
@@ -1412,24 +1823,22 @@ def _cuda_price_irs(ccy, swap_rate, r_prev_reset, r_t, t, first_reset, reset_fre
     zc_last = nb.float32(1.)
     for i in range(k+1, num_resets):
         reset += reset_freq
-        zc_last = _cuda_price_zc_bond(ccy, r_t, t, reset, a, b, sigma)
+        zc_last = _cuda_price_zc_bond_tab(ccy, r_t, reset-t, a, b, sigma, zc_tables, dt)
         fixed_leg += zc_last
     fixed_leg *= reset_freq * swap_rate
     if t < first_reset - 0.1*dt:
-        floating_leg = _cuda_price_zc_bond(
-            ccy, r_t, t, first_reset, a, b, sigma) - zc_last
+        floating_leg = _cuda_price_zc_bond_tab(ccy, r_t, first_reset-t, a, b, sigma, zc_tables, dt) - zc_last
     elif abs(t-first_reset-k*reset_freq) < 0.1*dt:
         if k == 0:
             floating_leg = 1 - zc_last
         else:
-            floating_leg = _cuda_price_zc_bond_inv(ccy, r_prev_reset, 0, reset_freq, a, b, sigma) - zc_last
+            floating_leg = _cuda_price_zc_bond_inv_tab(ccy, r_prev_reset, reset_freq, a, b, sigma, zc_tables, dt) - zc_last
             fixed_leg += reset_freq * swap_rate
     else:
         t_next_reset = first_reset + (k+1) * reset_freq
-        floating_leg = _cuda_price_zc_bond(ccy, r_t, t, t_next_reset, a, b, sigma)*_cuda_price_zc_bond_inv(ccy, r_prev_reset,
-                                                                                                       0,
-                                                                                                       reset_freq, a, b,
-                                                                                                       sigma) - zc_last
+        floating_leg = _cuda_price_zc_bond_tab(ccy, r_t, t_next_reset-t, a, b, sigma, zc_tables, dt)*_cuda_price_zc_bond_inv_tab(ccy, r_prev_reset,
+                                                                                                                       reset_freq, a, b,
+                                                                                                                       sigma, zc_tables, dt) - zc_last
     if only_fixed_leg:
         return fixed_leg
     else:
@@ -1462,16 +1871,21 @@ def _cuda_price_vanilla_on_fx(call_put, stk, t, mat, r_d_t, r_f_t, fx_t, rho_fx_
         return -zc_f*fx_t*_cuda_norm_cdf(-d_1)+zc_d*stk*_cuda_norm_cdf(-d_2)
 
 def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params, g_R, num_fine_per_coarse, num_rates, num_spreads,
-                             num_paths, ntpb, stream):
+                             num_paths, ntpb, stream, params_in_const=True, active_trades=False, pathwise_params=True, cache=False):
     # compile-time constants
     num_diffusions = 2*num_rates+num_spreads-1
     num_diff_params = 5*num_rates-2+3*num_spreads
+
+    if not params_in_const:
+        # see compile_cuda_diffuse_and_price
+        g_diff_params, g_R = np.zeros_like(g_diff_params), np.zeros_like(g_R)
+
     sig = (nb.int32, nb.float32, nb.float32[:, :, :], nb.float32[:, :, :], nb.float32[:, :, :], 
            nb.float32[:, :], nb.int32[:, :], nb.bool_[:, :], 
            nb.float32[:, :], nb.int32[:, :], nb.float32[:, :], nb.int32[:, :], 
-           nb.float32, nb.int32, nb.int32, nb.bool_, nb.float32[:, :])
-    @cuda.jit(func_or_sig=sig, max_registers=64)
-    def _cuda_compute_mtm(coarse_idx, t, X, mtm_by_cpty, cash_flows_by_cpty, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, irs_f32, irs_i32, zcs_f32, zcs_i32, dt, max_coarse_per_reset, window_length, set_irs_at_par, d_pathwise_diff_params):
+           nb.float32, nb.int32, nb.int32, nb.bool_, nb.float32[:], nb.float32[:], nb.float32[:, :], nb.float32[:, :, :])
+    @cuda.jit(func_or_sig=sig, max_registers=64, cache=cache)
+    def _cuda_compute_mtm(coarse_idx, t, X, mtm_by_cpty, cash_flows_by_cpty, vanillas_on_fx_f32, vanillas_on_fx_i32, vanillas_on_fx_b8, irs_f32, irs_i32, zcs_f32, zcs_i32, dt, max_coarse_per_reset, window_length, set_irs_at_par, d_diff_params, d_R, d_pathwise_diff_params, zc_tables = None):
         block = cuda.blockIdx.x
         block_size = cuda.blockDim.x
         tidx = cuda.threadIdx.x
@@ -1479,13 +1893,20 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
 
         if pos < num_paths:
             # TODO: price on a range of coarse steps, should minimize global->shared copies
-            if False:
-                diff_params = cuda.const.array_like(g_diff_params)
+            if not pathwise_params:
+                # see compile_cuda_diffuse_and_price
+                if params_in_const:
+                    diff_params = cuda.const.array_like(g_diff_params)
+                else:
+                    diff_params = d_diff_params
             else:
                 diff_params = cuda.local.array(num_diff_params, dtype=nb.float32) # [TODO] use len(g_diff_params) instead of 75
                 #diff_params = g_diff_params[:]
                 diff_params = d_pathwise_diff_params[num_diffusions:, pos]
-            R = cuda.const.array_like(g_R)
+            if params_in_const:
+                R = cuda.const.array_like(g_R)
+            else:
+                R = d_R
             irs_f32_sh = cuda.shared.array(shape=(irs_batch_size, 4), dtype=nb.float32)
             irs_i32_sh = cuda.shared.array(shape=(irs_batch_size, 3), dtype=nb.int32)
             vanillas_on_fx_f32_sh = cuda.shared.array(shape=(vanilla_batch_size, 3), dtype=nb.float32)
@@ -1496,11 +1917,12 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
                 mtm_by_cpty[coarse_idx, cpty, pos] = 0.
                 cash_flows_by_cpty[coarse_idx, cpty, pos] = 0.
 
-            for batch_idx in range((vanillas_on_fx_f32.shape[0]+vanilla_batch_size-1)//vanilla_batch_size):
+            num_vanillas = _cuda_num_live_vanillas(vanillas_on_fx_f32, t, dt) if active_trades else vanillas_on_fx_f32.shape[0]
+            for batch_idx in range((num_vanillas+vanilla_batch_size-1)//vanilla_batch_size):
                 cuda.syncthreads()
                 if tidx == 0:
                     for i in range(vanilla_batch_size):
-                        if batch_idx*vanilla_batch_size+i < vanillas_on_fx_f32.shape[0]:
+                        if batch_idx*vanilla_batch_size+i < num_vanillas:
                             for j in range(vanillas_on_fx_f32.shape[1]):
                                 vanillas_on_fx_f32_sh[i, j] = vanillas_on_fx_f32[batch_idx*vanilla_batch_size+i, j]
                             for j in range(vanillas_on_fx_i32.shape[1]):
@@ -1511,7 +1933,7 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
                             i -= 1
                             break
                 else:
-                    i = min(vanillas_on_fx_f32.shape[0]-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
+                    i = min(num_vanillas-batch_idx*vanilla_batch_size, vanilla_batch_size)-1
                 cuda.syncthreads()
                 for j in range(i+1):
                     maturity = vanillas_on_fx_f32_sh[j, 0]
@@ -1545,11 +1967,12 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
 
             # FIXME: to be tested, this is a first implementation of using shared mem as fast buffer
             # for IRS specs
-            for batch_idx in range((irs_f32.shape[0]+irs_batch_size-1)//irs_batch_size):
+            num_irs = _cuda_num_live_irs(irs_f32, irs_i32, t, dt) if active_trades else irs_f32.shape[0]
+            for batch_idx in range((num_irs+irs_batch_size-1)//irs_batch_size):
                 cuda.syncthreads()
                 if tidx == 0:
                     for i in range(irs_batch_size):
-                        if batch_idx*irs_batch_size+i < irs_f32.shape[0]:
+                        if batch_idx*irs_batch_size+i < num_irs:
                             for j in range(irs_f32.shape[1]):
                                 irs_f32_sh[i, j] = irs_f32[batch_idx*irs_batch_size+i, j]
                             for j in range(irs_i32.shape[1]):
@@ -1558,7 +1981,7 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
                             i -= 1
                             break
                 else:
-                    i = min(irs_f32.shape[0]-batch_idx*irs_batch_size, irs_batch_size)-1
+                    i = min(num_irs-batch_idx*irs_batch_size, irs_batch_size)-1
                 cuda.syncthreads()
                 for j in range(i+1):
                     first_reset = irs_f32_sh[j, 0]
@@ -1577,9 +2000,9 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
                     sigma = diff_params[2*num_rates+ccy]
                     if set_irs_at_par and coarse_idx==0:
                         fixed = _cuda_price_irs(ccy, 1., 0., X[max_coarse_per_reset-1, ccy, pos], 0., first_reset, reset_freq,
-                                                num_resets, True, a, b, sigma, dt)
+                                                num_resets, True, a, b, sigma, dt, zc_tables)
                         floating = _cuda_price_irs(ccy, 0., 0., X[max_coarse_per_reset-1, ccy, pos], 0., first_reset, reset_freq,
-                                                num_resets, False, a, b, sigma, dt)
+                                                num_resets, False, a, b, sigma, dt, zc_tables)
                         swap_rate = floating/fixed
                         if pos == 0:
                             irs_f32[batch_idx*irs_batch_size+j, 3] = swap_rate
@@ -1593,12 +2016,12 @@ def compile_cuda_compute_mtm(irs_batch_size, vanilla_batch_size, g_diff_params,
                         m = (m-coarse_idx+num_coarse_per_reset) % window_length + coarse_idx-num_coarse_per_reset # locate in (extended) local window
                     else:
                         m = 0
-                    price = _cuda_price_irs(ccy, swap_rate, X[m+max_coarse_per_reset-1, ccy, pos], X[coarse_idx+max_coarse_per_reset-1, ccy, pos], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt)
+                    price = _cuda_price_irs(ccy, swap_rate, X[m+max_coarse_per_reset-1, ccy, pos], X[coarse_idx+max_coarse_per_reset-1, ccy, pos], t, first_reset, reset_freq, num_resets, False, a, b, sigma, dt, zc_tables)
                     mtm_by_cpty[coarse_idx, cpty, pos] += notional * fx * price
                     k = int((t-first_reset+0.1*dt)/reset_freq)
                     is_coupon_date = (k >= 1) and (abs(t-first_reset-k*reset_freq) < 0.1*dt)
                     if is_coupon_date:
-                        cash_flows_by_cpty[coarse_idx, cpty, pos] += notional * fx * (_cuda_price_zc_bond_inv(ccy, X[m+max_coarse_per_reset-1, ccy, pos], 0, reset_freq, a, b, sigma) - 1 - swap_rate * reset_freq)
+                        cash_flows_by_cpty[coarse_idx, cpty, pos] += notional * fx * (_cuda_price_zc_bond_inv_tab(ccy, X[m+max_coarse_per_reset-1, ccy, pos], reset_freq, a, b, sigma, zc_tables, dt) - 1 - swap_rate * reset_freq)
 
     #_cuda_compute_mtm._func.get().cache_config(prefer_shared=True)
     cuda_compute_mtm = _cuda_compute_mtm[(num_paths+ntpb-1)//ntpb, ntpb, stream]
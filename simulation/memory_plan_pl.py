@@ -0,0 +1,353 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Memory footprint of a DiffusionEngine and of the CVA estimator trained on its paths, computed from the constructor
+# arguments without allocating anything.
+#
+# engine_arrays lists every host and device array of the engine with its shape and dtype, mirroring
+# _allocate_host_arrays, _allocate_device_arrays and the lazily allocated ones: the nested CVA & IM arrays (when
+# 'nested_cva' / 'nested_im'), the second RNG states of generate_batch(time_to_change_seed=...) ('reseed'), the
+# pinned ring of generate_batch_stream ('stream') and the host copy of the parameters drawn from a ShockSpec
+# ('params_to_host'). estimator_arrays lists the working set of a time step of
+# CVAEstimatorPortfolioInt (labels, mini-batch of features, network and its optimizer), the autograd activations
+# being estimated as two (batch_size, num_hidden_units) float32 buffers per hidden layer. With backend='cpu', the
+# "device" arrays are numpy arrays too, and are counted as host memory.
+#
+# plan_memory sums them up and, given a device and/or host budget, picks the largest cDtoH_freq and estimator
+# batch_size (at most the requested one, and among the sizes the estimator accepts) that fit.
+
+import inspect
+from collections import namedtuple
+import numpy as np
+from numba.cuda.random import xoroshiro128p_dtype
+
+from simulation.compact_pl import COMPACT_ARRAYS
+from simulation.compression_pl import compress_irs, compress_vanillas
+from simulation.sobol_pl import sobol_states
+from simulation.zc_tables_pl import num_zc_offsets
+from simulation.correlation_pl import factor_size
+from simulation.shocks_pl import ShockSpec
+
+# one array: name, memory ('host' or 'device'), pinned (page-locked host memory), shape, dtype and when it is allocated
+# ('engine' / 'estimator': always, 'nested_cva', 'nested_im', 'reseed', 'stream', 'params_to_host': on first use of the
+# feature)
+ArraySpec = namedtuple('ArraySpec', ('name', 'memory', 'pinned', 'shape', 'dtype', 'when'))
+
+OPTIONAL_FEATURES = ('nested_cva', 'nested_im', 'reseed', 'stream', 'params_to_host')
+
+
+def array_nbytes(spec):
+    return int(np.prod(spec.shape, dtype=np.int64)) * np.dtype(spec.dtype).itemsize
+
+
+def _engine_arguments(engine_args, engine_kwargs):
+    # arguments of DiffusionEngine by name, defaults included
+    from simulation.diffusion_engine_pl import DiffusionEngine
+    bound = inspect.signature(DiffusionEngine.__init__).bind(None, *engine_args, **(engine_kwargs or {}))
+    bound.apply_defaults()
+    return bound
+
+
+def engine_arrays(engine_args, engine_kwargs=None, stream_buffers=2):
+    # ArraySpec of every array of DiffusionEngine(*engine_args, **engine_kwargs), stream_buffers being the num_buffers
+    # of generate_batch_stream
+    from simulation.diffusion_engine_pl import STREAMED_ARRAYS
+    a = _engine_arguments(engine_args, engine_kwargs).arguments
+    cuda = a['backend'] == 'cuda'
+    P, D, I = a['num_paths'], a['num_defs_per_path'], a['num_inner_paths']
+    S = a['num_spreads']
+    C = S - 1
+    B = (C+7)//8
+    num_diffusions = 2*a['num_rates']+S-1
+    num_market_params = 5*a['num_rates']-2+3*S
+    num_dates = a['num_coarse_steps'] + 1 + (0 if a['early_pricing_date'] is None else len(a['early_pricing_date']))
+    c = a['cDtoH_freq']
+    irs_specs = a['irs_specs']
+    max_coarse_per_reset = max(int((irs_specs['reset_freq'].max()+a['dt'])/a['dT']), 1) if irs_specs.size > 0 else 1
+    outputs = STREAMED_ARRAYS if a['outputs'] is None else tuple(name for name in STREAMED_ARRAYS if name in a['outputs'])
+    if a['default_times']:
+        outputs = tuple(name for name in outputs if name != 'def_indicators')
+    compact_outputs = tuple(name for name in outputs if name in COMPACT_ARRAYS) if a['storage_dtype'] != 'float32' else ()
+    dates = {name: num_dates if a['full_host_arrays'] and name in outputs and name not in compact_outputs else 1 for name in STREAMED_ARRAYS}
+    path_shapes = {'X': (num_diffusions, P), 'mtm_by_cpty': (C, P), 'cash_flows_by_cpty': (C, P), 'cash_pos_by_cpty': (C, P),
+                   'spread_integrals': (S, P), 'dom_rate_integral': (P,), 'def_indicators': (B, D, P)}
+    path_dtypes = dict.fromkeys(STREAMED_ARRAYS, np.float32)
+    path_dtypes['def_indicators'] = np.int8
+
+    arrays = []
+
+    def host(name, shape, dtype, when='engine', pinned=True):
+        arrays.append(ArraySpec(name, 'host', pinned and cuda, tuple(shape), np.dtype(dtype), when))
+
+    def device(name, shape, dtype, when='engine'):
+        arrays.append(ArraySpec(name, 'device' if cuda else 'host', False, tuple(shape), np.dtype(dtype), when))
+
+    # host arrays of the paths, the reduced-precision codes and the default steps
+    for name in STREAMED_ARRAYS:
+        host(name, (dates[name],) + path_shapes[name], path_dtypes[name])
+    if a['default_times']:
+        host('default_steps', (C, D, P), np.int16)
+    codes_dates = num_dates if a['full_host_arrays'] else 1
+    for name in compact_outputs:
+        host(name+'_codes', (codes_dates,) + path_shapes[name], np.int16)
+        if a['storage_dtype'] == 'int16':
+            host(name+'_scale', (codes_dates,) + path_shapes[name][:-1], np.float32)
+            host(name+'_offset', (codes_dates,) + path_shapes[name][:-1], np.float32)
+    # market parameters, product specs and pathwise parameters
+    g_size = num_diffusions*(num_diffusions+1)//2
+    num_vanillas, num_zcs = a['vanilla_specs'].size, a['zcs_specs'].size
+    priced_irs = irs_specs
+    if a['compress_portfolio']:
+        num_vanillas, priced_irs = compress_vanillas(a['vanilla_specs'])[0].size, compress_irs(irs_specs)[0]
+    num_irs = priced_irs.size
+    market = [('R', (num_diffusions, num_diffusions), np.float32), ('g_R', (g_size,), np.float32), ('g_L_T', (factor_size(a['correlation'], num_diffusions),), np.float32),
+              ('g_diff_params', (num_market_params,), np.float32),
+              ('zc_tables', (2, a['num_rates'], num_zc_offsets(priced_irs, np.float32(a['dt']))), np.float32)]
+    specs = [('vanillas_on_fx_f32', (num_vanillas, 3), np.float32), ('vanillas_on_fx_i32', (num_vanillas, 2), np.int32),
+             ('vanillas_on_fx_b8', (num_vanillas, 1), np.bool_), ('irs_f32', (num_irs, 4), np.float32), ('irs_i32', (num_irs, 3), np.int32),
+             ('zcs_f32', (num_zcs, 2), np.float32), ('zcs_i32', (num_zcs, 2), np.int32)]
+    for name, shape, dtype in market + specs:
+        host(name, shape, dtype, pinned=False)
+    # the parameters drawn from a ShockSpec are only copied to the host on first access to pathwise_diff_para
+    spec = isinstance(a['pathwise_diff_para'], ShockSpec)
+    host('pathwise_diff_para', (num_diffusions+num_market_params, P), np.float32, 'params_to_host' if spec else 'engine', pinned=False)
+    if a['pathwise_diff_para'] is not None and not spec:
+        host('pathwise_diff_shock', (num_diffusions+num_market_params, P), np.float32, pinned=False)
+    # initial RNG states, kept in a pool of rng_pool_size seeds with xoroshiro128p
+    if a['rng'] == 'xoroshiro128p':
+        rng_shape, rng_dtype = (P*(D+I),), xoroshiro128p_dtype
+        host('rng_state_pool', rng_shape, rng_dtype, pinned=False)
+        if a['rng_pool_size'] > 1:
+            host('rng_state_pool', rng_shape, rng_dtype, 'reseed', pinned=False)
+    elif a['rng'] == 'philox':
+        rng_shape, rng_dtype = (4,), np.uint32
+    else:
+        rng_shape, rng_dtype = sobol_states(0, 0, 0, a['num_coarse_steps'], num_diffusions).shape, np.uint32
+
+    # device arrays, the slices of cDtoH_freq coarse steps being doubled with double_buffering
+    device('d_exp_1', (C, D, P), np.float32)
+    slices = [('d_X', (c+max_coarse_per_reset, num_diffusions, P), np.float32), ('d_spread_integrals', (c+1, S, P), np.float32),
+              ('d_dom_rate_integral', (c+1, P), np.float32), ('d_def_indicators', (c+1, B, D, P), np.int8),
+              ('d_mtm_by_cpty', (c+1, C, P), np.float32), ('d_cash_flows_by_cpty', (c+1, C, P), np.float32),
+              ('d_cash_pos_by_cpty', (c+1, C, P), np.float32)]
+    for name in compact_outputs:
+        # the scales and offsets are allocated on the device for all the storage dtypes, but only copied with 'int16'
+        slices.append(('d_'+name+'_codes', (c,) + path_shapes[name], np.int16))
+        slices.append(('d_'+name+'_scale', (c,) + path_shapes[name][:-1], np.float32))
+        slices.append(('d_'+name+'_offset', (c,) + path_shapes[name][:-1], np.float32))
+    for name, shape, dtype in slices:
+        device(name, shape, dtype)
+    if a['double_buffering']:
+        double_buffered = tuple('d_'+name for name in STREAMED_ARRAYS) + tuple(
+            'd_'+name+suffix for name in compact_outputs for suffix in (('_codes', '_scale', '_offset') if a['storage_dtype'] == 'int16' else ('_codes',)))
+        for name, shape, dtype in slices:
+            if name in double_buffered:
+                device(name+' (2nd buffer)', shape, dtype)
+    if a['default_times']:
+        device('d_default_steps', (C, D, P), np.int16)
+    for name, shape, dtype in market[1:] + specs:
+        device('d_'+name, shape, dtype)
+    device('d_no_zc_tables', (2, a['num_rates'], 0), np.float32)
+    # only allocated when the shocks move the diffusion parameters (see DiffusionEngine._shocks_params), or are drawn
+    # from a ShockSpec
+    pathwise_params = spec or (a['pathwise_diff_para'] is not None and bool(a['pathwise_diff_para'][num_diffusions:].any()))
+    device('d_pathwise_diff_para', (num_diffusions+num_market_params, P if pathwise_params else 0), np.float32)
+    device('d_rng_states', rng_shape, rng_dtype)
+    device('d_rng_states2', rng_shape, rng_dtype, 'reseed')
+
+    # lazily allocated arrays of the nested CVA & IM (nested_cva_sq never has the early pricing dates)
+    if not a['no_nested_cva']:
+        host('nested_cva', (num_dates, D, P), np.float32, 'nested_cva')
+        host('nested_cva_sq', (a['num_coarse_steps']+1, D, P), np.float32, 'nested_cva')
+        for name in ('d_nested_cva', 'd_nested_cva_sq'):
+            device(name, (D, P), np.float32, 'nested_cva')
+    if not a['no_nested_im']:
+        for name in ('nested_im_by_cpty', 'nested_im_err_by_cpty'):
+            host(name, (num_dates, C, P), np.float32, 'nested_im')
+        for name in ('d_nested_im_by_cpty', 'd_nested_im_err_by_cpty', 'd_nested_im_std_by_cpty', 'd_nested_im_m', 'd_nested_im_v'):
+            device(name, (C, P), np.float32, 'nested_im')
+
+    # ring of generate_batch_stream
+    stream_keys = []
+    for name in outputs:
+        if name in compact_outputs:
+            stream_keys.append((name+'_codes', path_shapes[name], np.int16))
+            if a['storage_dtype'] == 'int16':
+                stream_keys += [(name+'_scale', path_shapes[name][:-1], np.float32), (name+'_offset', path_shapes[name][:-1], np.float32)]
+        else:
+            stream_keys.append((name, path_shapes[name], path_dtypes[name]))
+    for k in range(stream_buffers):
+        for name, shape, dtype in stream_keys:
+            host('{} (stream buffer {})'.format(name, k), (c,) + shape, dtype, 'stream')
+    return arrays
+
+
+def estimator_batch_sizes(engine_args, engine_kwargs=None, antithetic=False):
+    # mini-batch sizes accepted by CVAEstimatorPortfolioInt, in increasing order: the divisors of num_paths and the
+    # multiples of num_paths by a divisor of num_defs_per_path (even with antithetic paths)
+    a = _engine_arguments(engine_args, engine_kwargs).arguments
+    P, D = a['num_paths'], a['num_defs_per_path']
+    sizes = [b for b in range(1, P+1) if P % b == 0] + [k*P for k in range(2, D+1) if D % k == 0]
+    return [b for b in sizes if not antithetic or b % 2 == 0]
+
+
+def estimator_arrays(engine_args, engine_kwargs=None, batch_size=None, num_hidden_layers=2, num_hidden_units=32,
+                     include_para_as_fea=False, labels_as_cuda_tensors=True):
+    # ArraySpec of the working set of a time step of CVAEstimatorPortfolioInt (with the default backward labels) on
+    # the paths of DiffusionEngine(*engine_args, **engine_kwargs)
+    a = _engine_arguments(engine_args, engine_kwargs).arguments
+    compact_x = a['storage_dtype'] != 'float32' and (a['outputs'] is None or 'X' in a['outputs'])
+    compact_labels = [name for name in ('spread_integrals', 'dom_rate_integral', 'mtm_by_cpty')
+                      if a['storage_dtype'] != 'float32' and (a['outputs'] is None or name in a['outputs'])]
+    P, D, S, R = a['num_paths'], a['num_defs_per_path'], a['num_spreads'], a['num_rates']
+    C = S - 1
+    num_diffusions = 2*R+S-1
+    num_features = 3*R+2*C-1 + (5*R-2+3*S) * include_para_as_fea
+    memory = 'device' if a['backend'] == 'cuda' else 'host'
+    arrays = []
+
+    def device(name, shape, dtype):
+        arrays.append(ArraySpec(name, memory, False, tuple(shape), np.dtype(dtype), 'estimator'))
+
+    # labels of all the paths, built backward in time
+    for name in ('t_spread_integral_now', 't_spread_integral_next', 't_mtm_next', 't_labels_by_cpty'):
+        device(name, (C, P), np.float32)
+    for name in ('t_rate_integral_now', 't_rate_integral_next'):
+        device(name, (P,), np.float32)
+    if a['default_times']:
+        device('t_def', (C, D, P), np.int16)
+    else:
+        device('t_def', ((C+7)//8, D, P), np.int8)
+    device('t_out', (D, P), np.float32)
+    if not labels_as_cuda_tensors:
+        arrays.append(ArraySpec('labels (host)', 'host', a['backend'] == 'cuda', (D, P), np.dtype(np.float32), 'estimator'))
+    for name in compact_labels:
+        # the codes of a date and their decoded values
+        shape = {'spread_integrals': (S, P), 'dom_rate_integral': (P,), 'mtm_by_cpty': (C, P)}[name]
+        device(name+' (codes)', shape, np.int16)
+        device(name+' (decoded)', shape, np.float32)
+    # mini-batch of features and labels
+    device('features_gpu', (batch_size, num_features), np.float32)
+    device('def_indicators_gpu', (batch_size, (C+7)//8), np.uint8)
+    device('default_steps_gpu', (batch_size, C), np.int16)
+    device('labels_gpu', (batch_size, 1), np.float32)
+    if compact_x:
+        for name in ('X', 'X_prev'):
+            device(name+' (codes)', (num_diffusions, P), np.int16)
+            device(name+' (decoded)', (num_diffusions, P), np.float32)
+    # network: parameters, gradients, Adam moments and the copies of the best state
+    num_weights = 0
+    dim_in = num_features
+    for _ in range(num_hidden_layers):
+        num_weights += (dim_in+1)*num_hidden_units
+        dim_in = num_hidden_units
+    num_weights += dim_in+1
+    device('network (params, grads, Adam moments, best state)', (7, num_weights), np.float32)
+    device('h_aug', (batch_size, num_hidden_units+1), np.float32)
+    device('activations (estimate)', (2*num_hidden_layers, batch_size, num_hidden_units), np.float32)
+    device('predicted_xva', (D*P, 1), np.float32)
+    return arrays
+
+
+class MemoryPlan:
+    def __init__(self, arrays, features=(), engine_args=None, engine_kwargs=None, batch_size=None):
+        self.arrays = arrays    # ArraySpec of all the arrays, optional features included
+        self.features = tuple(features)  # optional features accounted for in the totals, among OPTIONAL_FEATURES
+        self.engine_args = engine_args  # arguments of DiffusionEngine with the planned cDtoH_freq
+        self.engine_kwargs = engine_kwargs
+        self.batch_size = batch_size    # planned batch_size of the estimator, if any
+
+    @property
+    def cDtoH_freq(self):
+        return _engine_arguments(self.engine_args, self.engine_kwargs).arguments['cDtoH_freq']
+
+    def selected(self):
+        return [spec for spec in self.arrays if spec.when in ('engine', 'estimator') or spec.when in self.features]
+
+    def bytes(self, memory, when=None):
+        # total bytes in memory ('host' or 'device') of the selected arrays, or of those allocated by when
+        return sum(array_nbytes(spec) for spec in self.selected() if spec.memory == memory and (when is None or spec.when == when))
+
+    @property
+    def host_bytes(self):
+        return self.bytes('host')
+
+    @property
+    def device_bytes(self):
+        return self.bytes('device')
+
+    def fits(self, device_budget=None, host_budget=None):
+        return (device_budget is None or self.device_bytes <= device_budget) and (host_budget is None or self.host_bytes <= host_budget)
+
+    def summary(self, min_bytes=0):
+        # table of the selected arrays of at least min_bytes bytes, largest first, and of the totals
+        lines = ['{:<52} {:<7} {:<11} {:>11}'.format('array', 'memory', 'allocated', 'MB')]
+        for spec in sorted(self.selected(), key=array_nbytes, reverse=True):
+            if array_nbytes(spec) >= min_bytes:
+                memory = 'pinned' if spec.pinned else spec.memory
+                lines.append('{:<52} {:<7} {:<11} {:>11.2f}'.format(spec.name, memory, spec.when, array_nbytes(spec)/2**20))
+        for memory in ('host', 'device'):
+            lines.append('{:<52} {:<7} {:<11} {:>11.2f}'.format('total', memory, '', self.bytes(memory)/2**20))
+        if self.batch_size is not None:
+            lines.append('cDtoH_freq: {}, batch_size: {}'.format(self.cDtoH_freq, self.batch_size))
+        else:
+            lines.append('cDtoH_freq: {}'.format(self.cDtoH_freq))
+        return '\n'.join(lines)
+
+
+def plan_memory(engine_args, engine_kwargs=None, estimator_kwargs=None, features=(), device_budget=None, host_budget=None,
+                stream_buffers=2, antithetic=False):
+    # memory plan of DiffusionEngine(*engine_args, **engine_kwargs) and, with estimator_kwargs (keyword arguments of
+    # estimator_arrays, batch_size included), of the estimator trained on its paths, the optional features (see
+    # OPTIONAL_FEATURES) being accounted for. With a device and/or host budget (in bytes), the largest batch_size
+    # (at most estimator_kwargs['batch_size']) and then the largest cDtoH_freq fitting in the budgets are planned
+    for feature in features:
+        assert feature in OPTIONAL_FEATURES, 'features must be among {}'.format(OPTIONAL_FEATURES)
+    bound = _engine_arguments(engine_args, engine_kwargs)
+    a = bound.arguments
+
+    def plan(cDtoH_freq, batch_size):
+        a['cDtoH_freq'] = cDtoH_freq
+        args, kwargs = bound.args[1:], bound.kwargs
+        arrays = engine_arrays(args, kwargs, stream_buffers)
+        if estimator_kwargs is not None:
+            arrays += estimator_arrays(args, kwargs, **dict(estimator_kwargs, batch_size=batch_size))
+        return MemoryPlan(arrays, features, args, kwargs, batch_size)
+
+    batch_size = None if estimator_kwargs is None else estimator_kwargs['batch_size']
+    if device_budget is None and host_budget is None:
+        return plan(a['cDtoH_freq'], batch_size)
+    num_steps = a['num_coarse_steps'] + (0 if a['early_pricing_date'] is None else len(a['early_pricing_date']))
+    if batch_size is None:
+        batch_sizes = [None]
+    else:
+        batch_sizes = [b for b in estimator_batch_sizes(bound.args[1:], bound.kwargs, antithetic) if b <= batch_size][::-1]
+    for b in batch_sizes:
+        if not plan(1, b).fits(device_budget, host_budget):
+            continue
+        # the memory grows with cDtoH_freq, the largest one fitting is found by bisection
+        lo, hi = 1, num_steps
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if plan(mid, b).fits(device_budget, host_budget):
+                lo = mid
+            else:
+                hi = mid - 1
+        return plan(lo, b)
+    smallest = plan(1, batch_sizes[-1])
+    raise MemoryError('the run does not fit in the budget even with cDtoH_freq=1{}: {:.1f} MB of host and {:.1f} MB of device memory are needed'.format(
+        '' if batch_size is None else ' and batch_size={}'.format(batch_sizes[-1]), smallest.host_bytes/2**20, smallest.device_bytes/2**20))
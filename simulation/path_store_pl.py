@@ -0,0 +1,163 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# On-disk store of simulated paths, so that large runs can be generated once and consumed out-of-core.
+#
+# Each array has the layout of the corresponding host array of DiffusionEngine, (date, ..., path), and is split
+# into chunks of dates_per_chunk dates and paths_per_block paths. Each chunk is a .npy file
+#     <directory>/<name>/<date chunk>_<path block>.npy
+# which is opened with np.load(mmap_mode=...), i.e. as an np.memmap, and is only read from (or written to) disk
+# page by page. The sizes and dtypes are described in <directory>/store.json. The default indicators are stored
+# packed, as in DiffusionEngine (one bit per counterparty).
+
+import json
+import os
+import numpy as np
+
+STORED_ARRAYS = ('X', 'mtm_by_cpty', 'cash_flows_by_cpty', 'spread_integrals', 'dom_rate_integral', 'def_indicators')
+
+
+class PathStore:
+    def __init__(self, directory, mode='r'):
+        # opens an existing store, mode being 'r' (read-only) or 'r+' (to write more paths into it)
+        assert mode in ('r', 'r+'), 'mode must be either \'r\' or \'r+\''
+        self.directory = directory
+        self.mode = mode
+        with open(os.path.join(directory, 'store.json')) as f:
+            meta = json.load(f)
+        self.num_dates = meta['num_dates']  # number of dates (the initial one included)
+        self.num_paths = meta['num_paths']  # total number of paths
+        self.dates_per_chunk = meta['dates_per_chunk']
+        self.paths_per_block = meta['paths_per_block']
+        self.shapes = {name: tuple(shape) for name, shape in meta['shapes'].items()}   # shape of each array for a single date and path
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in meta['dtypes'].items()}
+        self.num_date_chunks = -(-self.num_dates // self.dates_per_chunk)
+        self.num_path_blocks = -(-self.num_paths // self.paths_per_block)
+        self._chunks = {}  # opened chunks, by (name, date chunk, path block)
+
+    @staticmethod
+    def layout(engine, num_paths, dates_per_chunk=None, paths_per_block=None):
+        # description of a store for num_paths paths of the engine (in any number of batches), by default with
+        # chunks of cDtoH_freq dates and blocks of num_paths of the engine; only the arrays of STORED_ARRAYS
+        # retained by the engine (see its outputs) are stored
+        assert not engine.compact_outputs, 'the path store requires storage_dtype=\'float32\''
+        # default_steps has no date axis, the defaults of the paths would be lost
+        assert not engine.default_times, 'the path store requires default_times=False'
+        names = [name for name in STORED_ARRAYS if name in engine.outputs]
+        num_dates = engine.num_coarse_steps+1 + engine.num_early_pricing
+        return {
+            'num_dates': num_dates,
+            'num_paths': num_paths,
+            'dates_per_chunk': min(dates_per_chunk or engine.cDtoH_freq, num_dates),
+            'paths_per_block': min(paths_per_block or engine.num_paths, num_paths),
+            'shapes': {name: list(getattr(engine, name).shape[1:-1]) for name in names},
+            'dtypes': {name: getattr(engine, name).dtype.str for name in names},
+        }
+
+    @classmethod
+    def create(cls, directory, engine, num_paths, dates_per_chunk=None, paths_per_block=None):
+        # creates an empty store for num_paths paths of the engine, see layout
+        return cls.create_from_layout(directory, cls.layout(engine, num_paths, dates_per_chunk, paths_per_block))
+
+    @classmethod
+    def create_from_layout(cls, directory, meta):
+        # creates an empty store described by meta (see layout), e.g. when the engines live in other processes
+        os.makedirs(directory, exist_ok=True)
+        for name in meta['shapes']:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        with open(os.path.join(directory, 'store.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return cls(directory, mode='r+')
+
+    def _chunk_file(self, name, date_chunk, path_block):
+        return os.path.join(self.directory, name, '{}_{}.npy'.format(date_chunk, path_block))
+
+    def chunk(self, name, date_chunk, path_block):
+        # memory map of a chunk, of shape (dates in the chunk,) + shapes[name] + (paths in the block,)
+        key = (name, date_chunk, path_block)
+        if key not in self._chunks:
+            file = self._chunk_file(name, date_chunk, path_block)
+            if os.path.exists(file):
+                self._chunks[key] = np.load(file, mmap_mode=self.mode)
+            else:
+                assert self.mode == 'r+', 'chunk {} of {} was never written'.format((date_chunk, path_block), name)
+                num_dates = min(self.dates_per_chunk, self.num_dates - date_chunk*self.dates_per_chunk)
+                num_paths = min(self.paths_per_block, self.num_paths - path_block*self.paths_per_block)
+                self._chunks[key] = np.lib.format.open_memmap(
+                    file, mode='w+', dtype=self.dtypes[name], shape=(num_dates,)+self.shapes[name]+(num_paths,))
+        return self._chunks[key]
+
+    def _regions(self, date_start, date_stop, path_start, path_stop):
+        # chunks overlapping dates [date_start, date_stop) and paths [path_start, path_stop), as
+        # (date chunk, path block, slice of dates in the chunk, slice of paths in the block, slice of dates in the
+        # region, slice of paths in the region)
+        for date_chunk in range(date_start // self.dates_per_chunk, -(-date_stop // self.dates_per_chunk)):
+            d0 = date_chunk*self.dates_per_chunk
+            d_lo, d_hi = max(date_start, d0), min(date_stop, d0+self.dates_per_chunk)
+            for path_block in range(path_start // self.paths_per_block, -(-path_stop // self.paths_per_block)):
+                p0 = path_block*self.paths_per_block
+                p_lo, p_hi = max(path_start, p0), min(path_stop, p0+self.paths_per_block)
+                yield (date_chunk, path_block, slice(d_lo-d0, d_hi-d0), slice(p_lo-p0, p_hi-p0),
+                       slice(d_lo-date_start, d_hi-date_start), slice(p_lo-path_start, p_hi-path_start))
+
+    def write(self, name, date_start, path_start, ary):
+        # writes ary, of shape (num dates,) + shapes[name] + (num paths,), at the given first date and first path
+        assert self.mode == 'r+', 'the store is read-only'
+        date_stop = date_start + ary.shape[0]
+        path_stop = path_start + ary.shape[-1]
+        assert date_stop <= self.num_dates and path_stop <= self.num_paths, 'out of the bounds of the store'
+        for date_chunk, path_block, d_chunk, p_chunk, d_ary, p_ary in self._regions(date_start, date_stop, path_start, path_stop):
+            self.chunk(name, date_chunk, path_block)[d_chunk, ..., p_chunk] = ary[d_ary, ..., p_ary]
+
+    def write_batch(self, engine, path_start):
+        # writes the paths of the last generate_batch of the engine as the paths path_start, ..., path_start+num_paths-1
+        for name in self.shapes:
+            self.write(name, 0, path_start, getattr(engine, name)[:self.num_dates])
+
+    def write_stream(self, stream, path_start):
+        # consumes the generator returned by DiffusionEngine.generate_batch_stream, writing each slice as it comes
+        for start_idx, slices in stream:
+            for name in self.shapes:
+                self.write(name, start_idx, path_start, slices[name])
+
+    def read_batch(self, engine, path_start):
+        # loads the paths path_start, ..., path_start+num_paths-1 into the host arrays of the engine, as if they had
+        # been simulated by its last generate_batch, so that they can be consumed by the estimators of learning/
+        for name in self.shapes:
+            self.read(name, paths=slice(path_start, path_start+engine.num_paths), out=getattr(engine, name)[:self.num_dates])
+
+    def read(self, name, dates=slice(None), paths=slice(None), out=None):
+        # copies the given ranges (slices with unit step) of dates and paths into a new array (or into out), only
+        # the chunks overlapping them being read from disk
+        date_start, date_stop, _ = dates.indices(self.num_dates)
+        path_start, path_stop, _ = paths.indices(self.num_paths)
+        shape = (max(date_stop-date_start, 0),)+self.shapes[name]+(max(path_stop-path_start, 0),)
+        if out is None:
+            out = np.empty(shape, self.dtypes[name])
+        assert out.shape == shape, 'out must be of shape {}'.format(shape)
+        for date_chunk, path_block, d_chunk, p_chunk, d_out, p_out in self._regions(date_start, date_stop, path_start, path_stop):
+            out[d_out, ..., p_out] = self.chunk(name, date_chunk, path_block)[d_chunk, ..., p_chunk]
+        return out
+
+    def flush(self):
+        for ary in self._chunks.values():
+            if isinstance(ary, np.memmap) and self.mode == 'r+':
+                ary.flush()
+
+    def close(self):
+        self.flush()
+        self._chunks = {}
@@ -0,0 +1,95 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Counter-based Philox4x32-10 generator (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3", SC11).
+# A draw is a pure function of a key and a counter, so no state has to be stored per path and a path only
+# depends on its global index: results do not change when the paths are split differently across launches,
+# processes or machines, and any single path can be regenerated on its own.
+#
+# The "RNG states" passed to the kernels are then a uint32 array of length 4:
+#     (seed, batch index, global index of the first path simulated by the engine,
+#      global index of the coarse step preceding the ones currently held in the device arrays)
+# the first two words being the Philox key. The 4 words of the counter are laid out as follows
+# (c0 is always the global path index, and the coarse steps are global indices):
+#     PHILOX_EXP1:   (path, default scenario, name, PHILOX_EXP1)
+#     PHILOX_OUTER:  (path, coarse step, fine step * num_draws + draw, PHILOX_OUTER), num_draws being num_diffusions
+#                    plus the number of common factors of a factor model of the correlation (see correlation_pl.py)
+#     PHILOX_NESTED_*: (path, inner path, draw index, PHILOX_NESTED_* + PHILOX_NUM_STREAMS*launch), where the
+#                      stream identifies the nested kernel and launch its coarse date (and Adam iteration)
+#     PHILOX_PARAMS: (path, shocked parameter, 0, PHILOX_PARAMS) for the pathwise parameter shocks drawn from a
+#                    ShockSpec (see shocks_pl.py), and (first path of the engine, shocked parameter, 1, PHILOX_PARAMS) for
+#                    the keys of their stratum permutations
+# Like the xoroshiro128p helpers of numba.cuda.random, these functions can be called both from CUDA
+# kernels and from CPU compiled functions.
+
+import numpy as np
+from numba import jit, float32, uint32, uint64
+
+PHILOX_M0 = uint32(0xD2511F53)
+PHILOX_M1 = uint32(0xCD9E8D57)
+PHILOX_W0 = uint32(0x9E3779B9)
+PHILOX_W1 = uint32(0xBB67AE85)
+
+PHILOX_EXP1 = 0
+PHILOX_OUTER = 1
+PHILOX_NESTED_CVA = 2
+PHILOX_NESTED_IM = 3
+PHILOX_NESTED_IM_ERR = 4
+PHILOX_PARAMS = 5
+PHILOX_NUM_STREAMS = 8
+
+
+def philox_key(seed, batch_idx, path_offset, coarse_offset=0):
+    assert 0 <= seed < 2**32, 'the seed must fit in 32 bits with the counter-based generator'
+    return np.array([seed, batch_idx, path_offset, coarse_offset], dtype=np.uint32)
+
+
+@jit(forceinline=True)
+def _mulhilo32(a, b):
+    p = uint64(a) * uint64(b)
+    return uint32(p >> uint64(32)), uint32(p & uint64(0xFFFFFFFF))
+
+
+@jit(forceinline=True)
+def philox4x32_10(k0, k1, c0, c1, c2, c3):
+    k0 = uint32(k0)
+    k1 = uint32(k1)
+    c0 = uint32(c0)
+    c1 = uint32(c1)
+    c2 = uint32(c2)
+    c3 = uint32(c3)
+    for _ in range(10):
+        hi0, lo0 = _mulhilo32(PHILOX_M0, c0)
+        hi1, lo1 = _mulhilo32(PHILOX_M1, c2)
+        c0, c1, c2, c3 = uint32(hi1 ^ c1 ^ k0), lo1, uint32(hi0 ^ c3 ^ k1), lo0
+        k0 = uint32(k0 + PHILOX_W0)
+        k1 = uint32(k1 + PHILOX_W1)
+    return c0, c1, c2, c3
+
+
+@jit(forceinline=True)
+def _uint32_to_unit_float32(x):
+    # uniform on (0, 1], so that log(u) is always finite (same convention as -log for the Exp(1) draws)
+    return float32((x >> uint32(8)) + uint32(1)) * float32(5.9604644775390625e-08)
+
+
+@jit(forceinline=True)
+def philox_uniform_float32_pair(rng_key, c0, c1, c2, c3):
+    # two independent uniforms for the counter (c0, c1, c2, c3), where c0 is the path index local to the
+    # engine, to which the global index of its first path is added
+    x0, x1, _, _ = philox4x32_10(rng_key[0], rng_key[1], uint32(rng_key[2] + uint32(c0)), c1, c2, c3)
+    return _uint32_to_unit_float32(x0), _uint32_to_unit_float32(x1)
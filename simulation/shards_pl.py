@@ -0,0 +1,159 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Splitting one logical run of num_paths paths over several worker processes.
+#
+# The paths are split into shards of paths_per_shard consecutive paths, which are assigned to the workers in a
+# round-robin fashion. Each worker builds a single DiffusionEngine of paths_per_shard paths and simulates its shards
+# one after the other by moving its path_offset, the counter-based generators (rng='philox' or 'sobol') making each
+# path depend only on its global index, seed and batch index. The shards therefore do not overlap, and the merged
+# run is identical to that of a single engine of num_paths paths, whatever the number of shards and workers. Each
+# shard is written to its own path block of a PathStore (see simulation/path_store_pl.py), which is the merged
+# dataset, and can be loaded back batch by batch into an engine with PathStore.read_batch.
+
+import os
+import time
+import traceback
+import multiprocessing as mp
+import numba
+import numpy as np
+
+from simulation.path_store_pl import PathStore
+from simulation.shocks_pl import ShockSpec
+
+# index of num_paths among the positional arguments of DiffusionEngine
+NUM_PATHS_ARG = 6
+
+
+def _worker(worker_idx, engine_args, engine_kwargs, num_threads, directory, shards, batch_idx, batch_kwargs,
+            pathwise_diff_para, ready, start, results):
+    # simulates the shards (shard index, first path) of a worker, reporting its progress to the coordinator
+    try:
+        if num_threads is not None:
+            numba.set_num_threads(num_threads)
+        from simulation.diffusion_engine_pl import DiffusionEngine
+        engine = DiffusionEngine(*engine_args, **engine_kwargs)
+        ready.put((worker_idx, PathStore.layout(engine, 1)))
+        start.wait()
+        store = PathStore(directory, mode='r+')
+        for shard_idx, path_start in shards:
+            begin = time.perf_counter()
+            engine.path_offset = path_start
+            engine.reset_rng_states(engine.seed)
+            engine._rng_batch_idx = batch_idx
+            # the shocks are relative to the initial values, which the shocks of the previous shard have overwritten
+            engine.X[0] = engine.base_initial_values[:, np.newaxis]
+            if isinstance(pathwise_diff_para, ShockSpec):
+                # drawn by the engine of the shard, at its path offset in the run
+                engine._gen_diff_params(pathwise_diff_para)
+            elif pathwise_diff_para is not None:
+                engine._gen_diff_params(pathwise_diff_para[:, path_start:path_start+engine.num_paths])
+            engine.generate_batch(**batch_kwargs)
+            store.write_batch(engine, path_start)
+            # the chunks of a shard are only written once, they are released so that the memory does not grow
+            store.close()
+            results.put((worker_idx, shard_idx, time.perf_counter() - begin, engine.irs_f32[:, 3].copy()))
+        results.put((worker_idx, None, None, None))
+    except Exception:
+        results.put((worker_idx, None, None, traceback.format_exc()))
+        ready.put((worker_idx, traceback.format_exc()))
+
+
+class ShardedRun:
+    def __init__(self, engine_args, paths_per_shard, num_workers, engine_kwargs=None, devices=None, threads_per_worker=None):
+        # engine_args: positional arguments of DiffusionEngine for the whole run, num_paths included, engine_kwargs:
+        # its keyword arguments, rng being 'philox' or 'sobol', devices: with backend='cuda', the GPUs among which the
+        # workers are spread, threads_per_worker: with backend='cpu', numba threads of each worker (by default, the
+        # cores are split evenly between the workers)
+        self.engine_kwargs = dict(engine_kwargs or {})
+        assert self.engine_kwargs.get('rng') in ('philox', 'sobol'), 'sharding requires a counter-based generator (rng=\'philox\' or \'sobol\')'
+        assert self.engine_kwargs.get('path_offset', 0) == 0, 'the path offsets are set by the coordinator'
+        self.num_paths = engine_args[NUM_PATHS_ARG]    # number of paths of the logical run
+        assert self.num_paths % paths_per_shard == 0, 'num_paths must be a multiple of paths_per_shard'
+        self.paths_per_shard = paths_per_shard
+        self.num_shards = self.num_paths // paths_per_shard
+        self.num_workers = min(num_workers, self.num_shards)
+        self.engine_args = tuple(engine_args[:NUM_PATHS_ARG]) + (paths_per_shard,) + tuple(engine_args[NUM_PATHS_ARG+1:])
+        self.devices = devices
+        if threads_per_worker is None and self.engine_kwargs.get('backend', 'cuda') == 'cpu':
+            threads_per_worker = max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.threads_per_worker = threads_per_worker
+        self.startup_time = None
+        self.run_time = None
+        self.shard_times = None     # simulation and write time of each shard, in s, after run
+        self.swap_rates = None  # swap rates of the swaps after run, at par if set_irs_at_par
+
+    def shards(self, worker_idx):
+        # (shard index, first path) of the shards of a worker
+        return [(shard_idx, shard_idx*self.paths_per_shard) for shard_idx in range(worker_idx, self.num_shards, self.num_workers)]
+
+    def run(self, directory, batch_idx=0, pathwise_diff_para=None, dates_per_chunk=None, **batch_kwargs):
+        # simulates all the shards of the batch batch_idx into a new PathStore in directory, which is returned;
+        # pathwise_diff_para: relative pathwise shocks of the parameters of the whole run, of shape
+        # (num_params, num_paths), or a ShockSpec (its groups then split the paths of the whole run, each shard drawing
+        # the shocks of its own paths), batch_kwargs: keyword arguments of generate_batch (fused=True by default)
+        batch_kwargs.setdefault('fused', True)
+        if isinstance(pathwise_diff_para, ShockSpec):
+            assert pathwise_diff_para.num_paths in (None, self.num_paths), 'the num_paths of the ShockSpec must be that of the run'
+            pathwise_diff_para = pathwise_diff_para._replace(num_paths=self.num_paths)
+        # with pathwise shocks, the par swap rates would be those of the first path of each shard
+        assert pathwise_diff_para is None or not batch_kwargs.get('set_irs_at_par', True), \
+            'with pathwise_diff_para, set the swaps at par beforehand and use set_irs_at_par=False'
+        ctx = mp.get_context('spawn')
+        ready, results, start = ctx.Queue(), ctx.Queue(), ctx.Event()
+        begin = time.perf_counter()
+        workers = []
+        for worker_idx in range(self.num_workers):
+            engine_kwargs = dict(self.engine_kwargs)
+            if self.devices is not None:
+                engine_kwargs['device'] = self.devices[worker_idx % len(self.devices)]
+            workers.append(ctx.Process(target=_worker, args=(
+                worker_idx, self.engine_args, engine_kwargs, self.threads_per_worker, directory, self.shards(worker_idx),
+                batch_idx, batch_kwargs, pathwise_diff_para, ready, start, results), daemon=True))
+            workers[-1].start()
+        try:
+            # the store is created from the layout of the engine of a worker, once all of them are built
+            layouts = dict(ready.get() for _ in workers)
+            for worker_idx, layout in layouts.items():
+                if isinstance(layout, str):
+                    raise RuntimeError('worker {} failed:\n{}'.format(worker_idx, layout))
+            self.startup_time = time.perf_counter() - begin    # time to start the workers and build their engines, in s
+            layout = dict(layouts[0], num_paths=self.num_paths, paths_per_block=self.paths_per_shard)
+            layout['dates_per_chunk'] = min(dates_per_chunk or layout['dates_per_chunk'], layout['num_dates'])
+            store = PathStore.create_from_layout(directory, layout)
+            begin = time.perf_counter()
+            start.set()
+            self.shard_times = [None] * self.num_shards
+            num_done = 0
+            while num_done < self.num_workers:
+                worker_idx, shard_idx, elapsed, swap_rates = results.get()
+                if shard_idx is not None:
+                    self.shard_times[shard_idx] = elapsed
+                    if shard_idx == 0:
+                        self.swap_rates = swap_rates
+                elif swap_rates is not None:
+                    raise RuntimeError('worker {} failed:\n{}'.format(worker_idx, swap_rates))
+                else:
+                    num_done += 1
+            self.run_time = time.perf_counter() - begin    # wall time of the simulation of all the shards, in s
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        for worker in workers:
+            worker.join()
+        return PathStore(store.directory)
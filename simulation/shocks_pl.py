@@ -0,0 +1,126 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Pathwise shocks of the parameters drawn by the engine, from a compact ShockSpec passed as pathwise_diff_para
+# (instead of a (num_params, num_paths) array of relative shocks built on the host).
+#
+# The parameters are numbered as the rows of pathwise_diff_para: the initial values of the diffusions, then the
+# diffusion parameters in the layout of g_diff_params (see DiffusionEngine). As in the bump notebooks, the paths are
+# split into consecutive batches, one per group, the last one taking the remainder: the paths of a batch shock the
+# parameters of their group only, by a relative shock scale * z, i.e. parameter = base * (1 + scale * z), with
+#  - 'normal': z independent standard normals;
+#  - 'stratified': the z of the first parameter of the group is stratified over the paths of its batch (one path per
+#    stratum of probability 1/n), the others are independent normals (for the groups of one parameter, or the
+#    regressions on one direction);
+#  - 'lhs': Latin hypercube, each parameter of the group being stratified over the batch, with an independent random
+#    order of the strata per parameter;
+#  - 'bump': z = 1, the deterministic bumps of the "rapid bump" sensitivities.
+# A negative scale gives the opposite shocks of the same draws (the antithetic bump runs of the notebooks).
+#
+# The batches split the paths of the logical run, num_paths of the spec (by default, those of the engine), the engine
+# holding its paths path_offset, ..., path_offset+num_paths-1 (e.g. a shard of a ShardedRun). The draws are
+# counter-based Philox draws (see philox_pl.py), keyed by the seed of the spec and the global index of the path,
+# whatever the rng of the engine, so that the shocks are the same on both backends and whatever the sharding. The strata are
+# permuted by the hash-based permutation of Kensler, "Correlated Multi-Jittered Sampling" (Pixar technical memo
+# 13-01, 2013), which needs no storage per path.
+
+from collections import namedtuple
+import numpy as np
+from numba import jit, uint32
+
+from simulation.sobol_pl import norm_invcdf
+
+SAMPLINGS = ('normal', 'stratified', 'lhs', 'bump')
+
+# groups: sequence of sequences of parameter rows (one batch of paths per group), scales: one relative scale per group,
+# or one sequence of scales per group (one per row), sampling: one of SAMPLINGS, seed: seed of the Philox draws,
+# num_paths: number of paths of the logical run, None for the paths of the engine
+ShockSpec = namedtuple('ShockSpec', ('groups', 'scales', 'sampling', 'seed', 'num_paths'), defaults=('normal', 0, None))
+
+
+def shock_layout(spec, num_params, num_paths):
+    # flattened spec read by the kernels: the rows of the groups, their scales, the offsets (num_groups+1,) of the groups
+    # in the rows, and the number of paths of a batch (the last one taking the remainder) of the num_paths paths of the run
+    assert spec.sampling in SAMPLINGS, 'sampling must be one of {}'.format(SAMPLINGS)
+    num_groups = len(spec.groups)
+    assert 0 < num_groups <= num_paths, 'there must be between 1 and num_paths groups'
+    if np.ndim(spec.scales) == 0:
+        scales = [np.full(len(group), spec.scales) for group in spec.groups]
+    else:
+        assert len(spec.scales) == num_groups, 'scales must have one entry per group'
+        scales = [np.broadcast_to(np.asarray(scale, np.float32), (len(group),)) for group, scale in zip(spec.groups, spec.scales)]
+    for group in spec.groups:
+        group = np.asarray(group, np.int64)
+        assert ((0 <= group) & (group < num_params)).all(), 'the rows of the groups must be between 0 and num_params-1'
+        assert np.unique(group).size == group.size, 'the rows of a group must be distinct'
+    rows = np.concatenate([np.asarray(group, np.int32).ravel() for group in spec.groups])
+    row_scales = np.concatenate(scales).astype(np.float32)
+    group_starts = np.cumsum([0] + [len(group) for group in spec.groups]).astype(np.int32)
+    return rows, row_scales, group_starts, num_paths // num_groups
+
+
+def shocked_rows(spec):
+    # rows moved on some path
+    rows = np.concatenate([np.asarray(group, np.int32).ravel() for group in spec.groups])
+    if np.ndim(spec.scales) == 0:
+        return rows if spec.scales != 0 else rows[:0]
+    scales = np.concatenate([np.broadcast_to(np.asarray(scale, np.float32), (len(group),)) for group, scale in zip(spec.groups, spec.scales)])
+    return rows[scales != 0]
+
+
+@jit(forceinline=True)
+def permute_stratum(i, n, key):
+    # image of i by the random permutation of range(n) of the given key (Kensler's permute, cycle-walking over the
+    # next power of 2)
+    i = uint32(i)
+    n = uint32(n)
+    p = uint32(key)
+    w = uint32(n - uint32(1))
+    w = uint32(w | (w >> uint32(1)))
+    w = uint32(w | (w >> uint32(2)))
+    w = uint32(w | (w >> uint32(4)))
+    w = uint32(w | (w >> uint32(8)))
+    w = uint32(w | (w >> uint32(16)))
+    while True:
+        i = uint32(i ^ p)
+        i = uint32(i * uint32(0xE170893D))
+        i = uint32(i ^ (p >> uint32(16)))
+        i = uint32(i ^ ((i & w) >> uint32(4)))
+        i = uint32(i ^ (p >> uint32(8)))
+        i = uint32(i * uint32(0x0929EB3F))
+        i = uint32(i ^ (p >> uint32(23)))
+        i = uint32(i ^ ((i & w) >> uint32(1)))
+        i = uint32(i * uint32(uint32(1) | (p >> uint32(27))))
+        i = uint32(i * uint32(0x6935FA69))
+        i = uint32(i ^ ((i & w) >> uint32(11)))
+        i = uint32(i * uint32(0x74DCB303))
+        i = uint32(i ^ ((i & w) >> uint32(2)))
+        i = uint32(i * uint32(0x9E501CC3))
+        i = uint32(i ^ ((i & w) >> uint32(2)))
+        i = uint32(i * uint32(0xC860A3DF))
+        i = uint32(i & w)
+        i = uint32(i ^ (i >> uint32(5)))
+        if i < n:
+            break
+    return uint32(uint32(i + p) % n)
+
+
+@jit(forceinline=True)
+def stratified_normal(stratum, n, u):
+    # normal of the stratum (of probability 1/n) given by the uniform u in (0, 1] of philox_uniform_float32_pair, whose
+    # 2^24 values are shifted by half a step, so that the probability stays in (0, 1)
+    return norm_invcdf((stratum + u - 2.98023223876953125e-08) / n)
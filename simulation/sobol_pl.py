@@ -0,0 +1,237 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Scrambled Sobol driver for the outer diffusion, used with rng='sobol'.
+#
+# The Brownian motions are first built on the coarse grid by a Brownian bridge (the terminal value, then the
+# midpoints of the coarse intervals in breadth-first order), the i-th constructed point of factor f being
+# driven by the Sobol coordinate i*num_factors+f of the point whose index is the global path index, so that
+# the first dimensions carry most of the variance. The fine increments inside a coarse step are then drawn
+# from the Brownian bridge between its two coarse points, using the counter-based Philox normals of
+# philox_pl.py. Default times and the nested simulations also use Philox.
+#
+# Each coarse point is obtained by walking down the bisection tree from the terminal point, which only takes
+# O(log(num_coarse_steps)) Sobol coordinates and no storage per path, so that a kernel launch can start at
+# any coarse step.
+#
+# The points are scrambled with the hash-based nested uniform (Owen) scrambling of Burley, "Practical
+# Hash-based Owen Scrambling" (JCGT 2020), keyed by (seed, batch index, dimension): the successive batches
+# are independent randomized QMC replications, hence the standard error can be estimated across batches.
+# The direction numbers use primitive polynomials in increasing order of degree and initial direction
+# numbers drawn once and for all with a fixed seed (Sobol's original random initialisation).
+#
+# The "RNG states" passed to the kernels then extend the Philox key of philox_pl.py:
+#     (seed, batch index, path offset, coarse offset, num_coarse_steps, num_factors,
+#      order of construction of the coarse points (num_coarse_steps+1 words),
+#      direction numbers (32 words per dimension))
+
+import functools
+import math
+import numpy as np
+from numba import jit, float32, float64, uint32
+from simulation.philox_pl import philox_key
+
+SOBOL_NUM_BITS = 32
+SOBOL_ORDER_START = 6
+
+
+def _gf2_mulmod(a, b, p, deg):
+    r = 0
+    while b:
+        if b & 1:
+            r ^= a
+        b >>= 1
+        a <<= 1
+        if (a >> deg) & 1:
+            a ^= p
+    return r
+
+
+def _gf2_x_powmod(e, p, deg):
+    r, a = 1, 2
+    while e:
+        if e & 1:
+            r = _gf2_mulmod(r, a, p, deg)
+        a = _gf2_mulmod(a, a, p, deg)
+        e >>= 1
+    return r
+
+
+def _prime_factors(n):
+    factors = []
+    d = 2
+    while d*d <= n:
+        if n % d == 0:
+            factors.append(d)
+            while n % d == 0:
+                n //= d
+        d += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+
+def _primitive_polynomials(n):
+    # the n first primitive polynomials over GF(2), by increasing degree, as bit masks
+    polys = [0b11]
+    deg = 2
+    while len(polys) < n:
+        order = (1 << deg) - 1
+        factors = _prime_factors(order)
+        for p in range((1 << deg) | 1, 1 << (deg+1), 2):
+            if bin(p).count('1') % 2 == 0:
+                continue    # divisible by x+1
+            if _gf2_x_powmod(order, p, deg) != 1 or any(_gf2_x_powmod(order//q, p, deg) == 1 for q in factors):
+                continue
+            polys.append(p)
+            if len(polys) == n:
+                break
+        deg += 1
+    return polys[:n]
+
+
+@functools.lru_cache(maxsize=4)
+def sobol_direction_numbers(num_dims):
+    dirs = np.empty((num_dims, SOBOL_NUM_BITS), dtype=np.uint32)
+    dirs[0] = 1 << (SOBOL_NUM_BITS - 1 - np.arange(SOBOL_NUM_BITS, dtype=np.uint64))    # van der Corput
+    rng = np.random.RandomState(0)
+    for d, p in enumerate(_primitive_polynomials(num_dims-1), 1):
+        s = p.bit_length() - 1
+        m = [2*int(rng.randint(0, 1 << i)) + 1 for i in range(s)]   # odd and < 2^(i+1)
+        for i in range(s, SOBOL_NUM_BITS):
+            new_m = m[i-s] ^ (m[i-s] << s)
+            for k in range(1, s):
+                if (p >> (s-k)) & 1:
+                    new_m ^= m[i-k] << k
+            m.append(new_m)
+        dirs[d] = [m[i] << (SOBOL_NUM_BITS-1-i) for i in range(SOBOL_NUM_BITS)]
+    return dirs
+
+
+def brownian_bridge_order(num_points):
+    # order[k]: rank of the coarse point k (1 <= k <= num_points) in the breadth-first bisection construction
+    order = np.zeros(num_points+1, dtype=np.uint32)
+    queue = [(0, num_points)]
+    rank = 1
+    while queue:
+        l, r = queue.pop(0)
+        if r - l > 1:
+            m = (l + r) // 2
+            order[m] = rank
+            rank += 1
+            queue += [(l, m), (m, r)]
+    return order
+
+
+def sobol_states(seed, batch_idx, path_offset, num_coarse_steps, num_factors, coarse_offset=0):
+    dirs = sobol_direction_numbers(num_coarse_steps*num_factors)
+    return np.concatenate([philox_key(seed, batch_idx, path_offset, coarse_offset),
+                           np.array([num_coarse_steps, num_factors], dtype=np.uint32),
+                           brownian_bridge_order(num_coarse_steps), dirs.ravel()])
+
+
+@jit(forceinline=True)
+def _reverse_bits32(x):
+    x = uint32(((x >> uint32(1)) & uint32(0x55555555)) | ((x & uint32(0x55555555)) << uint32(1)))
+    x = uint32(((x >> uint32(2)) & uint32(0x33333333)) | ((x & uint32(0x33333333)) << uint32(2)))
+    x = uint32(((x >> uint32(4)) & uint32(0x0F0F0F0F)) | ((x & uint32(0x0F0F0F0F)) << uint32(4)))
+    x = uint32(((x >> uint32(8)) & uint32(0x00FF00FF)) | ((x & uint32(0x00FF00FF)) << uint32(8)))
+    return uint32((x >> uint32(16)) | (x << uint32(16)))
+
+
+@jit(forceinline=True)
+def _hash32(x):
+    # lowbias32 integer hash (C. Wellons)
+    x = uint32(x)
+    x = uint32(x ^ (x >> uint32(16)))
+    x = uint32(x * uint32(0x7FEB352D))
+    x = uint32(x ^ (x >> uint32(15)))
+    x = uint32(x * uint32(0x846CA68B))
+    return uint32(x ^ (x >> uint32(16)))
+
+
+@jit(forceinline=True)
+def _nested_uniform_scramble(x, seed):
+    x = _reverse_bits32(x)
+    x = uint32(x + seed)
+    x = uint32(x ^ uint32(x * uint32(0x6C50B47C)))
+    x = uint32(x ^ uint32(x * uint32(0xB82F1E52)))
+    x = uint32(x ^ uint32(x * uint32(0xC7AFE638)))
+    x = uint32(x ^ uint32(x * uint32(0x8D22F6E6)))
+    return _reverse_bits32(x)
+
+
+@jit(forceinline=True)
+def norm_invcdf(p):
+    # Acklam's rational approximation (relative error below 1.2e-9)
+    if p < 0.02425:
+        q = math.sqrt(-2*math.log(p))
+        return (((((-7.784894002430293e-03*q-3.223964580411365e-01)*q-2.400758277161838e+00)*q-2.549732539343734e+00)*q+4.374664141464968e+00)*q+2.938163982698783e+00) / \
+            ((((7.784695709041462e-03*q+3.224671290700398e-01)*q+2.445134137142996e+00)*q+3.754408661907416e+00)*q+1.)
+    elif p > 1 - 0.02425:
+        q = math.sqrt(-2*math.log(1-p))
+        return -(((((-7.784894002430293e-03*q-3.223964580411365e-01)*q-2.400758277161838e+00)*q-2.549732539343734e+00)*q+4.374664141464968e+00)*q+2.938163982698783e+00) / \
+            ((((7.784695709041462e-03*q+3.224671290700398e-01)*q+2.445134137142996e+00)*q+3.754408661907416e+00)*q+1.)
+    q = p - 0.5
+    r = q*q
+    return (((((-3.969683028665376e+01*r+2.209460984245205e+02)*r-2.759285104469687e+02)*r+1.383577518672690e+02)*r-3.066479806614716e+01)*r+2.506628277459239e+00)*q / \
+        (((((-5.447609879822406e+01*r+1.615858368580409e+02)*r-1.556989798598866e+02)*r+6.680131188771972e+01)*r-1.328068155288572e+01)*r+1.)
+
+
+@jit(forceinline=True)
+def _sobol_normal(states, path, dim):
+    # standard normal from the scrambled Sobol coordinate dim of the point of index path
+    base = SOBOL_ORDER_START + states[4] + 1 + dim*SOBOL_NUM_BITS
+    x = uint32(0)
+    n = uint32(path)
+    j = 0
+    while n != uint32(0):
+        if n & uint32(1):
+            x = uint32(x ^ states[base+j])
+        n = uint32(n >> uint32(1))
+        j += 1
+    x = _nested_uniform_scramble(x, _hash32(states[0] ^ _hash32(states[1] ^ _hash32(dim))))
+    u = (float64(x >> uint32(8)) + 0.5) * 5.9604644775390625e-08
+    return norm_invcdf(u)
+
+
+@jit(forceinline=True)
+def sobol_bridge_point(states, c0, k, factor):
+    # value at the global coarse step k of the Brownian motion of the given factor, in units of coarse steps
+    # (i.e. to be multiplied by the square root of the coarse step), for the path of local index c0
+    if k == 0:
+        return float32(0)
+    path = uint32(states[2] + uint32(c0))
+    num_points = states[4]
+    if k > num_points:
+        # the last launch of a batch may run past the horizon, these steps are discarded
+        k = num_points
+    num_factors = states[5]
+    l = 0
+    r = num_points
+    w_l = 0.
+    w_r = math.sqrt(float64(num_points)) * _sobol_normal(states, path, states[SOBOL_ORDER_START+num_points]*num_factors+factor)
+    while r != k:
+        m = (l + r) // 2
+        w_m = ((r-m)*w_l + (m-l)*w_r)/(r-l) + math.sqrt((m-l)*(r-m)/float64(r-l)) * _sobol_normal(states, path, states[SOBOL_ORDER_START+m]*num_factors+factor)
+        if k <= m:
+            r = m
+            w_r = w_m
+        else:
+            l = m
+            w_l = w_m
+    return float32(w_r)
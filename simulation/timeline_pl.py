@@ -0,0 +1,133 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Opt-in timeline of the kernels, copies and learning stages, shared by DiffusionEngine and the estimators of
+# learning/ through their timeline attribute (None by default, in which case nothing is recorded or allocated).
+#
+# Host spans are timed with the wall clock. Device spans (kernel launches and copies) are timed with a pair of events
+# recorded on their stream, cuda.event() with the CUDA backend, where they are resolved into timestamps after the
+# stream is synchronized, and host events with the CPU backend, where the kernels and copies are synchronous. Each
+# span has a name, a category, a track (the host, or the stream it ran on), a byte count for the copies and optional
+# arguments (e.g. the coarse step). The timeline is exported to the Chrome trace format (chrome://tracing or
+# https://ui.perfetto.dev) with save_chrome_trace, and summarized by name with summary.
+
+import contextlib
+import json
+import time
+from collections import OrderedDict
+
+NO_SPAN = contextlib.nullcontext()
+
+
+def span(timeline, name, cat, nbytes=0, sync=None, engine=None, stream=None, track='host', **args):
+    # span of timeline around the body of a with statement, a no-op if timeline is None: with engine, the span of the
+    # work queued on stream (see Timeline.device_span), otherwise a host span (see Timeline.span)
+    if timeline is None:
+        return NO_SPAN
+    if engine is not None:
+        return timeline.device_span(engine, stream, track, name, cat, nbytes, **args)
+    return timeline.span(name, cat, nbytes, sync, **args)
+
+
+class Timeline:
+    def __init__(self):
+        self.origin = time.perf_counter()   # time 0 of the timeline, in s of the wall clock
+        self.spans = []     # resolved spans, as dicts with keys name, cat, track, start, end (in s since origin), bytes, args
+        self._pending = []  # device spans whose events may not have completed yet
+        self._references = {}   # by track, (reference event, its wall-clock time) for the device spans
+
+    def add(self, name, cat, start, end, nbytes=0, track='host', **args):
+        # records a span from its wall-clock start and end, in s
+        self.spans.append({'name': name, 'cat': cat, 'track': track, 'start': start - self.origin, 'end': end - self.origin,
+                           'bytes': nbytes, 'args': args})
+
+    @contextlib.contextmanager
+    def span(self, name, cat, nbytes=0, sync=None, **args):
+        # host span around the body of a with statement, sync (if given) being called before and after it so that
+        # the asynchronous work queued by the body is accounted for
+        if sync is not None:
+            sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync is not None:
+                sync()
+            self.add(name, cat, start, time.perf_counter(), nbytes, **args)
+
+    @contextlib.contextmanager
+    def device_span(self, engine, stream, track, name, cat, nbytes=0, **args):
+        # span of the work queued on stream by the body of a with statement, timed with the events of engine
+        if track not in self._references:
+            # the reference event is recorded on an idle stream, so that it completes at the recorded wall-clock time
+            engine._synchronize()
+            reference = engine._event()
+            reference.record(stream=stream)
+            reference.synchronize()
+            self._references[track] = (reference, time.perf_counter())
+        begin, end = engine._event(), engine._event()
+        begin.record(stream=stream)
+        try:
+            yield
+        finally:
+            end.record(stream=stream)
+            self._pending.append((engine, track, begin, end, name, cat, nbytes, args))
+
+    def resolve(self):
+        # converts the device spans into timestamps, their streams having to be synchronized beforehand
+        for engine, track, begin, end, name, cat, nbytes, args in self._pending:
+            reference, reference_time = self._references[track]
+            end.synchronize()
+            start = reference_time + engine._event_elapsed_time(reference, begin) / 1000
+            self.add(name, cat, start, start + engine._event_elapsed_time(begin, end) / 1000, nbytes, track, **args)
+        self._pending = []
+        self.spans.sort(key=lambda span: span['start'])
+
+    def clear(self):
+        self.resolve()
+        self.spans = []
+
+    def save_chrome_trace(self, path):
+        # writes the spans as complete events ('X') of the Chrome trace format, one thread per track
+        self.resolve()
+        tracks = list(OrderedDict.fromkeys(span['track'] for span in self.spans))
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': track}}
+                  for tid, track in enumerate(tracks)]
+        for span in self.spans:
+            args = dict(span['args'])
+            if span['bytes']:
+                args['bytes'] = span['bytes']
+            events.append({'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'pid': 0, 'tid': tracks.index(span['track']),
+                           'ts': 1e6*span['start'], 'dur': 1e6*(span['end'] - span['start']), 'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        # table of the number of spans, total and mean time, bytes and throughput by category and name
+        self.resolve()
+        totals = OrderedDict()
+        for span in sorted(self.spans, key=lambda span: (span['cat'], span['name'])):
+            total = totals.setdefault((span['cat'], span['name']), [0, 0., 0])
+            total[0] += 1
+            total[1] += span['end'] - span['start']
+            total[2] += span['bytes']
+        lines = ['{:<10} {:<28} {:>7} {:>12} {:>10} {:>10} {:>9}'.format('category', 'name', 'count', 'total (ms)', 'mean (ms)', 'MB', 'GB/s')]
+        for (cat, name), (count, elapsed, nbytes) in totals.items():
+            throughput = '{:9.2f}'.format(nbytes / elapsed / 2**30) if nbytes and elapsed > 0 else ' '*9
+            lines.append('{:<10} {:<28} {:>7} {:>12.3f} {:>10.3f} {:>10.1f} {}'.format(
+                cat, name, count, 1e3*elapsed, 1e3*elapsed/count, nbytes/2**20, throughput))
+        return '\n'.join(lines)
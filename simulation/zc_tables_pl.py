@@ -0,0 +1,52 @@
+# Copyright 2024 Hoang Dung NGUYEN and Botao LI
+
+# This file is part of NeuralXVA.
+
+# NeuralXVA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# NeuralXVA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with NeuralXVA.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tables of the affine coefficients of the Vasicek zero-coupon bonds priced by the swaps.
+#
+# The zero-coupon bond of maturity t+tau is P(t, t+tau) = exp(A(tau) - B(tau) r_t), with
+#     B(tau) = (1 - e^{-a tau}) / a,    A(tau) = (b - sigma^2 / (2 a^2)) (B(tau) - tau) - sigma^2 / (4 a) B(tau)^2
+# which only depend on the currency (a, b, sigma) and on tau. The resets of the swaps and the pricing dates lie on
+# the fine grid, so that tau is a multiple of dt: the kernels read A and B from a table zc_tables[0 or 1, ccy, n]
+# for tau = n dt, instead of computing two exponentials per reset, path and date. The coefficients are computed in
+# double precision and stored in float32; the kernels fall back to the formulas for tau off the grid or beyond the
+# table, and for all tau with an empty table (the outer diffusion when the rate parameters are shocked pathwise).
+
+import numpy as np
+
+
+def num_zc_offsets(irs_specs, dt):
+    # number of offsets n = 0, 1, ... of the table covering the swaps: tau is at most the last reset of a swap (priced
+    # from t >= 0) or its reset period (the fixing of a floating coupon)
+    if irs_specs.size == 0:
+        return 0
+    last_reset = irs_specs['first_reset'].astype(np.float64) + (irs_specs['num_resets'].astype(np.float64) - 1) * irs_specs['reset_freq'].astype(np.float64)
+    max_tau = max(last_reset.max(), irs_specs['reset_freq'].astype(np.float64).max())
+    return int(max_tau / float(dt) + 0.5) + 2
+
+
+def tabulate_zc_coefficients(diff_params, num_rates, dt, out):
+    # fills out, of shape (2, num_rates, num_offsets), with A(n dt) and B(n dt) for each currency, from the Vasicek
+    # parameters at the start of diff_params (a, b and sigma of each currency, see DiffusionEngine)
+    tau = np.arange(out.shape[2]) * float(dt)
+    for ccy in range(num_rates):
+        a = float(diff_params[ccy])
+        b = float(diff_params[num_rates+ccy])
+        sigma = float(diff_params[2*num_rates+ccy])
+        B = -np.expm1(-a*tau) / a
+        out[0, ccy] = (b - 0.5*sigma*sigma/(a*a)) * (B - tau) - 0.25*sigma*sigma/a * B*B
+        out[1, ccy] = B
+    return out